@@ -4,21 +4,44 @@
 
 
 import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import os
 import re
+import select
+import struct
 import sys
+import tempfile
+import time
 from functools import singledispatch
 from io import TextIOWrapper
 from pathlib import Path
 from textwrap import dedent
-from typing import MutableMapping
+from typing import Iterator, MutableMapping, Optional
 
 from git import Repo
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, TemplateError, TemplateNotFound, meta
 
 CHANNELS = re.compile(r"^(latest/|[0-9].[0-9]/)?(edge|beta|candidate|stable)$")
 ROOT_DIR = Repo(Path(__file__), search_parent_directories=True).working_dir
 TEMPLATE_DIRS = [ROOT_DIR, Path(ROOT_DIR) / "templates"]
 
+# inotify(7) events signalling that a file in a watched directory was written or replaced
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+POLL_INTERVAL = 0.05
+# Editors often save in several steps (truncate, write, rename), wait for them to settle
+SETTLE_DELAY = 0.01
+
 
 @singledispatch
 def generate_output(output, content: str) -> None:
@@ -32,12 +55,38 @@ def _(output, content: str) -> None:
         dest.write(content)
 
 
+def write_atomically(output: Path, content: str) -> None:
+    """Write to a temporary file and rename it, readers never see a partial bundle.
+
+    A symlinked output is resolved, the file it points to is replaced and keeps its mode.
+    """
+    output = output.resolve()
+    fd, tmp_path = tempfile.mkstemp(dir=output.parent, prefix=f".{output.name}.")
+    try:
+        with open(fd, mode="wt", encoding="utf-8") as dest:
+            dest.write(content)
+        if output.exists():
+            os.chmod(tmp_path, output.stat().st_mode & 0o777)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_get_umask())
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 @generate_output.register
 def _(output: TextIOWrapper, content: str) -> None:
     with output:
         output.write(content)
 
 
+def _get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
 def channel_type(channel: str) -> str:
     if not CHANNELS.match(channel):
         raise argparse.ArgumentTypeError("invalid channel")
@@ -50,12 +99,189 @@ def process_template_variables(variables: str) -> dict[str, str]:
     return dict(vars_)
 
 
-def render_bundle_file(template_file: Path, variables: MutableMapping[str, str]) -> str:
-    template_env = Environment(loader=FileSystemLoader(TEMPLATE_DIRS))
+def render_bundle_file(
+    template_file: Path,
+    variables: MutableMapping[str, str],
+    template_env: Optional[Environment] = None,
+) -> str:
+    template_env = template_env or Environment(loader=FileSystemLoader(TEMPLATE_DIRS))
     template = template_env.get_template(template_file.name)
     return template.render(**variables)
 
 
+def get_template_dependencies(template_env: Environment, name: str) -> Optional[set[Path]]:
+    """Get the files a template is rendered from: itself and the templates it includes.
+
+    Returns None when a dependency can't be resolved statically, e.g. an include of a
+    variable, any change of the template directories must then trigger a render.
+    """
+    dependencies: set[Path] = set()
+    pending = [name]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source, filename, _ = template_env.loader.get_source(template_env, name)
+        except TemplateNotFound:
+            return None
+        if filename:
+            dependencies.add(Path(filename).resolve())
+        for reference in meta.find_referenced_templates(template_env.parse(source)):
+            if reference is None:
+                return None
+            pending.append(reference)
+    return dependencies
+
+
+def _get_digest(path: Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+class _Inotify:
+    """Watch directories with inotify(7), through the C library."""
+
+    def __init__(self, directories: list[Path]) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # Raises AttributeError where inotify is not available, e.g. on macOS
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd >= 0:
+                self._directories[wd] = directory
+
+    def wait(self) -> set[Path]:
+        """Wait for changes, return the paths that changed."""
+        select.select([self._fd], [], [])
+        changed = self._read()
+        while select.select([self._fd], [], [], SETTLE_DELAY)[0]:
+            changed |= self._read()
+        return changed
+
+    def _read(self) -> set[Path]:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self._directories and name:
+                changed.add((self._directories[wd] / os.fsdecode(name)).resolve())
+        return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class _Poller:
+    """Watch directories by polling the modification time of their files."""
+
+    def __init__(self, directories: list[Path]) -> None:
+        self._directories = directories
+        self._mtimes = self._scan()
+
+    def _scan(self) -> dict[Path, int]:
+        mtimes = {}
+        for directory in self._directories:
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    mtimes[Path(entry.path).resolve()] = entry.stat().st_mtime_ns
+        return mtimes
+
+    def wait(self) -> set[Path]:
+        """Wait for changes, return the paths that changed."""
+        while True:
+            time.sleep(POLL_INTERVAL)
+            mtimes = self._scan()
+            changed = {
+                path
+                for path in mtimes.keys() | self._mtimes.keys()
+                if mtimes.get(path) != self._mtimes.get(path)
+            }
+            self._mtimes = mtimes
+            if changed:
+                return changed
+
+    def close(self) -> None:
+        pass
+
+
+def watch_changes(directories: list[Path]) -> Iterator[set[Path]]:
+    """Yield the paths that changed in the directories, as they change."""
+    try:
+        watcher = _Inotify(directories)
+    except (AttributeError, OSError):
+        print("inotify is not available, polling for changes", file=sys.stderr)
+        watcher = _Poller(directories)
+    try:
+        while True:
+            yield watcher.wait()
+    finally:
+        watcher.close()
+
+
+def watch_bundle_file(
+    template_file: Path, variables: MutableMapping[str, str], output_file: Path
+) -> None:
+    """Render the bundle file whenever the template or a template it includes changes."""
+    # The environment is kept across renders, only the changed templates are compiled again
+    template_env = Environment(loader=FileSystemLoader(TEMPLATE_DIRS))
+    directories = [Path(directory).resolve() for directory in TEMPLATE_DIRS]
+    directories = [directory for directory in directories if directory.is_dir()]
+
+    def render() -> Optional[set[Path]]:
+        start = time.monotonic()
+        try:
+            # The output is read while it is rendered again, e.g. by `juju deploy`
+            write_atomically(
+                output_file, render_bundle_file(template_file, variables, template_env)
+            )
+        except TemplateError as e:
+            print(f"Failed to render {template_file.name}: {e}", file=sys.stderr)
+        else:
+            elapsed = (time.monotonic() - start) * 1000
+            print(f"Rendered {output_file} in {elapsed:.0f}ms", file=sys.stderr)
+        try:
+            return get_template_dependencies(template_env, template_file.name)
+        except TemplateError:
+            return None
+
+    dependencies = render()
+    digests = {path: _get_digest(path) for path in dependencies or ()}
+    output_path = output_file.resolve()
+    for changed in watch_changes(directories):
+        # Writing the output, possibly in a watched directory, is not a change
+        changed = {
+            path
+            for path in changed
+            if path != output_path
+            and not (
+                path.parent == output_path.parent and path.name.startswith(f".{output_path.name}.")
+            )
+        }
+        if dependencies is not None:
+            changed &= dependencies
+            # Skip the files that were saved without being modified
+            changed = {path for path in changed if _get_digest(path) != digests.get(path)}
+        if not changed:
+            continue
+        dependencies = render()
+        digests = {path: _get_digest(path) for path in dependencies or ()}
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -70,6 +296,9 @@ def main() -> None:
 
             # Render to console
             python bundle_renderer.py bundle.yaml.j2 -c <channel> --variables <key>=<value>
+
+            # Render to a file whenever the templates change
+            python bundle_renderer.py bundle.yaml.j2 -o <output file> -c <channel> --watch
         """
         ),
     )
@@ -105,9 +334,23 @@ def main() -> None:
         """
         ),
     )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="render the bundle file again whenever the templates change",
+    )
     args = parser.parse_args()
 
     variables = {**args.variables, **{"channel": args.channel}}
+    if args.watch:
+        if not args.output_file:
+            parser.error("--watch requires --output")
+        try:
+            watch_bundle_file(args.template, variables, args.output_file)
+        except KeyboardInterrupt:
+            pass
+        return
+
     rendered_content = render_bundle_file(args.template, variables)
 
     dest = (
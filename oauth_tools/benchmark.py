@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Measure the token endpoint throughput, e.g. to check that hydra scales out."""
+
+import asyncio
+import logging
+from os.path import join
+from time import monotonic
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import httpx
+
+from oauth_tools.instrumentation import ConnectionStats, get_async_http_client
+
+logger = logging.getLogger(__name__)
+
+
+class ThroughputResult(NamedTuple):
+    """The outcome of a token endpoint benchmark."""
+
+    units: int
+    grant_type: str
+    requests: int
+    errors: int
+    duration: float
+    latencies: Sequence[float]
+    http_version: str = "HTTP/1.1"
+    connections: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """The number of successful requests per second."""
+        return (self.requests - self.errors) / self.duration if self.duration else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """The latency, in seconds, under which `percent` of the requests completed."""
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+
+
+async def measure_token_throughput(
+    hydra_url: str,
+    client_id: str,
+    client_secret: str,
+    units: int,
+    grant_type: str = "client_credentials",
+    refresh_tokens: Optional[List[str]] = None,
+    concurrency: int = 8,
+    duration: float = 10.0,
+    scope: str = "openid profile",
+    http2: bool = False,
+) -> ThroughputResult:
+    """Send token requests for `duration` seconds and measure the throughput.
+
+    Refresh tokens are rotated by hydra, each one can only be used by one worker: with the
+    refresh_token grant, there is one worker per refresh token and each worker carries on
+    with the token it was last issued. The `refresh_tokens` are replaced in place by the
+    last tokens issued, so that they can be passed to the next measurement.
+
+    Args:
+        hydra_url (str): The public URL of hydra.
+        client_id (str): The client_id of a client allowed to use the grant.
+        client_secret (str): The client_secret of the client.
+        units (int): The number of hydra units, to label the result.
+        grant_type (str): Either "client_credentials" or "refresh_token".
+        refresh_tokens (List[str]): The refresh tokens, for the refresh_token grant. They are
+            updated with the tokens issued during the measurement.
+        concurrency (int): The number of concurrent workers, for the client_credentials grant.
+        duration (float): The number of seconds to send requests for.
+        scope (str): The scope to request, for the client_credentials grant.
+        http2 (bool): Whether to multiplex the requests over HTTP/2 connections, rather than
+            use an HTTP/1.1 connection per worker. It requires the `h2` package.
+    """
+    if grant_type not in ("client_credentials", "refresh_token"):
+        raise ValueError(f"Unsupported grant type: {grant_type}")
+    if grant_type == "refresh_token" and not refresh_tokens:
+        raise ValueError("The refresh_token grant needs refresh_tokens")
+    tokens = refresh_tokens if grant_type == "refresh_token" else [None] * concurrency
+
+    url = join(hydra_url, "oauth2/token")
+    latencies: List[float] = []
+    requests = errors = 0
+    http_versions: Dict[str, int] = {}
+    # The connections opened by the client, the network streams may be reused by the pool
+    connection_stats = ConnectionStats()
+
+    async def worker(http_client: httpx.AsyncClient, index: int) -> None:
+        nonlocal requests, errors
+        while monotonic() < deadline:
+            if grant_type == "refresh_token":
+                data = {"grant_type": grant_type, "refresh_token": tokens[index]}
+            else:
+                data = {"grant_type": grant_type, "scope": scope}
+            requests += 1
+            start = monotonic()
+            try:
+                resp = await http_client.post(url, data=data)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(monotonic() - start)
+            http_versions[resp.http_version] = http_versions.get(resp.http_version, 0) + 1
+            if resp.status_code != 200:
+                errors += 1
+                if grant_type == "refresh_token":
+                    # The token chain is broken, there is nothing left to refresh
+                    return
+            elif grant_type == "refresh_token":
+                tokens[index] = resp.json()["refresh_token"]
+
+    limits = httpx.Limits(max_connections=len(tokens), max_keepalive_connections=len(tokens))
+    async with get_async_http_client(
+        callbacks=[connection_stats],
+        auth=(client_id, client_secret),
+        verify=False,
+        limits=limits,
+        http2=http2,
+    ) as http_client:
+        start = monotonic()
+        deadline = start + duration
+        await asyncio.gather(*(worker(http_client, index) for index in range(len(tokens))))
+        elapsed = monotonic() - start
+
+    result = ThroughputResult(
+        units=units,
+        grant_type=grant_type,
+        requests=requests,
+        errors=errors,
+        duration=elapsed,
+        latencies=latencies,
+        # The server may not have negotiated HTTP/2, report the version it spoke the most
+        http_version=max(http_versions, key=http_versions.__getitem__, default="HTTP/1.1"),
+        connections=connection_stats.connections,
+    )
+    logger.info(
+        f"{grant_type} with {units} unit(s) over {result.http_version}: "
+        f"{result.throughput:.1f} req/s, p50 {result.percentile(50) * 1000:.0f}ms, "
+        f"p95 {result.percentile(95) * 1000:.0f}ms, {result.connections} connection(s), "
+        f"{errors} error(s)"
+    )
+    return result
+
+
+def get_scaling_efficiency(results: Sequence[ThroughputResult]) -> Dict[int, float]:
+    """Get the scaling efficiency of each number of units, per grant type.
+
+    The efficiency is the throughput gain relative to the smallest number of units, divided
+    by the units gain: 1.0 means linear scaling, 1/units means the extra units added nothing.
+
+    Args:
+        results (Sequence[ThroughputResult]): The results of a single grant type.
+    """
+    baseline = min(results, key=lambda result: result.units)
+    return {
+        result.units: (result.throughput / baseline.throughput) / (result.units / baseline.units)
+        if baseline.throughput
+        else 0.0
+        for result in results
+    }
+
+
+def format_scaling_table(results: Sequence[ThroughputResult]) -> str:
+    """Format the results as a table, with the scaling efficiency of each grant type.
+
+    Args:
+        results (Sequence[ThroughputResult]): The benchmark results.
+    """
+    rows = [("grant", "units", "req/s", "p50 ms", "p95 ms", "errors", "efficiency")]
+    for grant_type in dict.fromkeys(result.grant_type for result in results):
+        grant_results = sorted(
+            (result for result in results if result.grant_type == grant_type),
+            key=lambda result: result.units,
+        )
+        efficiency = get_scaling_efficiency(grant_results)
+        for result in grant_results:
+            rows.append((
+                grant_type,
+                str(result.units),
+                f"{result.throughput:.1f}",
+                f"{result.percentile(50) * 1000:.0f}",
+                f"{result.percentile(95) * 1000:.0f}",
+                str(result.errors),
+                f"{efficiency[result.units]:.2f}",
+            ))
+
+    return _format_table(rows)
+
+
+def _format_table(rows: Sequence[Sequence[str]]) -> str:
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows
+    )
+
+
+def format_protocol_table(results: Sequence[ThroughputResult]) -> str:
+    """Format the results as a table comparing the HTTP versions, e.g. HTTP/1.1 and HTTP/2.
+
+    Args:
+        results (Sequence[ThroughputResult]): The results of the same benchmark, run with
+            different HTTP versions.
+    """
+    rows = [("http", "grant", "units", "req/s", "p50 ms", "p95 ms", "connections", "errors")]
+    for result in results:
+        rows.append((
+            result.http_version,
+            result.grant_type,
+            str(result.units),
+            f"{result.throughput:.1f}",
+            f"{result.percentile(50) * 1000:.0f}",
+            f"{result.percentile(95) * 1000:.0f}",
+            str(result.connections),
+            str(result.errors),
+        ))
+    return _format_table(rows)
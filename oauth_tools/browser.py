@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Share a browser between the test modules and recycle its contexts."""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import IO, Any, Dict, List, Tuple
+
+from playwright.async_api._generated import Browser, BrowserContext
+
+logger = logging.getLogger(__name__)
+
+
+def _drain(stream: IO[str], browser_name: str) -> None:
+    # The server blocks on its writes once the pipe is full, keep reading until it exits
+    for line in stream:
+        logger.debug(f"{browser_name} server: {line.rstrip()}")
+
+
+def launch_browser_server(
+    browser_name: str, launch_arguments: Dict[str, Any]
+) -> Tuple[subprocess.Popen, str]:
+    """Launch a playwright browser server, the test modules connect to it.
+
+    The playwright objects are bound to the event loop that created them and the event
+    loop is module scoped, so a browser can only be shared across modules from another
+    process.
+
+    Returns the server process and its websocket endpoint, for `BrowserType.connect`.
+
+    Args:
+        browser_name (str): One of "chromium", "firefox" or "webkit".
+        launch_arguments (Dict[str, Any]): The options of the browser, e.g. `headless`.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config:
+        json.dump({k: v for k, v in launch_arguments.items() if v is not None}, config)
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "playwright",
+            "launch-server",
+            "--browser",
+            browser_name,
+            "--config",
+            config.name,
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        # The server prints its endpoint once the browser is launched
+        for line in process.stdout:  # type: ignore[union-attr]
+            if line.startswith("ws://"):
+                logger.info(f"Launched a {browser_name} server")
+                threading.Thread(
+                    target=_drain,
+                    args=(process.stdout, browser_name),
+                    name=f"{browser_name}-server-output",
+                    daemon=True,
+                ).start()
+                return process, line.strip()
+    finally:
+        os.unlink(config.name)
+
+    process.kill()
+    raise RuntimeError(f"Failed to launch a {browser_name} server")
+
+
+class BrowserContextPool:
+    """A bounded pool of browser contexts, cleared between uses.
+
+    Creating a context is cheaper than launching a browser, but still costs tens of
+    milliseconds and some memory. The contexts are cleared (pages, cookies, permissions and
+    routes) when they are released, and closed after `max_uses` uses so that the memory
+    they accumulate is returned. The storage of the origins (e.g. localStorage) is not
+    cleared, tests that depend on it must use a context of their own.
+    """
+
+    def __init__(
+        self, browser: Browser, max_size: int = 2, max_uses: int = 20, **context_kwargs: Any
+    ):
+        """Create an empty pool.
+
+        Args:
+            browser (Browser): The browser the contexts are created in.
+            max_size (int): The maximum number of idle contexts kept.
+            max_uses (int): The number of uses after which a context is closed.
+            context_kwargs (Any): The arguments of `Browser.new_context`.
+        """
+        self._browser = browser
+        self._max_size = max_size
+        self._max_uses = max_uses
+        self._context_kwargs = context_kwargs
+        self._idle: List[BrowserContext] = []
+        self._uses: Dict[BrowserContext, int] = {}
+        self.created = 0
+        self.reused = 0
+
+    async def acquire(self) -> BrowserContext:
+        """Get a cleared context, a new one if none is idle."""
+        if self._idle:
+            self.reused += 1
+            return self._idle.pop()
+        context = await self._browser.new_context(**self._context_kwargs)
+        self._uses[context] = 0
+        self.created += 1
+        return context
+
+    async def release(self, context: BrowserContext) -> None:
+        """Clear a context and return it to the pool, or close it.
+
+        Args:
+            context (BrowserContext): A context returned by `acquire`.
+        """
+        self._uses[context] += 1
+        if self._uses[context] < self._max_uses and len(self._idle) < self._max_size:
+            try:
+                await self._clear(context)
+                self._idle.append(context)
+                return
+            except Exception:
+                logger.info("Failed to clear the browser context, closing it")
+        del self._uses[context]
+        await context.close()
+
+    @staticmethod
+    async def _clear(context: BrowserContext) -> None:
+        for page in context.pages:
+            await page.close()
+        await context.clear_cookies()
+        await context.clear_permissions()
+        await context.unroute_all()
+
+    async def close(self) -> None:
+        """Close the idle contexts."""
+        logger.info(
+            f"Browser context pool: {self.created} context(s) created, {self.reused} reused"
+        )
+        while self._idle:
+            context = self._idle.pop()
+            del self._uses[context]
+            await context.close()
+
+    @property
+    def size(self) -> int:
+        """The number of idle contexts."""
+        return len(self._idle)
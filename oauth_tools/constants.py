@@ -8,11 +8,19 @@ from pathlib import Path
 DEX_MANIFESTS = Path(__file__).parent / "dex.yaml"
 KUBECONFIG = os.environ.get("TESTING_KUBECONFIG", "~/.kube/config")
 
+# Model annotation storing the fingerprint of the deployed bundle
+BUNDLE_FINGERPRINT_ANNOTATION = "oauth-tools-bundle-fingerprint"
+
 DEX_CLIENT_ID = "client_id"
 DEX_CLIENT_SECRET = "client_secret"
+DEX_READY_TIMEOUT = 300
+# The default k8s namespace of dex, each model tested in parallel can have its own
+DEX_NAMESPACE = "dex"
 
 EXTERNAL_USER_EMAIL = "admin@example.com"
 EXTERNAL_USER_PASSWORD = "password"
+# bcrypt hash of the string "password": $(echo password | htpasswd -BinC 10 admin | cut -d: -f2)
+EXTERNAL_USER_PASSWORD_HASH = "$2a$10$2b2cU8CPhOTaGrs1HRQuAueS7JTT5ZHsHSzYiFPm1leZck7Mc8T4W"
 
 APPS = collections.namedtuple(
     "Apps",
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""The deterministic users and clients registered on the external IdPs."""
+
+import uuid
+from functools import lru_cache
+from typing import NamedTuple, Tuple
+
+from oauth_tools.constants import DEX_CLIENT_ID, DEX_CLIENT_SECRET, EXTERNAL_USER_EMAIL
+
+
+class IdpUser(NamedTuple):
+    """A user registered on the external IdP."""
+
+    email: str
+    username: str
+    password: str
+    user_id: str
+
+
+class IdpClient(NamedTuple):
+    """A client registered on the external IdP."""
+
+    client_id: str
+    client_secret: str
+
+
+@lru_cache(maxsize=None)
+def get_idp_users(count: int, password: str) -> Tuple[IdpUser, ...]:
+    """Generate deterministic users, the first one is the default test user.
+
+    Each user has a password of its own, derived from the password of the first one, so that
+    logging in as a user with the credentials of another one fails.
+
+    Args:
+        count (int): The number of users.
+        password (str): The password of the first user.
+    """
+    users = []
+    for i in range(count):
+        email, username = (
+            (EXTERNAL_USER_EMAIL, "admin") if i == 0 else (f"user{i}@example.com", f"user{i}")
+        )
+        user_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"mailto:{email}"))
+        users.append(IdpUser(email, username, password if i == 0 else f"{password}{i}", user_id))
+    return tuple(users)
+
+
+@lru_cache(maxsize=None)
+def get_idp_clients(count: int) -> Tuple[IdpClient, ...]:
+    """Generate deterministic clients, the first one is the default test client.
+
+    Args:
+        count (int): The number of clients.
+    """
+    clients = [IdpClient(DEX_CLIENT_ID, DEX_CLIENT_SECRET)]
+    clients += [
+        IdpClient(f"{DEX_CLIENT_ID}-{i}", f"{DEX_CLIENT_SECRET}-{i}") for i in range(1, count)
+    ]
+    return tuple(clients)
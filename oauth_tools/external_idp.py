@@ -3,32 +3,205 @@
 # See LICENSE file for licensing details.
 
 import abc
+import asyncio
+import copy
+import hashlib
+import json
 import logging
 import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from os.path import join
-from time import sleep
-from typing import List, Optional
+from time import monotonic
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-import requests
-from lightkube import Client, KubeConfig, codecs
+import bcrypt
+import httpx
+import jinja2
+import yaml
+from lightkube import AsyncClient, Client, KubeConfig, codecs
 from lightkube.core.exceptions import ApiError
 from lightkube.resources.apps_v1 import Deployment
-from lightkube.resources.core_v1 import Namespace, Pod, Service
+from lightkube.resources.core_v1 import ConfigMap, Namespace, Pod, Service
+from lightkube.types import CascadeType
 from playwright.async_api import expect
 from playwright.async_api._generated import Page
-from requests.exceptions import RequestException
 
 from oauth_tools.constants import (
     DEX_CLIENT_ID,
     DEX_CLIENT_SECRET,
     DEX_MANIFESTS,
+    DEX_NAMESPACE,
+    DEX_READY_TIMEOUT,
     EXTERNAL_USER_EMAIL,
     EXTERNAL_USER_PASSWORD,
+    EXTERNAL_USER_PASSWORD_HASH,
     KUBECONFIG,
 )
+from oauth_tools.credentials import IdpClient, IdpUser, get_idp_clients, get_idp_users
+from oauth_tools.instrumentation import get_async_http_client
+from oauth_tools.tracing import span, traced
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+CONFIG_CHECKSUM_ANNOTATION = "oauth-tools/config-checksum"
+
+
+@lru_cache(maxsize=None)
+def _hash_password(password: str) -> str:
+    """Get the bcrypt hash of a password, computed at most once per process."""
+    if password == EXTERNAL_USER_PASSWORD:
+        return EXTERNAL_USER_PASSWORD_HASH
+    # Dex rejects the hashes of a cost lower than 10
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=10)).decode()
+
+
+def _is_subset(desired: Any, live: Any) -> bool:
+    """Check that all the fields of the desired object are set in the live object.
+
+    The live object also contains defaults and status fields filled in by the API server,
+    these are ignored.
+    """
+    if isinstance(desired, dict):
+        return isinstance(live, dict) and all(
+            key in live and _is_subset(value, live[key]) for key, value in desired.items()
+        )
+    if isinstance(desired, list):
+        return (
+            isinstance(live, list)
+            and len(desired) == len(live)
+            and all(_is_subset(d, v) for d, v in zip(desired, live))
+        )
+    return desired == live
+
+
+def _get_config_checksum(objs: List[codecs.AnyResource]) -> str:
+    config = next(obj for obj in objs if obj.kind == "ConfigMap")
+    return hashlib.sha256(json.dumps(config.data, sort_keys=True).encode()).hexdigest()
+
+
+def _annotate_config_checksum(objs: List[codecs.AnyResource]) -> None:
+    """Roll the dex pods when the config changes.
+
+    Dex only reads its config on startup, the checksum of the config in the pod template
+    makes the Deployment roll out new pods when, and only when, the config changes.
+    """
+    checksum = _get_config_checksum(objs)
+    deployment = next(obj for obj in objs if obj.kind == "Deployment")
+    template_metadata = deployment.spec.template.metadata
+    template_metadata.annotations = {
+        **(template_metadata.annotations or {}),
+        CONFIG_CHECKSUM_ANNOTATION: checksum,
+    }
+
+
+@lru_cache(maxsize=1)
+def _get_dex_template() -> jinja2.Template:
+    """Compile the dex manifest template, once per process."""
+    template_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+    return template_env.from_string(DEX_MANIFESTS.read_text())
+
+
+@lru_cache(maxsize=8)
+def _render_dex_manifest(
+    clients: Tuple[IdpClient, ...],
+    users: Tuple[IdpUser, ...],
+    redirect_uri: Optional[str],
+    issuer_url: Optional[str],
+    namespace: str,
+    replicas: int,
+    resources: Optional[str],
+) -> Tuple[codecs.AnyResource, ...]:
+    """Render and parse the dex manifest, memoised by the template context."""
+    # bcrypt releases the GIL, the passwords of many users are hashed concurrently
+    with ThreadPoolExecutor() as executor:
+        password_hashes = list(executor.map(_hash_password, (user.password for user in users)))
+    rendered = _get_dex_template().render(
+        clients=clients,
+        users=[
+            dict(user._asdict(), password_hash=password_hash)
+            for user, password_hash in zip(users, password_hashes)
+        ],
+        redirect_uri=redirect_uri,
+        issuer_url=issuer_url,
+        namespace=namespace,
+        replicas=replicas,
+        # JSON is valid YAML, the resources are passed serialized to keep the cache key hashable
+        resources=resources,
+    )
+    objs = codecs.load_all_yaml(rendered)
+    _annotate_config_checksum(objs)
+    return tuple(objs)
+
+
+def _has_condition(obj: Any, condition: str) -> bool:
+    conditions = obj.status.conditions if obj.status else None
+    return any(c.type == condition and c.status == "True" for c in conditions or [])
+
+
+def _run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine to completion from synchronous code.
+
+    When called from a running event loop, e.g. in an async test, the coroutine is run on a
+    new event loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+async def _watch_until(
+    client: AsyncClient,
+    res: Any,
+    predicate: Callable[[Any], bool],
+    timeout: float,
+    on_deleted: Optional[Callable[[Any], None]] = None,
+    **kwargs: Any,
+) -> Any:
+    """Watch a resource until an object matches the predicate.
+
+    A deleted object never matches, the watch goes on, e.g. until it is created again.
+
+    Args:
+        client (AsyncClient): The lightkube client.
+        res (Any): The resource kind to watch.
+        predicate (Callable): Returns True when the watched object is in the desired state.
+        timeout (float): The number of seconds to wait for.
+        on_deleted (Callable): Called with each deleted object, e.g. to forget its state.
+        kwargs (Any): Extra arguments for `AsyncClient.watch`, e.g. the `resource_version`.
+    """
+
+    async def _watch() -> Any:
+        async for op, obj in client.watch(res, server_timeout=int(timeout) + 1, **kwargs):
+            if op == "DELETED":
+                if on_deleted:
+                    on_deleted(obj)
+            elif predicate(obj):
+                return obj
+
+    try:
+        return await asyncio.wait_for(_watch(), timeout=max(timeout, 0))
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Timed out waiting for {res.__name__}") from None
+
 
 class ExternalIdpService(abc.ABC):
     """Abstract class for managing lifecycle for an external IdP."""
@@ -77,144 +250,606 @@ class ExternalIdpService(abc.ABC):
         """Get a page on the IDP login page and login the user."""
         ...
 
+    def start_provisioning(self) -> None:
+        """Start deploying the idp service in the background.
+
+        Services that are deployed when they are created have nothing to do.
+        """
+
+    async def async_wait_until_provisioned(self) -> None:
+        """Wait until the deployment started by `start_provisioning` is done."""
+
+    async def async_create_idp_service(self) -> None:
+        """Deploy and configure the idp service, without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.create_idp_service)
+
+    async def async_remove_idp_service(self) -> None:
+        """Remove and clean up the idp service, without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.remove_idp_service)
+
+    async def async_update_redirect_uri(self, redirect_uri: str) -> None:
+        """Update the registered client's redirect_uri, without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.update_redirect_uri, redirect_uri
+        )
+
 
 class DexIdpService(ExternalIdpService):
-    """Class for managing lifecycle for an external Dex IdP."""
+    """Class for managing lifecycle for an external Dex IdP.
+
+    The Kubernetes API is accessed with a lightkube `AsyncClient` per event loop. The
+    `async_*` methods can be awaited from async tests without blocking the event loop, the
+    synchronous methods wrap them and run them on an event loop of their own.
+    """
 
     client_id = DEX_CLIENT_ID
     client_secret = DEX_CLIENT_SECRET
     user_email = EXTERNAL_USER_EMAIL
     user_password = EXTERNAL_USER_PASSWORD
-    _namespace = "dex"
 
-    def __init__(self, client: Optional[Client] = None):
-        if not client:
-            client = Client(config=KubeConfig.from_file(KUBECONFIG), field_manager="dex-test")
-        self._client = client
+    def __init__(
+        self,
+        client: Optional[Client] = None,
+        users: int = 1,
+        clients: int = 1,
+        replicas: int = 1,
+        resources: Optional[Dict] = None,
+        provision: bool = True,
+        namespace: str = DEX_NAMESPACE,
+        async_client: Optional[AsyncClient] = None,
+    ):
+        """Deploy dex, or update it when its spec changed.
+
+        Args:
+            client (Client): The lightkube client, e.g. the `client` fixture. Its config is
+                used to create an `AsyncClient` for each event loop the service is used from.
+                By default, the config is loaded from the KUBECONFIG.
+            users (int): The number of users to register, e.g. for concurrent logins. The
+                users are deterministic, the first one is the default test user. Each one has
+                a password of its own, see `iter_users`, whose bcrypt hash is computed once
+                per process. The users are stored in the dex ConfigMap, which limits them to
+                about 5000.
+            clients (int): The number of clients to register. The first one is the default
+                test client.
+            replicas (int): The number of dex replicas, scale dex out so that it does not
+                become the bottleneck of login load tests.
+            resources (Dict): The resource requirements of the dex container, e.g.
+                `{"requests": {"cpu": "500m", "memory": "256Mi"}}`.
+            provision (bool): Whether to deploy dex now, see `create` to do it from a
+                coroutine and `start_provisioning` to do it in the background.
+            namespace (str): The k8s namespace to deploy dex in. Models tested in parallel
+                need a dex each, since the registered client redirects to a single model.
+            async_client (AsyncClient): A lightkube async client to use instead of `client`.
+                It is bound to the event loop it is first used from, the service can then
+                only be used from that loop with the `async_*` methods, see `create`.
+        """
+        self._namespace = namespace
+        self._async_client = async_client
+        self._async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._config = None
+        if not async_client:
+            self._config = client.config if client else KubeConfig.from_file(KUBECONFIG)
+        # The lightkube clients created from the config, by event loop
+        self._kube_clients: Dict[asyncio.AbstractEventLoop, AsyncClient] = {}
+        self._kube_clients_lock = threading.Lock()
         self._redirect_uri = ""
-        if not self._dex_namespace_exists():
-            self._apply_dex_resources()
+        self._users = get_idp_users(users, self.user_password)
+        self._clients = get_idp_clients(clients)
+        self._replicas = replicas
+        self._resources = json.dumps(resources, sort_keys=True) if resources else None
+        self._issuer_url: Optional[str] = None
+        # The number of Kubernetes API calls avoided by caching the issuer_url
+        self.saved_api_calls = 0
+        self.readiness_timings: Dict[str, float] = {}
+        self._provisioning: Optional[Union[Future, "asyncio.Future[None]"]] = None
+        self._provisioned = False
+        if provision:
+            self._run_sync(self.async_ensure_idp_service())
+
+    @classmethod
+    async def create(cls, **kwargs: Any) -> "DexIdpService":
+        """Create the service and deploy dex, or update it when its spec changed.
+
+        Args:
+            kwargs (Any): The arguments of `DexIdpService`.
+        """
+        ext_idp_service = cls(**kwargs, provision=False)
+        await ext_idp_service.async_ensure_idp_service()
+        return ext_idp_service
+
+    def start_provisioning(self, deploy: bool = True) -> None:
+        """Start deploying dex in the background, unless it is already deployed.
+
+        Dex is deployed in a background thread, or in a task of the running event loop
+        with an `async_client`. The `async_*` methods that need dex wait for it, e.g. dex can
+        be provisioned while the identity bundle is being deployed. Await
+        `async_wait_until_provisioned` before reading the `issuer_url`.
+
+        Args:
+            deploy (bool): Whether to deploy dex, or to only wait for another process to
+                deploy it, see `async_ensure_idp_service`.
+        """
+        if self._provisioning or self._provisioned:
+            return
+
+        logger.info("Deploying dex in the background")
+        if self._async_client is not None:
+            # The async_client is bound to the event loop of the caller
+            loop = asyncio.get_running_loop()
+            self._provisioning = loop.create_task(self.async_ensure_idp_service(deploy))
+            return
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dex-provisioning")
+        self._provisioning = executor.submit(self._run_sync, self.async_ensure_idp_service(deploy))
+        executor.shutdown(wait=False)
+
+    def wait_until_provisioned(self) -> None:
+        """Wait until the deployment started by `start_provisioning` is done."""
+        if isinstance(self._provisioning, asyncio.Future):
+            raise RuntimeError(
+                "Dex is provisioned on an event loop, await async_wait_until_provisioned instead"
+            )
+        if self._provisioning:
+            self._provisioning.result()
+
+    async def async_wait_until_provisioned(self) -> None:
+        """Wait until the deployment started by `start_provisioning` is done."""
+        if isinstance(self._provisioning, asyncio.Future):
+            # Cancelling the waiter must not cancel the deployment
+            await asyncio.shield(self._provisioning)
+        elif self._provisioning:
+            await asyncio.wrap_future(self._provisioning)
+
+    def _run_sync(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Run a coroutine from synchronous code, on an event loop of its own.
+
+        The lightkube client created for that event loop is closed with it.
+        """
+        if self._async_client is not None:
+            coro.close()
+            raise RuntimeError(
+                "The async_client is bound to an event loop, await the async_* methods instead"
+            )
+
+        async def run() -> T:
+            try:
+                return await coro
+            finally:
+                await self.aclose()
+
+        return _run_sync(run())
+
+    def _get_client(self) -> AsyncClient:
+        # The connections of an AsyncClient are bound to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        with self._kube_clients_lock:
+            if self._async_client is not None:
+                if self._async_client_loop is None:
+                    self._async_client_loop = loop
+                elif self._async_client_loop is not loop:
+                    raise RuntimeError("The async_client is bound to another event loop")
+                return self._async_client
+
+            for closed_loop in [other for other in self._kube_clients if other.is_closed()]:
+                logger.debug("Dropping the lightkube client of a closed event loop")
+                del self._kube_clients[closed_loop]
+            if loop not in self._kube_clients:
+                self._kube_clients[loop] = AsyncClient(
+                    config=self._config, field_manager="dex-test"
+                )
+            return self._kube_clients[loop]
+
+    async def aclose(self) -> None:
+        """Close the lightkube client created for the running event loop, if any.
+
+        Await it before closing an event loop the `async_*` methods were awaited from, an
+        injected `async_client` is left to its owner.
+        """
+        with self._kube_clients_lock:
+            client = self._kube_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
 
     @property
     def issuer_url(self) -> str:
-        """The provider's issuer URL."""
-        service = self._client.get(Service, "dex", namespace=self.namespace)
-        return f"http://{service.status.loadBalancer.ingress[0].ip}:5556/"
+        """The provider's issuer URL.
+
+        It does not wait for dex, await `async_wait_until_provisioned` before reading it
+        while dex is provisioned in the background.
+        """
+        if self._issuer_url:
+            self.saved_api_calls += 1
+            return self._issuer_url
+        if self._provisioning and not self._provisioning.done():
+            raise RuntimeError(
+                "Dex is still being provisioned, await async_wait_until_provisioned first"
+            )
+        return self.refresh_issuer_url()
+
+    def refresh_issuer_url(self) -> str:
+        """Fetch the provider's issuer URL from the dex Service, bypassing the cache."""
+        return self._run_sync(self.async_refresh_issuer_url())
+
+    async def async_refresh_issuer_url(self) -> str:
+        """Fetch the provider's issuer URL from the dex Service, bypassing the cache."""
+        self._issuer_url = None
+        service = await self._get_client().get(Service, "dex", namespace=self.namespace)
+        self._issuer_url = self._get_service_issuer_url(service)
+        if not self._issuer_url:
+            raise RuntimeError("The dex service has no LoadBalancer IP")
+        return self._issuer_url
+
+    @staticmethod
+    def _get_service_issuer_url(service: Service) -> Optional[str]:
+        ingress = service.status.loadBalancer.ingress if service.status else None
+        if not ingress:
+            return None
+        return f"http://{ingress[0].ip}:5556/"
+
+    def iter_users(self) -> Iterator[IdpUser]:
+        """Iterate over the credentials of the users registered on dex."""
+        return iter(self._users)
+
+    def iter_clients(self) -> Iterator[IdpClient]:
+        """Iterate over the credentials of the clients registered on dex."""
+        return iter(self._clients)
 
     @property
     def namespace(self) -> str:
         """The k8s namespace in which dex is deployed."""
         return self._namespace
 
-    def _dex_namespace_exists(self) -> bool:
+    async def _dex_namespace_exists(self) -> bool:
         try:
-            self._client.get(Namespace, self.namespace)
-            return True
+            namespace = await self._get_client().get(Namespace, self.namespace)
         except ApiError:
             return False
+        if namespace.status and namespace.status.phase == "Terminating":
+            logger.info("Waiting for the previous dex namespace to be deleted")
+            await self._wait_for_namespace_deletion(monotonic() + DEX_READY_TIMEOUT)
+            return False
+        return True
 
-    def _get_dex_manifest(self) -> List[codecs.AnyResource]:
-        temp_issuer_url = None
-        try:
-            temp_issuer_url = self.issuer_url
-        except ApiError:
-            logger.info("No service found for identity provider")
+    async def _get_dex_manifest(self) -> List[codecs.AnyResource]:
+        temp_issuer_url = self._issuer_url
+        if temp_issuer_url:
+            self.saved_api_calls += 1
+        else:
+            try:
+                temp_issuer_url = await self.async_refresh_issuer_url()
+            except (ApiError, RuntimeError):
+                logger.info("No service found for identity provider")
 
         temp_redirect_url = self._redirect_uri
         if not temp_redirect_url:
             temp_redirect_url = None
 
-        with open(DEX_MANIFESTS, "r") as file:
-            return codecs.load_all_yaml(
-                file,
-                context={
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
-                    "redirect_uri": temp_redirect_url,
-                    "issuer_url": temp_issuer_url,
-                    "namespace": self.namespace,
-                },
+        objs = _render_dex_manifest(
+            self._clients,
+            self._users,
+            temp_redirect_url,
+            temp_issuer_url,
+            self.namespace,
+            self._replicas,
+            self._resources,
+        )
+        # The rendered objects are shared by the services with the same spec, copy them so
+        # that the callers can modify their own
+        return [copy.deepcopy(obj) for obj in objs]
+
+    async def _is_applied(self, obj: codecs.AnyResource) -> bool:
+        try:
+            live = await self._get_client().get(
+                type(obj), obj.metadata.name, namespace=obj.metadata.namespace
             )
+        except ApiError:
+            return False
+        return _is_subset(obj.to_dict(), live.to_dict())
 
-    def _restart_dex(self) -> List[str]:
-        deleted = []
-        for pod in self._client.list(Pod, namespace=self.namespace, labels={"app": "dex"}):
-            deleted.append(pod.metadata.name)
-            self._client.delete(Pod, pod.metadata.name, namespace=self.namespace)
-        return deleted
+    @traced("apply_dex_resources")
+    async def _apply_dex_resources(self) -> bool:
+        """Apply the dex resources that changed and wait for dex to be ready.
 
-    def _apply_dex_resources(self) -> None:
-        objs = self._get_dex_manifest()
+        Returns False, without waiting, when all the resources are up to date.
+        """
+        objs = await self._get_dex_manifest()
 
-        for obj in objs:
-            self._client.apply(obj, force=True)
+        with span("diff_dex_resources"):
+            applied = await asyncio.gather(*(self._is_applied(obj) for obj in objs))
+        changed = [obj for obj, is_applied in zip(objs, applied) if not is_applied]
+        if not changed:
+            logger.info("Dex resources are up to date")
+            return False
 
-        logger.info("Restarting dex")
-        deleted_pod_names = self._restart_dex()
+        # The Deployment goes last, so that the pods it rolls out pick up the new config
+        for obj in sorted(changed, key=lambda obj: obj.kind == "Deployment"):
+            logger.info(f"Applying {obj.kind} {obj.metadata.name}")
+            with span("apply", kind=obj.kind, resource=obj.metadata.name):
+                await self._get_client().apply(obj, force=True)
+            if obj.kind == "Service":
+                # The LoadBalancer IP may change when the Service is re-created
+                self._issuer_url = None
 
         logger.info("Waiting for dex to be ready")
-        self._wait_until_is_ready(ignore=deleted_pod_names)
-
-    def __wait_until_is_ready(self, ignore: Optional[List[str]] = None) -> None:
-        ignore = ignore or []
-        ready = False
-        while not ready:
-            for pod in self._client.list(Pod, namespace=self.namespace, labels={"app": "dex"}):
-                # Some pods may be deleted, if we are restarting
-                if pod.metadata.name in ignore:
-                    continue
-                self._client.wait(
-                    Pod,
-                    pod.metadata.name,
-                    for_conditions=["Ready"],
-                    namespace=self.namespace,
-                )
-                ready = True
-                break
-        self._client.wait(
-            Deployment, "dex", namespace=self.namespace, for_conditions=["Available"]
+        await self._wait_until_is_ready(checksum=_get_config_checksum(objs))
+        return True
+
+    async def _wait_for_pods(self, deadline: float, checksum: Optional[str]) -> None:
+        ready: Set[str] = set()
+
+        def all_ready(pod: Pod) -> bool:
+            # During a rollout, the pods running the previous config may still be ready
+            annotations = pod.metadata.annotations or {}
+            if (
+                (checksum is None or annotations.get(CONFIG_CHECKSUM_ANNOTATION) == checksum)
+                and not pod.metadata.deletionTimestamp
+                and _has_condition(pod, "Ready")
+            ):
+                ready.add(pod.metadata.name)
+            else:
+                ready.discard(pod.metadata.name)
+            return len(ready) >= self._replicas
+
+        pods = self._get_client().list(Pod, namespace=self.namespace, labels={"app": "dex"})
+        async for pod in pods:
+            all_ready(pod)
+        if len(ready) >= self._replicas:
+            return
+        await _watch_until(
+            self._get_client(),
+            Pod,
+            all_ready,
+            deadline - monotonic(),
+            # A pod deleted before it was seen terminating no longer counts as ready
+            on_deleted=lambda pod: ready.discard(pod.metadata.name),
+            namespace=self.namespace,
+            labels={"app": "dex"},
+            resource_version=pods.resourceVersion,
         )
 
-        issuer_url = self.issuer_url
-        resp = requests.get(join(issuer_url, ".well-known/openid-configuration"))
-        if resp.status_code != 200:
-            raise RuntimeError("Failed to deploy dex")
+    async def _wait_for_deployment(self, deadline: float) -> None:
+        def is_rolled_out(deployment: Deployment) -> bool:
+            # Same as `kubectl rollout status`, the pods of previous rollouts must be gone too
+            status = deployment.status
+            replicas = deployment.spec.replicas
+            return (
+                status is not None
+                and (status.observedGeneration or 0) >= (deployment.metadata.generation or 0)
+                and status.updatedReplicas == replicas
+                and status.availableReplicas == replicas
+                and status.replicas == replicas
+            )
+
+        try:
+            deployment = await self._get_client().get(Deployment, "dex", namespace=self.namespace)
+        except ApiError as e:
+            if e.status.code != 404:
+                raise
+            # Not created yet, e.g. by the process deploying dex
+            resource_version = None
+        else:
+            if is_rolled_out(deployment):
+                return
+            resource_version = deployment.metadata.resourceVersion
+        await _watch_until(
+            self._get_client(),
+            Deployment,
+            is_rolled_out,
+            deadline - monotonic(),
+            namespace=self.namespace,
+            fields={"metadata.name": "dex"},
+            resource_version=resource_version,
+        )
+
+    async def _wait_for_service(self, deadline: float) -> None:
+        def has_ip(service: Service) -> bool:
+            self._issuer_url = self._get_service_issuer_url(service)
+            return self._issuer_url is not None
 
-    def _wait_until_is_ready(self, ignore: Optional[List[str]] = None) -> None:
-        """Wait until the dex service is ready."""
         try:
-            self.__wait_until_is_ready(ignore=ignore)
-        except (RuntimeError, RequestException):
-            sleep(3)
-            self.__wait_until_is_ready(ignore=ignore)
+            service = await self._get_client().get(Service, "dex", namespace=self.namespace)
+        except ApiError as e:
+            if e.status.code != 404:
+                raise
+            resource_version = None
+        else:
+            if has_ip(service):
+                return
+            resource_version = service.metadata.resourceVersion
+        await _watch_until(
+            self._get_client(),
+            Service,
+            has_ip,
+            deadline - monotonic(),
+            namespace=self.namespace,
+            fields={"metadata.name": "dex"},
+            resource_version=resource_version,
+        )
 
-    def create_idp_service(self):
+    async def _wait_for_issuer(self, deadline: float) -> None:
+        backoff = 0.1
+        async with get_async_http_client() as http_client:
+            while True:
+                try:
+                    resp = await http_client.get(
+                        join(self._issuer_url, ".well-known/openid-configuration"),
+                        timeout=max(deadline - monotonic(), 1),
+                    )
+                    if resp.status_code == 200:
+                        return
+                except httpx.HTTPError:
+                    pass
+                if monotonic() + backoff > deadline:
+                    raise RuntimeError("Failed to deploy dex")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 5)
+
+    @traced("dex_wait_until_ready")
+    async def _wait_until_is_ready(
+        self, checksum: Optional[str] = None, timeout: float = DEX_READY_TIMEOUT
+    ) -> Dict[str, float]:
+        """Wait until the dex service is ready.
+
+        Returns the number of seconds spent on each phase of the wait.
+        """
+        deadline = monotonic() + timeout
+        phases = [
+            ("pods", lambda: self._wait_for_pods(deadline, checksum)),
+            ("deployment", lambda: self._wait_for_deployment(deadline)),
+            ("service", lambda: self._wait_for_service(deadline)),
+            ("issuer", lambda: self._wait_for_issuer(deadline)),
+        ]
+
+        timings = {}
+        for phase, wait in phases:
+            start = monotonic()
+            with span(f"dex_{phase}"):
+                await wait()
+            timings[phase] = monotonic() - start
+        logger.info(
+            "Dex is ready, "
+            + ", ".join(f"{phase}: {duration:.2f}s" for phase, duration in timings.items())
+        )
+        self.readiness_timings = timings
+        return timings
+
+    async def async_ensure_idp_service(self, deploy: bool = True) -> None:
+        """Deploy dex, or update it when its spec changed, and wait for it to be ready.
+
+        An existing dex is only updated when its users, clients, replicas or resources differ
+        from the ones of this service.
+
+        Args:
+            deploy (bool): Whether to deploy dex, or to only wait until it is deployed by
+                another process, e.g. the pytest-xdist worker that deploys the shared dex.
+        """
+        if not deploy:
+            logger.info("Waiting for dex to be deployed")
+            await self._wait_until_is_ready()
+            if not self._redirect_uri:
+                self._redirect_uri = await self._get_live_redirect_uri() or ""
+        else:
+            if await self._dex_namespace_exists() and not self._redirect_uri:
+                # Keep the redirect URI registered by a previous run, e.g. on a reused model
+                self._redirect_uri = await self._get_live_redirect_uri() or ""
+            if not await self._apply_dex_resources():
+                # Another process may still be deploying it
+                await self._wait_until_is_ready()
+        self._provisioned = True
+
+    async def _get_live_redirect_uri(self) -> Optional[str]:
+        try:
+            config_map = await self._get_client().get(ConfigMap, "dex", namespace=self.namespace)
+        except ApiError:
+            return None
+        config = yaml.safe_load((config_map.data or {}).get("config.yaml", "")) or {}
+        clients = config.get("staticClients") or [{}]
+        redirect_uris = clients[0].get("redirectURIs") or [None]
+        return redirect_uris[0]
+
+    def create_idp_service(self) -> None:
+        """Deploy and configure the dex service."""
+        self._run_sync(self.async_create_idp_service())
+
+    async def async_create_idp_service(self) -> None:
         """Deploy and configure the dex service."""
-        self._apply_dex_resources()
+        await self.async_wait_until_provisioned()
+        await self._apply_dex_resources()
 
     def update_redirect_uri(self, redirect_uri: str) -> None:
+        """Update the registered client's redirect_uri."""
+        self._run_sync(self.async_update_redirect_uri(redirect_uri))
+
+    async def async_update_redirect_uri(self, redirect_uri: str) -> None:
         """Update the registered client's redirect_uri."""
         if not redirect_uri:
             logger.info("Empty parameter for redirect_uri")
             return
+        await self.async_wait_until_provisioned()
         self._redirect_uri = redirect_uri
-        self._apply_dex_resources()
+        await self._apply_dex_resources()
+
+    def remove_idp_service(self, wait: bool = True, timeout: float = DEX_READY_TIMEOUT) -> None:
+        """Remove and clean up the dex manifests, see `async_remove_idp_service`."""
+        self._run_sync(self.async_remove_idp_service(wait=wait, timeout=timeout))
+
+    @traced("remove_dex_resources")
+    async def async_remove_idp_service(
+        self, wait: bool = True, timeout: float = DEX_READY_TIMEOUT
+    ) -> None:
+        """Remove and clean up the dex manifests.
+
+        The dex namespace is deleted with foreground propagation, which deletes all the
+        namespaced resources with it, only the cluster scoped resources are deleted one by one.
+
+        Args:
+            wait (bool): Whether to wait until the namespace is gone, so that dex can be
+                deployed again right away.
+            timeout (float): The number of seconds to wait for.
+        """
+        try:
+            await self.async_wait_until_provisioned()
+        except Exception:
+            # Whatever was deployed is removed below
+            logger.exception("Failed to provision dex, removing what was deployed")
 
-    def remove_idp_service(self) -> None:
-        """Remove and clean up the dex manifests."""
         logger.info("Deleting dex resources")
-        for obj in self._get_dex_manifest():
+        start = monotonic()
+
+        async def delete(obj: codecs.AnyResource) -> None:
+            cascade = CascadeType.FOREGROUND if obj.kind == "Namespace" else None
             try:
-                self._client.delete(type(obj), obj.metadata.name, namespace=obj.metadata.namespace)
+                await self._get_client().delete(type(obj), obj.metadata.name, cascade=cascade)
             except ApiError:
                 pass
 
-    async def complete_user_login(self, page: Page) -> None:
-        """Get a page on the IDP login page and login the user."""
+        objs = await self._get_dex_manifest()
+        await asyncio.gather(*(delete(obj) for obj in objs if not obj.metadata.namespace))
+        self._issuer_url = None
+        self._provisioning = None
+        self._provisioned = False
+
+        if wait:
+            await self._wait_for_namespace_deletion(start + timeout)
+            logger.info(f"Deleted dex resources in {monotonic() - start:.2f}s")
+        await self.aclose()
+
+    async def _wait_for_namespace_deletion(self, deadline: float) -> None:
+        client = self._get_client()
+        try:
+            namespace = await client.get(Namespace, self.namespace)
+        except ApiError as e:
+            if e.status.code == 404:
+                return
+            raise
+
+        async def _watch() -> None:
+            async for op, _ in client.watch(
+                Namespace,
+                fields={"metadata.name": self.namespace},
+                server_timeout=int(deadline - monotonic()) + 1,
+                resource_version=namespace.metadata.resourceVersion,
+            ):
+                if op == "DELETED":
+                    return
+
+        try:
+            await asyncio.wait_for(_watch(), timeout=max(deadline - monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for namespace {self.namespace}") from None
+
+    async def complete_user_login(self, page: Page, user: Optional[IdpUser] = None) -> None:
+        """Get a page on the IDP login page and login the user.
+
+        Args:
+            page (Page): The page fixture.
+            user (IdpUser): The user to login as, defaults to the test user.
+        """
+        user = user or self._users[0]
+        await self.async_wait_until_provisioned()
         logger.info("Signing in to dex")
         await expect(page).to_have_url(re.compile(rf"{self.issuer_url}*"))
         await page.get_by_placeholder("email address").click()
-        await page.get_by_placeholder("email address").fill(self.user_email)
+        await page.get_by_placeholder("email address").fill(user.email)
         await page.get_by_placeholder("password").click()
-        await page.get_by_placeholder("password").fill(self.user_password)
+        await page.get_by_placeholder("password").fill(user.password)
         await page.get_by_role("button", name="Login").click()
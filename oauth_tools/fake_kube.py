@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""An offline stand-in for the Kubernetes API, to test a `DexIdpService` without a cluster.
+
+It stores the applied objects and replays their changes to the watches:
+
+    client = FakeAsyncClient()
+    ext_idp_service = DexIdpService(async_client=client, provision=False)
+    await ext_idp_service._apply_dex_resources()
+    assert [obj.kind for obj in client.applied] == ["Namespace", ...]
+"""
+
+import asyncio
+import copy
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from lightkube import codecs
+from lightkube.core.exceptions import ApiError
+from lightkube.models.core_v1 import NamespaceStatus
+from lightkube.models.meta_v1 import Status
+from lightkube.resources.core_v1 import Namespace
+from lightkube.types import CascadeType
+
+# The kind, namespace and name of an object
+Key = Tuple[str, Optional[str], str]
+
+
+def _get_key(obj: codecs.AnyResource) -> Key:
+    return type(obj).__name__, obj.metadata.namespace, obj.metadata.name
+
+
+class _FakeList:
+    """The objects listed by `FakeAsyncClient.list`, with the version to watch them from."""
+
+    def __init__(self, objs: List[codecs.AnyResource], resource_version: str):
+        self._objs = objs
+        self.resourceVersion = resource_version
+
+    async def __aiter__(self) -> AsyncIterator[codecs.AnyResource]:
+        for obj in self._objs:
+            yield obj
+
+
+class FakeAsyncClient:
+    """A stand-in for the lightkube `AsyncClient` of a `DexIdpService`.
+
+    Every change to an object, with `apply`, `modify`, `delete` or `remove`, bumps the
+    resource version and is recorded as a watch event. A watch replays the events that
+    follow its `resource_version`, then waits for new ones. No controller runs: the tests
+    create the pods and update the status of the objects themselves.
+    """
+
+    def __init__(self, namespace_deletion_delay: float = 0.0):
+        """Create a client without objects.
+
+        Args:
+            namespace_deletion_delay (float): The number of seconds a namespace stays in the
+                Terminating phase once deleted, before it is gone with all its objects.
+        """
+        self.namespace_deletion_delay = namespace_deletion_delay
+        self.objects: Dict[Key, codecs.AnyResource] = {}
+        self.events: List[Tuple[int, str, codecs.AnyResource]] = []
+        self.applied: List[codecs.AnyResource] = []
+        self.deleted: List[Tuple[str, str, Optional[CascadeType]]] = []
+        self.watches: List[Dict[str, Any]] = []
+        self._resource_version = 0
+        self._changed = asyncio.Condition()
+
+    def _record(self, op: str, obj: codecs.AnyResource) -> None:
+        self._resource_version += 1
+        obj.metadata.resourceVersion = str(self._resource_version)
+        self.events.append((self._resource_version, op, copy.deepcopy(obj)))
+
+        async def notify() -> None:
+            async with self._changed:
+                self._changed.notify_all()
+
+        asyncio.get_running_loop().create_task(notify())
+
+    def modify(self, obj: codecs.AnyResource) -> None:
+        """Store an object, e.g. with an updated status, and emit its ADDED or MODIFIED event.
+
+        Args:
+            obj (codecs.AnyResource): The object.
+        """
+        key = _get_key(obj)
+        op = "MODIFIED" if key in self.objects else "ADDED"
+        self.objects[key] = copy.deepcopy(obj)
+        self._record(op, self.objects[key])
+
+    def remove(self, res: Any, name: str, namespace: Optional[str] = None) -> None:
+        """Remove an object right away and emit its DELETED event.
+
+        Args:
+            res (Any): The resource kind, e.g. `Pod`.
+            name (str): The name of the object.
+            namespace (str): The namespace of the object.
+        """
+        obj = self.objects.pop((res.__name__, namespace, name))
+        self._record("DELETED", obj)
+
+    async def get(self, res: Any, name: str, namespace: Optional[str] = None) -> Any:
+        """Get an object, like `AsyncClient.get`."""
+        try:
+            return copy.deepcopy(self.objects[(res.__name__, namespace, name)])
+        except KeyError:
+            raise ApiError(status=Status(code=404, message=f"{name} not found")) from None
+
+    def list(
+        self,
+        res: Any,
+        namespace: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+        **kwargs: Any,
+    ) -> _FakeList:
+        """List objects, like `AsyncClient.list`."""
+        objs = [
+            copy.deepcopy(obj)
+            for obj in self.objects.values()
+            if self._matches(obj, res, namespace, labels, None)
+        ]
+        return _FakeList(objs, str(self._resource_version))
+
+    async def watch(
+        self,
+        res: Any,
+        namespace: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+        fields: Optional[Dict[str, str]] = None,
+        server_timeout: Optional[int] = None,
+        resource_version: Optional[str] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Watch objects, like `AsyncClient.watch`.
+
+        Without a `resource_version`, the watch starts with an ADDED event for each object.
+        """
+        self.watches.append({
+            "res": res,
+            "namespace": namespace,
+            "labels": labels,
+            "fields": fields,
+            "resource_version": resource_version,
+        })
+        if resource_version is None:
+            start = self._resource_version
+            for obj in list(self.objects.values()):
+                if self._matches(obj, res, namespace, labels, fields):
+                    yield "ADDED", copy.deepcopy(obj)
+        else:
+            start = int(resource_version)
+
+        while True:
+            for version, op, obj in [event for event in self.events if event[0] > start]:
+                start = version
+                if self._matches(obj, res, namespace, labels, fields):
+                    yield op, copy.deepcopy(obj)
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._resource_version > start)
+
+    async def apply(self, obj: codecs.AnyResource, **kwargs: Any) -> codecs.AnyResource:
+        """Apply an object, like `AsyncClient.apply`."""
+        self.applied.append(obj)
+        self.modify(obj)
+        return copy.deepcopy(self.objects[_get_key(obj)])
+
+    async def delete(
+        self,
+        res: Any,
+        name: str,
+        namespace: Optional[str] = None,
+        cascade: Optional[CascadeType] = None,
+        **kwargs: Any,
+    ) -> None:
+        """Delete an object, like `AsyncClient.delete`.
+
+        A namespace is Terminating for `namespace_deletion_delay` seconds, then it is removed
+        with all its objects.
+        """
+        key = (res.__name__, namespace, name)
+        if key not in self.objects:
+            raise ApiError(status=Status(code=404, message=f"{name} not found"))
+        self.deleted.append((res.__name__, name, cascade))
+        if res is not Namespace:
+            self.remove(res, name, namespace)
+            return
+
+        terminating = copy.deepcopy(self.objects[key])
+        terminating.status = NamespaceStatus(phase="Terminating")
+        self.modify(terminating)
+
+        def remove_namespace() -> None:
+            for other in [key for key in self.objects if key[1] == name]:
+                self.remove(type(self.objects[other]), other[2], name)
+            self.remove(Namespace, name)
+
+        asyncio.get_running_loop().call_later(self.namespace_deletion_delay, remove_namespace)
+
+    @staticmethod
+    def _matches(
+        obj: codecs.AnyResource,
+        res: Any,
+        namespace: Optional[str],
+        labels: Optional[Dict[str, str]],
+        fields: Optional[Dict[str, str]],
+    ) -> bool:
+        obj_labels = obj.metadata.labels or {}
+        return (
+            type(obj) is res
+            and (namespace is None or obj.metadata.namespace == namespace)
+            and all(obj_labels.get(label) == value for label, value in (labels or {}).items())
+            and all(
+                field == "metadata.name" and obj.metadata.name == value
+                for field, value in (fields or {}).items()
+            )
+        )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""An offline stand-in for the Kubernetes metrics API, to test a `PodResourceSampler`.
+
+It lists pods and their metrics, whose usage and restarts are changed between samples:
+
+    client = FakeMetricsClient()
+    client.add_pod("hydra-0", app="hydra", cpu="250m", memory="64Mi")
+    sampler = PodResourceSampler(client, "test-model")
+    sampler.sample()
+"""
+
+import uuid
+from typing import Any, Dict, List, Optional
+
+from lightkube.core.exceptions import ApiError
+from lightkube.models.core_v1 import ContainerStatus, PodStatus
+from lightkube.models.meta_v1 import ObjectMeta, Status
+from lightkube.resources.core_v1 import Pod
+
+from oauth_tools.pod_resources import APP_LABEL, PodMetrics
+
+
+class FakeMetricsClient:
+    """A stand-in for the lightkube `Client` of a `PodResourceSampler`.
+
+    It lists the pods added with `add_pod` and their metrics, the usage and restarts can be
+    changed between two samples.
+    """
+
+    def __init__(self, metrics_available: bool = True):
+        """Create a client without pods.
+
+        Args:
+            metrics_available (bool): Whether the metrics API is served, i.e. metrics-server is
+                deployed.
+        """
+        self.metrics_available = metrics_available
+        self.pods: Dict[str, Dict[str, Any]] = {}
+
+    def add_pod(
+        self, name: str, app: Optional[str] = None, cpu: str = "0", memory: str = "0"
+    ) -> None:
+        """Add a pod.
+
+        Args:
+            name (str): The name of the pod, e.g. "hydra-0".
+            app (str): The application of the pod, it is labelled with it.
+            cpu (str): The CPU usage, e.g. "250m".
+            memory (str): The memory usage, e.g. "64Mi".
+        """
+        self.pods[name] = {
+            "app": app,
+            "cpu": cpu,
+            "memory": memory,
+            "restarts": 0,
+            "uid": str(uuid.uuid4()),
+        }
+
+    def set_usage(self, name: str, cpu: str, memory: str) -> None:
+        """Set the usage of a pod.
+
+        Args:
+            name (str): The name of the pod.
+            cpu (str): The CPU usage, e.g. "250m".
+            memory (str): The memory usage, e.g. "64Mi".
+        """
+        self.pods[name].update(cpu=cpu, memory=memory)
+
+    def restart(self, name: str) -> None:
+        """Restart the container of a pod.
+
+        Args:
+            name (str): The name of the pod.
+        """
+        self.pods[name]["restarts"] += 1
+
+    def recreate(self, name: str) -> None:
+        """Delete a pod and create it again, e.g. like its statefulset, with no restarts.
+
+        Args:
+            name (str): The name of the pod.
+        """
+        self.pods[name].update(restarts=0, uid=str(uuid.uuid4()))
+
+    def remove_pod(self, name: str) -> None:
+        """Remove a pod.
+
+        Args:
+            name (str): The name of the pod.
+        """
+        del self.pods[name]
+
+    def list(self, res: Any, namespace: Optional[str] = None, **kwargs: Any) -> List[Any]:
+        """List the pods or their metrics, like `Client.list`."""
+        if res is PodMetrics:
+            if not self.metrics_available:
+                raise ApiError(
+                    status=Status(code=404, message="the server could not find the resource")
+                )
+            return [
+                PodMetrics.from_dict({
+                    "apiVersion": "metrics.k8s.io/v1beta1",
+                    "kind": "PodMetrics",
+                    "metadata": self._get_metadata(name, namespace),
+                    "containers": [
+                        {"name": "charm", "usage": {"cpu": pod["cpu"], "memory": pod["memory"]}}
+                    ],
+                })
+                for name, pod in self.pods.items()
+            ]
+        if res is Pod:
+            return [
+                Pod(
+                    metadata=ObjectMeta.from_dict(self._get_metadata(name, namespace)),
+                    status=PodStatus(
+                        containerStatuses=[
+                            ContainerStatus(
+                                image="image",
+                                imageID="image",
+                                name="charm",
+                                ready=True,
+                                restartCount=pod["restarts"],
+                            )
+                        ]
+                    ),
+                )
+                for name, pod in self.pods.items()
+            ]
+        raise ValueError(f"Unsupported resource: {res}")
+
+    def _get_metadata(self, name: str, namespace: Optional[str]) -> Dict[str, Any]:
+        app = self.pods[name]["app"]
+        return {
+            "name": name,
+            "namespace": namespace,
+            "uid": self.pods[name]["uid"],
+            "labels": {APP_LABEL: app} if app else {},
+        }
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Offline stand-ins for `OpsTest` and its juju model.
+
+It simulates the juju operations used by the helpers, with configurable latencies, so that
+the orchestration of `deploy_identity_bundle`, `clean_up_identity_bundle` and friends can be
+tested and benchmarked without a juju controller:
+
+    ops_test = FakeOpsTest(latencies={"wait_for_idle": 0.5})
+    await deploy_identity_bundle(ops_test, ext_idp_service=LocalIdpService())
+    assert ops_test.calls[0][0] == "run"
+"""
+
+import asyncio
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import yaml
+
+from oauth_tools.constants import APPS
+
+# The simulated duration of each operation, in seconds
+DEFAULT_LATENCIES = {
+    "run": 0.0,
+    "get_status": 0.0,
+    "get_config": 0.0,
+    "set_config": 0.0,
+    "run_action": 0.0,
+    "wait_for_idle": 0.0,
+    "remove_application": 0.0,
+    "scale": 0.0,
+    "annotations": 0.0,
+}
+
+ActionHandler = Callable[["FakeUnit", Dict[str, Any]], Dict[str, Any]]
+
+
+def _get_redirect_uri(unit: "FakeUnit", params: Dict[str, Any]) -> Dict[str, Any]:
+    model = unit.application.model
+    config = unit.application.config
+    address = model.get_address(APPS.TRAEFIK_PUBLIC)
+    provider_id = config.get("provider_id", "generic")
+    return {
+        "redirect-uri": f"https://{address}/{model.name}-{APPS.KRATOS}"
+        f"/self-service/methods/oidc/callback/{provider_id}"
+    }
+
+
+def _create_oauth_client(unit: "FakeUnit", params: Dict[str, Any]) -> Dict[str, Any]:
+    return {"client-id": str(uuid.uuid4()), "client-secret": uuid.uuid4().hex}
+
+
+DEFAULT_ACTIONS: Dict[str, ActionHandler] = {
+    "get-redirect-uri": _get_redirect_uri,
+    "create-oauth-client": _create_oauth_client,
+}
+
+
+class FakeActionOutput:
+    """The outcome of an action, as returned by `Action.wait`."""
+
+    def __init__(self, results: Dict[str, Any]):
+        self.results = results
+        self.status = "completed"
+
+
+class FakeAction:
+    """An action that already ran."""
+
+    def __init__(self, results: Dict[str, Any]):
+        self._output = FakeActionOutput(results)
+
+    async def wait(self) -> FakeActionOutput:
+        """Get the action's outcome."""
+        return self._output
+
+
+class FakeUnit:
+    """A unit of an application, it runs the actions."""
+
+    def __init__(self, application: "FakeApplication", number: int):
+        self.application = application
+        self.name = f"{application.name}/{number}"
+
+    async def run_action(self, action_name: str, **params: Any) -> FakeAction:
+        """Run an action with the handler registered for it.
+
+        Args:
+            action_name (str): The name of the action.
+            params (Any): The action's parameters.
+        """
+        model = self.application.model
+        await model.simulate("run_action", self.name, action_name)
+        if action_name not in model.actions:
+            raise ValueError(f"No handler for action {action_name}")
+        return FakeAction(model.actions[action_name](self, params))
+
+
+class FakeApplication:
+    """An application of the model."""
+
+    def __init__(
+        self, model: "FakeModel", name: str, scale: int = 1, config: Optional[Dict] = None
+    ):
+        self.model = model
+        self.name = name
+        self.config: Dict[str, Any] = dict(config or {})
+        self.units: List[FakeUnit] = []
+        self._set_scale(scale)
+
+    def _set_scale(self, scale: int) -> None:
+        self.units = [FakeUnit(self, i) for i in range(scale)]
+
+    async def get_config(self) -> Dict[str, Dict[str, Any]]:
+        """Get the application's config, in the format of juju."""
+        await self.model.simulate("get_config", self.name)
+        return {key: {"value": value} for key, value in self.config.items()}
+
+    async def set_config(self, config: Dict[str, Any]) -> None:
+        """Update the application's config.
+
+        Args:
+            config (Dict[str, Any]): The options to set.
+        """
+        await self.model.simulate("set_config", self.name)
+        self.config.update(config)
+
+    async def scale(self, scale: int) -> None:
+        """Set the number of units of the application.
+
+        Args:
+            scale (int): The number of units.
+        """
+        await self.model.simulate("scale", self.name, scale)
+        self._set_scale(scale)
+
+
+class FakeModel:
+    """A juju model, with the operations used by the oauth_tools helpers."""
+
+    def __init__(
+        self,
+        name: str = "test-model",
+        latencies: Optional[Dict[str, float]] = None,
+        actions: Optional[Dict[str, ActionHandler]] = None,
+    ):
+        """Create an empty model.
+
+        Args:
+            name (str): The name of the model.
+            latencies (Dict[str, float]): The simulated duration of the operations, see
+                `DEFAULT_LATENCIES`.
+            actions (Dict[str, ActionHandler]): Extra action handlers, they are called with
+                the unit and the action's parameters and return the action's results.
+        """
+        self.name = name
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        self.actions = dict(DEFAULT_ACTIONS, **(actions or {}))
+        self.applications: Dict[str, FakeApplication] = {}
+        self.config: Dict[str, Any] = {}
+        self.annotations: Dict[str, str] = {}
+        self.calls: List[Tuple[Any, ...]] = []
+        self.simulated_time = 0.0
+
+    async def simulate(self, operation: str, *args: Any) -> None:
+        """Record an operation and wait for its simulated duration.
+
+        Args:
+            operation (str): The operation, a key of `latencies`.
+            args (Any): The details of the operation, recorded in `calls`.
+        """
+        self.calls.append((operation, *args))
+        latency = self.latencies.get(operation, 0.0)
+        self.simulated_time += latency
+        if latency:
+            await asyncio.sleep(latency)
+
+    def add_application(self, name: str, scale: int = 1, config: Optional[Dict] = None) -> None:
+        """Add an application to the model, without simulating anything.
+
+        Args:
+            name (str): The name of the application.
+            scale (int): The number of units.
+            config (Dict): The application's config.
+        """
+        if name not in self.applications:
+            self.applications[name] = FakeApplication(self, name, scale, config)
+
+    def get_address(self, app_name: str) -> str:
+        """Get the deterministic address of an application.
+
+        Args:
+            app_name (str): The name of the application.
+        """
+        index = sorted(self.applications).index(app_name) if app_name in self.applications else 0
+        return f"10.1.0.{index + 1}"
+
+    async def get_status(self) -> Dict[str, Any]:
+        """Get the status of the model, only the application addresses and statuses."""
+        await self.simulate("get_status")
+        return {
+            "applications": {
+                name: {
+                    "public-address": self.get_address(name),
+                    "status": {"status": "active"},
+                    "units": {unit.name: {} for unit in app.units},
+                }
+                for name, app in self.applications.items()
+            }
+        }
+
+    async def set_config(self, config: Dict[str, Any]) -> None:
+        """Update the model's config.
+
+        Args:
+            config (Dict[str, Any]): The options to set.
+        """
+        await self.simulate("set_config", self.name)
+        self.config.update(config)
+
+    async def get_annotations(self) -> Dict[str, str]:
+        """Get the annotations of the model."""
+        await self.simulate("annotations")
+        return dict(self.annotations)
+
+    async def set_annotations(self, annotations: Dict[str, str]) -> None:
+        """Update the annotations of the model.
+
+        Args:
+            annotations (Dict[str, str]): The annotations to set.
+        """
+        await self.simulate("annotations")
+        self.annotations.update(annotations)
+
+    async def wait_for_idle(self, apps: Optional[List[str]] = None, **kwargs: Any) -> None:
+        """Wait for the applications to settle, they settle after the simulated latency.
+
+        Raises `asyncio.TimeoutError` like juju when an application is not in the model.
+
+        Args:
+            apps (List[str]): The applications to wait for, all of them by default.
+            kwargs (Any): The other arguments of `Model.wait_for_idle`, they are ignored.
+        """
+        apps = list(apps or self.applications)
+        await self.simulate("wait_for_idle", tuple(apps))
+        missing = [app for app in apps if app not in self.applications]
+        if missing:
+            raise asyncio.TimeoutError(f"Timed out waiting for {', '.join(missing)}")
+
+    async def remove_application(self, app_name: str, **kwargs: Any) -> None:
+        """Remove an application from the model.
+
+        Args:
+            app_name (str): The name of the application.
+            kwargs (Any): The other arguments of `Model.remove_application`, they are ignored.
+        """
+        await self.simulate("remove_application", app_name)
+        self.applications.pop(app_name, None)
+
+
+class FakeOpsTest:
+    """A stand-in for the `ops_test` fixture, its model is a `FakeModel`."""
+
+    def __init__(self, model: Optional[FakeModel] = None, **kwargs: Any):
+        """Create the stand-in.
+
+        Args:
+            model (FakeModel): The model, a new one created with `kwargs` by default.
+            kwargs (Any): The arguments of `FakeModel`.
+        """
+        self.model = model or FakeModel(**kwargs)
+
+    @property
+    def calls(self) -> List[Tuple[Any, ...]]:
+        """The operations simulated so far, in order."""
+        return self.model.calls
+
+    async def run(self, *cmd: str, **kwargs: Any) -> Tuple[int, str, str]:
+        """Run a juju command, only `juju deploy` has an effect.
+
+        Deploying a local bundle adds its applications, deploying from charmhub adds the
+        identity platform applications.
+
+        Args:
+            cmd (str): The command and its arguments.
+            kwargs (Any): The other arguments of `OpsTest.run`, they are ignored.
+        """
+        await self.model.simulate("run", *cmd)
+        if cmd[:2] != ("juju", "deploy"):
+            return 0, "", ""
+
+        bundle_path = Path(cmd[2])
+        if bundle_path.is_file():
+            bundle = yaml.safe_load(bundle_path.read_text())
+            for name, app in (bundle.get("applications") or {}).items():
+                self.model.add_application(name, app.get("scale", 1), app.get("options"))
+        else:
+            for name in APPS:
+                self.model.add_application(name)
+        return 0, "", ""
+
+    def render_bundle(self, bundle: Union[str, Path], **kwargs: Any) -> Path:
+        """Return the bundle as is, templates are not rendered offline.
+
+        Args:
+            bundle (Union[str, Path]): The path to the bundle.
+            kwargs (Any): The other arguments of `OpsTest.render_bundle`, they are ignored.
+        """
+        return Path(bundle)
+
+    @property
+    def elapsed(self) -> float:
+        """The total simulated duration of the operations, in seconds."""
+        return self.model.simulated_time
+
+    def reset(self) -> None:
+        """Forget the operations simulated so far."""
+        self.model.calls.clear()
+        self.model.simulated_time = 0.0
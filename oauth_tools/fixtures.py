@@ -2,9 +2,16 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import fcntl
+import json
 import logging
 import os
-from typing import Any, AsyncGenerator, Callable, Coroutine, Dict, Generator
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, AsyncGenerator, Callable, Coroutine, Dict, Generator, Optional
 
 import pytest
 import pytest_asyncio
@@ -14,32 +21,224 @@ from playwright.async_api._generated import Browser, BrowserContext, BrowserType
 from playwright.async_api._generated import Playwright as AsyncPlaywright
 from pytest_operator.plugin import OpsTest
 
-from oauth_tools.constants import APPS, DEX_CLIENT_ID, DEX_CLIENT_SECRET, EXTERNAL_USER_EMAIL
+from oauth_tools.browser import BrowserContextPool, launch_browser_server
+from oauth_tools.constants import (
+    APPS,
+    DEX_CLIENT_ID,
+    DEX_CLIENT_SECRET,
+    DEX_NAMESPACE,
+    EXTERNAL_USER_EMAIL,
+)
 from oauth_tools.external_idp import DexIdpService
+from oauth_tools.fake_ops_test import FakeOpsTest
+from oauth_tools.local_idp import LocalIdpService
+from oauth_tools.network import format_latency_breakdown, get_latency_breakdown, load_har
+from oauth_tools.pod_resources import PodResourceSampler
 
 logger = logging.getLogger(__name__)
 KUBECONFIG = os.environ.get("TESTING_KUBECONFIG", "~/.kube/config")
 
+# The directory used to coordinate the pytest-xdist workers, it is created by the controller
+SHARED_DIR = "oauth_tools_shared_dir"
+_shared_dir_key = pytest.StashKey[Path]()
+_reports_key = pytest.StashKey[Dict[str, pytest.TestReport]]()
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    group = parser.getgroup("oauth-tools network breakdown")
+    group.addoption(
+        "--network-breakdown",
+        action="store_true",
+        help="Record the browser traffic and break its latency down per backend",
+    )
+    group.addoption(
+        "--network-breakdown-threshold",
+        type=float,
+        metavar="SECONDS",
+        help="Keep the HAR and trace of the tests whose network time exceeds it",
+    )
+    group.addoption(
+        "--network-artifacts",
+        default="network-artifacts",
+        metavar="DIR",
+        help="Where to keep the HAR and trace of the failed or slow tests",
+    )
+    group = parser.getgroup("oauth-tools browser reuse")
+    group.addoption(
+        "--reuse-browser",
+        action="store_true",
+        help="Share one browser across the test modules and recycle the browser contexts",
+    )
+    group.addoption(
+        "--context-pool-size",
+        type=int,
+        default=2,
+        help="The maximum number of idle browser contexts kept for reuse",
+    )
+    group.addoption(
+        "--context-max-uses",
+        type=int,
+        default=20,
+        help="The number of tests after which a browser context is closed",
+    )
+    group = parser.getgroup("oauth-tools sharding")
+    group.addoption(
+        "--shared-dex",
+        action="store_true",
+        help="Share one dex across the pytest-xdist workers, only when they test the same model",
+    )
+    group = parser.getgroup("oauth-tools pod resources")
+    group.addoption(
+        "--pod-sample-interval",
+        type=float,
+        default=5.0,
+        metavar="SECONDS",
+        help="The interval between two samples of the pod resources",
+    )
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    # Registered by pytest-xdist, the test groups are ignored when running without it
+    config.addinivalue_line(
+        "markers", "xdist_group(name): run the tests of a group on the same pytest-xdist worker"
+    )
+    if hasattr(config, "workerinput"):
+        return
+    config.stash[_shared_dir_key] = Path(tempfile.mkdtemp(prefix="oauth-tools-"))
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node: Any) -> None:
+    """Pass the shared directory to the pytest-xdist workers."""
+    node.workerinput[SHARED_DIR] = str(node.config.stash[_shared_dir_key])
+
+
+def pytest_sessionfinish(session: pytest.Session) -> None:
+    """Remove the shared external IdP, once, when all the workers are done."""
+    config = session.config
+    if hasattr(config, "workerinput") or _shared_dir_key not in config.stash:
+        return
+
+    try:
+        with _shared_state(config) as state:
+            if state.get("provisioned") and not _keep_models(config):
+                logger.info("Deleting dex resources")
+                DexIdpService(provision=False).remove_idp_service()
+    finally:
+        shutil.rmtree(config.stash[_shared_dir_key], ignore_errors=True)
+
+
+def _keep_models(config: pytest.Config) -> bool:
+    # Same as `OpsTest.keep_model`, models are kept when asked to or when reusing a model
+    return bool(config.getoption("--keep-models", False) or config.getoption("--model", None))
+
+
+@contextmanager
+def _shared_state(config: pytest.Config) -> Generator[Dict, None, None]:
+    """Lock the state shared by the pytest-xdist workers, for reading and updating it."""
+    if hasattr(config, "workerinput"):
+        shared_dir = Path(config.workerinput[SHARED_DIR])
+    else:
+        shared_dir = config.stash[_shared_dir_key]
+
+    state_file = shared_dir / "ext_idp.json"
+    with open(shared_dir / "ext_idp.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = json.loads(state_file.read_text()) if state_file.exists() else {}
+        try:
+            yield state
+        finally:
+            state_file.write_text(json.dumps(state))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item: pytest.Item) -> Generator[None, Any, None]:
+    """Keep the reports of the test, for the fixtures to know whether it failed."""
+    outcome = yield
+    report = outcome.get_result()
+    item.stash.setdefault(_reports_key, {})[report.when] = report
+
 
 @pytest.fixture(scope="session")
 def client() -> Client:
     return Client(config=KubeConfig.from_file(KUBECONFIG), field_manager="dex-test")
 
 
+def get_shard(config: pytest.Config) -> Optional[str]:
+    """Get the id of the pytest-xdist worker running the tests, None without pytest-xdist."""
+    return getattr(config, "workerinput", {}).get("workerid")
+
+
+@pytest.fixture(scope="session")
+def ext_idp_service(pytestconfig: pytest.Config) -> Generator[DexIdpService, None, None]:
+    """Deploy and manage the lifecycle of an Dex service.
+
+    The service is shared by all the test modules. Each pytest-xdist worker tests a model of
+    its own and dex registers a single redirect URI, so each worker deploys its own in the
+    `dex-<worker>` namespace and removes it when its tests are over.
+
+    With `--shared-dex`, the workers share a single dex instead, e.g. when they all test the
+    same model. The first worker deploys it, the others wait for it to be ready and attach
+    to it. It is removed once, when the test run is over.
+
+    Dex is deployed in the background, it is waited for when it is first used, e.g. by
+    `deploy_identity_bundle` once the bundle is deployed.
+    """
+    shard = get_shard(pytestconfig)
+    if shard and not pytestconfig.getoption("--shared-dex"):
+        ext_idp_service = DexIdpService(provision=False, namespace=f"{DEX_NAMESPACE}-{shard}")
+        ext_idp_service.start_provisioning()
+        try:
+            yield ext_idp_service
+        finally:
+            if not _keep_models(pytestconfig):
+                logger.info(f"Deleting dex resources of {shard}")
+                ext_idp_service.remove_idp_service()
+        return
+
+    with _shared_state(pytestconfig) as state:
+        # Only the first worker deploys dex, the others wait for it to be ready
+        deploy = not state.get("provisioned")
+        # Clean up on failure too, dex may have been partially deployed
+        state["provisioned"] = True
+        ext_idp_service = DexIdpService(provision=False)
+        ext_idp_service.start_provisioning(deploy=deploy)
+    yield ext_idp_service
+
+
 @pytest.fixture(scope="module")
-def ext_idp_service(ops_test: OpsTest, client: Client) -> Generator[DexIdpService, None, None]:
-    """Deploy and manage the lifecycle of an Dex service."""
-    logger.info("Deploying dex resources")
-    ext_idp_manager = DexIdpService(client=client)
+def local_idp_service() -> Generator[LocalIdpService, None, None]:
+    """Run a minimal OIDC provider in the test process, instead of deploying Dex."""
+    ext_idp_manager = LocalIdpService()
     try:
         yield ext_idp_manager
     finally:
-        if ops_test.keep_model:
-            return
-        logger.info("Deleting dex resources")
         ext_idp_manager.remove_idp_service()
 
 
+@pytest.fixture
+def pod_resource_sampler(
+    request: pytest.FixtureRequest, client: Client, ops_test: OpsTest
+) -> Generator[PodResourceSampler, None, None]:
+    """Sample the resources of the model's pods during the test, and attach them to its report."""
+    sampler = PodResourceSampler(
+        client, ops_test.model.name, interval=request.config.getoption("--pod-sample-interval")
+    )
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        request.node.user_properties.append(("pod_resources", sampler.series()))
+        request.node.add_report_section("teardown", "pod resources", sampler.format())
+
+
+@pytest.fixture
+def fake_ops_test() -> FakeOpsTest:
+    """An offline stand-in for `ops_test`, to test the deploy orchestration without juju."""
+    return FakeOpsTest()
+
+
 @pytest.fixture
 def dex_client_id() -> str:
     return DEX_CLIENT_ID
@@ -88,14 +287,36 @@ def self_signed_certificates_app_name() -> str:
 # To learn more about playwright for python see https://github.com/microsoft/playwright-python.
 # Fixtures are accessible from
 # https://github.com/microsoft/playwright-python/blob/main/tests/async/conftest.py.
-@pytest.fixture(scope="module")
-def launch_arguments(pytestconfig: Any) -> Dict:
+def _get_launch_arguments(config: pytest.Config) -> Dict:
     return {
-        "headless": not (pytestconfig.getoption("--headed") or os.getenv("HEADFUL", False)),
-        "channel": pytestconfig.getoption("--browser-channel"),
+        "headless": not (config.getoption("--headed") or os.getenv("HEADFUL", False)),
+        "channel": config.getoption("--browser-channel"),
     }
 
 
+@pytest.fixture(scope="module")
+def launch_arguments(pytestconfig: Any) -> Dict:
+    return _get_launch_arguments(pytestconfig)
+
+
+@pytest.fixture(scope="session")
+def browser_server(
+    pytestconfig: pytest.Config, browser_name: str
+) -> Generator[Optional[str], None, None]:
+    """Launch the browser shared by the test modules, with `--reuse-browser`.
+
+    Yields the websocket endpoint of the browser server, None without `--reuse-browser`.
+    """
+    if not pytestconfig.getoption("--reuse-browser"):
+        yield None
+        return
+
+    process, ws_endpoint = launch_browser_server(browser_name, _get_launch_arguments(pytestconfig))
+    yield ws_endpoint
+    process.terminate()
+    process.wait()
+
+
 @pytest_asyncio.fixture(scope="module")
 async def playwright() -> AsyncGenerator[AsyncPlaywright, None]:
     async with async_playwright() as playwright_object:
@@ -113,12 +334,16 @@ def browser_type(playwright: AsyncPlaywright, browser_name: str) -> BrowserType:
 
 @pytest_asyncio.fixture(scope="module")
 async def browser_factory(
-    launch_arguments: Dict, browser_type: BrowserType
+    launch_arguments: Dict, browser_type: BrowserType, browser_server: Optional[str]
 ) -> AsyncGenerator[Callable[..., Coroutine[Any, Any, Browser]], None]:
     browsers = []
 
     async def launch(**kwargs: Any) -> Browser:
-        browser = await browser_type.launch(**launch_arguments, **kwargs)
+        if browser_server and not kwargs:
+            # Closing a connected browser only disconnects from it
+            browser = await browser_type.connect(browser_server)
+        else:
+            browser = await browser_type.launch(**launch_arguments, **kwargs)
         browsers.append(browser)
         return browser
 
@@ -152,13 +377,87 @@ async def context_factory(
         await context.close()
 
 
+@pytest_asyncio.fixture(scope="module")
+async def browser_context_pool(
+    pytestconfig: pytest.Config, browser: Browser
+) -> AsyncGenerator[Optional[BrowserContextPool], None]:
+    """The pool of recycled browser contexts, with `--reuse-browser`."""
+    if not pytestconfig.getoption("--reuse-browser"):
+        yield None
+        return
+
+    pool = BrowserContextPool(
+        browser,
+        max_size=pytestconfig.getoption("--context-pool-size"),
+        max_uses=pytestconfig.getoption("--context-max-uses"),
+        ignore_https_errors=True,
+    )
+    yield pool
+    await pool.close()
+
+
 @pytest_asyncio.fixture
 async def context(
+    request: pytest.FixtureRequest,
     context_factory: Callable[..., Coroutine[Any, Any, BrowserContext]],
+    browser_context_pool: Optional[BrowserContextPool],
 ) -> AsyncGenerator[BrowserContext, None]:
-    context = await context_factory(ignore_https_errors=True)
-    yield context
-    await context.close()
+    if browser_context_pool and not request.config.getoption("--network-breakdown"):
+        context = await browser_context_pool.acquire()
+        yield context
+        await browser_context_pool.release(context)
+        return
+
+    if not request.config.getoption("--network-breakdown"):
+        context = await context_factory(ignore_https_errors=True)
+        yield context
+        await context.close()
+        return
+
+    with tempfile.TemporaryDirectory(prefix="oauth-tools-network-") as tmp_dir:
+        har_path = Path(tmp_dir) / "network.har"
+        trace_path = Path(tmp_dir) / "trace.zip"
+        context = await context_factory(
+            ignore_https_errors=True, record_har_path=str(har_path), record_har_content="omit"
+        )
+        await context.tracing.start(screenshots=True, snapshots=True)
+        yield context
+        await context.tracing.stop(path=str(trace_path))
+        # The HAR is written when the context is closed
+        await context.close()
+        _report_network_breakdown(request, har_path, trace_path)
+
+
+def _report_network_breakdown(
+    request: pytest.FixtureRequest, har_path: Path, trace_path: Path
+) -> None:
+    """Attach the latency breakdown to the test report, keep the artifacts of slow tests."""
+    backends = {}
+    if "ext_idp_service" in request.fixturenames:
+        try:
+            backends[request.getfixturevalue("ext_idp_service").issuer_url] = "dex"
+        except Exception:
+            logger.info("Dex is not available, its requests are attributed to its host")
+
+    breakdown = get_latency_breakdown(load_har(har_path), backends)
+    request.node.user_properties.append(("network_breakdown", breakdown))
+    request.node.add_report_section(
+        "teardown", "network breakdown", format_latency_breakdown(breakdown)
+    )
+
+    reports = request.node.stash.get(_reports_key, {})
+    failed = any(report.failed for report in reports.values())
+    threshold = request.config.getoption("--network-breakdown-threshold")
+    if not failed and (threshold is None or breakdown["time"] <= threshold * 1000):
+        return
+
+    artifacts_dir = Path(request.config.getoption("--network-artifacts")) / re.sub(
+        r"[^\w.-]+", "_", request.node.nodeid
+    )
+    artifacts_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copy(har_path, artifacts_dir)
+    shutil.copy(trace_path, artifacts_dir)
+    logger.info(f"Kept the network artifacts in {artifacts_dir}")
 
 
 @pytest_asyncio.fixture
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Instrumentation of the HTTP requests sent by oauth_tools.
+
+The HTTP clients of oauth_tools are created with `get_http_client` or
+`get_async_http_client`, their requests emit an `HttpEvent` to the callbacks registered
+with `add_http_callback`:
+
+    histogram = HttpHistogram()
+    add_http_callback(histogram)
+    add_http_callback(JsonLinesSink("http.jsonl"))
+    ...
+    logger.info(histogram.format())
+
+Pass `http2=True` to multiplex concurrent requests over fewer connections, it requires the
+`h2` package (`pip install httpx[http2]`). HTTP/2 is negotiated with TLS, servers that do not
+support it are still spoken to in HTTP/1.1. `ConnectionStats` reports how many connections
+were opened and how often they were reused.
+
+Pass `callbacks` to a client to call them with the events of its requests only:
+
+    stats = ConnectionStats()
+    async with get_async_http_client(callbacks=[stats]) as http_client:
+        ...
+"""
+
+import json
+import logging
+import threading
+from collections import defaultdict
+from pathlib import Path
+from time import monotonic
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# The arguments of the HTTP clients that configure their transport
+_TRANSPORT_ARGS = ("verify", "cert", "trust_env", "http1", "http2", "limits", "retries")
+
+
+class HttpEvent(NamedTuple):
+    """The timings of an HTTP request, in seconds.
+
+    `connect` includes the DNS resolution, `connect` and `tls` are 0 when a connection
+    was reused. `ttfb` and `total` are measured from the start of the request. A request
+    that failed is never counted as `connection_reused`, whether it connected or not.
+    """
+
+    method: str
+    url: str
+    endpoint: str
+    status: Optional[int]
+    http_version: Optional[str]
+    connection_reused: bool
+    connect: float
+    tls: float
+    ttfb: float
+    total: float
+    bytes: int
+    error: Optional[str] = None
+
+
+HttpCallback = Callable[[HttpEvent], None]
+
+_callbacks: List[HttpCallback] = []
+
+
+def add_http_callback(callback: HttpCallback) -> None:
+    """Register a callback, it is called with the `HttpEvent` of every request.
+
+    The callbacks are called from the thread that sent the request, they must be fast and
+    thread safe.
+
+    Args:
+        callback (HttpCallback): The callback.
+    """
+    _callbacks.append(callback)
+
+
+def remove_http_callback(callback: HttpCallback) -> None:
+    """Unregister a callback.
+
+    Args:
+        callback (HttpCallback): The callback.
+    """
+    _callbacks.remove(callback)
+
+
+def _emit(event: HttpEvent, callbacks: Sequence[HttpCallback] = ()) -> None:
+    for callback in [*_callbacks, *callbacks]:
+        try:
+            callback(event)
+        except Exception:
+            logger.exception(f"HTTP callback {callback} failed")
+
+
+class _RequestTimer:
+    """Collect the timings of a request from the httpcore trace events."""
+
+    def __init__(self, request: httpx.Request, callbacks: Sequence[HttpCallback] = ()):
+        self.request = request
+        self.callbacks = callbacks
+        self.start = monotonic()
+        self.marks: Dict[str, float] = {}
+        self.response: Optional[httpx.Response] = None
+        self.bytes = 0
+        self.emitted = False
+
+    def trace(self, name: str, info: Dict[str, Any]) -> None:
+        # e.g. "connection.connect_tcp.started" or "http11.receive_response_headers.complete"
+        self.marks[name.split(".", 1)[-1]] = monotonic()
+
+    async def atrace(self, name: str, info: Dict[str, Any]) -> None:
+        self.trace(name, info)
+
+    def _duration(self, phase: str) -> float:
+        start, end = self.marks.get(f"{phase}.started"), self.marks.get(f"{phase}.complete")
+        return end - start if start is not None and end is not None else 0.0
+
+    def emit(self, error: Optional[BaseException] = None) -> None:
+        if self.emitted:
+            return
+        self.emitted = True
+        now = monotonic()
+        headers = self.marks.get("receive_response_headers.complete")
+        response = self.response
+        _emit(
+            HttpEvent(
+                method=self.request.method,
+                url=str(self.request.url),
+                endpoint=self.request.url.path,
+                status=response.status_code if response is not None else None,
+                http_version=response.http_version if response is not None else None,
+                # Only a response tells that a connection of the pool was used
+                connection_reused=(
+                    response is not None
+                    and error is None
+                    and "connect_tcp.started" not in self.marks
+                ),
+                connect=self._duration("connect_tcp"),
+                tls=self._duration("start_tls"),
+                ttfb=(headers if headers is not None else now) - self.start,
+                total=now - self.start,
+                bytes=self.bytes,
+                error=repr(error) if error else None,
+            ),
+            self.callbacks,
+        )
+
+
+class _TimedStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, timer: _RequestTimer):
+        self._stream = stream
+        self._timer = timer
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            for chunk in self._stream:
+                self._timer.bytes += len(chunk)
+                yield chunk
+        except Exception as e:
+            self._timer.emit(e)
+            raise
+
+    def close(self) -> None:
+        self._stream.close()
+        self._timer.emit()
+
+
+class _AsyncTimedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, timer: _RequestTimer):
+        self._stream = stream
+        self._timer = timer
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in self._stream:
+                self._timer.bytes += len(chunk)
+                yield chunk
+        except Exception as e:
+            self._timer.emit(e)
+            raise
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+        self._timer.emit()
+
+
+class InstrumentedTransport(httpx.BaseTransport):
+    """A transport emitting an `HttpEvent` for each request, once its response is closed."""
+
+    def __init__(
+        self,
+        transport: Optional[httpx.BaseTransport] = None,
+        callbacks: Sequence[HttpCallback] = (),
+        **kwargs: Any,
+    ):
+        """Wrap a transport.
+
+        Args:
+            transport (httpx.BaseTransport): The transport to wrap, an `httpx.HTTPTransport`
+                created with `kwargs` by default.
+            callbacks (Sequence[HttpCallback]): The callbacks of this transport only, they
+                are called after the ones registered with `add_http_callback`.
+            kwargs (Any): The arguments of `httpx.HTTPTransport`.
+        """
+        self._transport = transport or httpx.HTTPTransport(**kwargs)
+        self._callbacks = list(callbacks)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        timer = _RequestTimer(request, self._callbacks)
+        request.extensions["trace"] = timer.trace
+        try:
+            response = self._transport.handle_request(request)
+        except Exception as e:
+            timer.emit(e)
+            raise
+        timer.response = response
+        response.stream = _TimedStream(response.stream, timer)  # type: ignore[arg-type]
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncInstrumentedTransport(httpx.AsyncBaseTransport):
+    """An async transport emitting an `HttpEvent` for each request."""
+
+    def __init__(
+        self,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        callbacks: Sequence[HttpCallback] = (),
+        **kwargs: Any,
+    ):
+        """Wrap a transport.
+
+        Args:
+            transport (httpx.AsyncBaseTransport): The transport to wrap, an
+                `httpx.AsyncHTTPTransport` created with `kwargs` by default.
+            callbacks (Sequence[HttpCallback]): The callbacks of this transport only, they
+                are called after the ones registered with `add_http_callback`.
+            kwargs (Any): The arguments of `httpx.AsyncHTTPTransport`.
+        """
+        self._transport = transport or httpx.AsyncHTTPTransport(**kwargs)
+        self._callbacks = list(callbacks)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        timer = _RequestTimer(request, self._callbacks)
+        request.extensions["trace"] = timer.atrace
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception as e:
+            timer.emit(e)
+            raise
+        timer.response = response
+        response.stream = _AsyncTimedStream(response.stream, timer)  # type: ignore[arg-type]
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _split_transport_args(kwargs: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    transport_args = {k: v for k, v in kwargs.items() if k in _TRANSPORT_ARGS}
+    client_args = {k: v for k, v in kwargs.items() if k not in _TRANSPORT_ARGS or k == "trust_env"}
+    return client_args, transport_args
+
+
+def get_http_client(callbacks: Sequence[HttpCallback] = (), **kwargs: Any) -> httpx.Client:
+    """Create an instrumented `httpx.Client`.
+
+    Args:
+        callbacks (Sequence[HttpCallback]): Callbacks called with the events of the requests
+            of this client only, e.g. a `ConnectionStats`.
+        kwargs (Any): The arguments of `httpx.Client`, e.g. `verify=False`.
+    """
+    client_args, transport_args = _split_transport_args(kwargs)
+    transport = InstrumentedTransport(callbacks=callbacks, **transport_args)
+    return httpx.Client(transport=transport, **client_args)
+
+
+def get_async_http_client(
+    callbacks: Sequence[HttpCallback] = (), **kwargs: Any
+) -> httpx.AsyncClient:
+    """Create an instrumented `httpx.AsyncClient`.
+
+    Args:
+        callbacks (Sequence[HttpCallback]): Callbacks called with the events of the requests
+            of this client only, e.g. a `ConnectionStats`.
+        kwargs (Any): The arguments of `httpx.AsyncClient`, e.g. `verify=False`.
+    """
+    client_args, transport_args = _split_transport_args(kwargs)
+    transport = AsyncInstrumentedTransport(callbacks=callbacks, **transport_args)
+    return httpx.AsyncClient(transport=transport, **client_args)
+
+
+class HttpHistogram:
+    """A callback aggregating the request durations per endpoint in histogram buckets."""
+
+    # The upper bounds of the buckets, in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+    def __init__(self, phase: str = "total"):
+        """Create an empty histogram.
+
+        Args:
+            phase (str): The `HttpEvent` duration to aggregate, e.g. "ttfb".
+        """
+        self.phase = phase
+        self._lock = threading.Lock()
+        self._counts: Dict[Tuple[str, str], List[int]] = defaultdict(
+            lambda: [0] * len(self.buckets)
+        )
+        self._sums: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._errors: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def __call__(self, event: HttpEvent) -> None:
+        """Add an event to the histogram."""
+        key = (event.method, event.endpoint)
+        duration = getattr(event, self.phase)
+        with self._lock:
+            counts = self._counts[key]
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    counts[i] += 1
+                    break
+            self._sums[key] += duration
+            if event.error or (event.status or 0) >= 400:
+                self._errors[key] += 1
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Get the count, mean, errors and bucket counts of each endpoint."""
+        with self._lock:
+            summary = {}
+            for (method, endpoint), counts in self._counts.items():
+                count = sum(counts)
+                summary[f"{method} {endpoint}"] = {
+                    "count": count,
+                    "mean": self._sums[(method, endpoint)] / count,
+                    "errors": self._errors[(method, endpoint)],
+                    "buckets": dict(zip(map(str, self.buckets), counts)),
+                }
+            return summary
+
+    def quantile(self, method: str, endpoint: str, q: float) -> float:
+        """Get the upper bound of the bucket holding the `q` quantile of an endpoint.
+
+        Args:
+            method (str): The HTTP method.
+            endpoint (str): The URL path.
+            q (float): The quantile, e.g. 0.95.
+        """
+        with self._lock:
+            counts = self._counts.get((method, endpoint))
+            if not counts:
+                return 0.0
+            rank = q * sum(counts)
+            seen = 0
+            for bound, count in zip(self.buckets, counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return self.buckets[-1]
+
+    def format(self) -> str:
+        """Format the summary, one endpoint per line."""
+        lines = []
+        for key, stats in sorted(self.summary().items()):
+            method, endpoint = key.split(" ", 1)
+            lines.append(
+                f"{key}: {stats['count']} request(s), {stats['errors']} error(s), "
+                f"mean {stats['mean'] * 1000:.0f}ms, "
+                f"p95 <= {self.quantile(method, endpoint, 0.95) * 1000:.0f}ms"
+            )
+        return "\n".join(lines)
+
+
+class ConnectionStats:
+    """A callback counting the connections opened and reused, per HTTP version."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._requests: Dict[str, int] = defaultdict(int)
+        self._connections: Dict[str, int] = defaultdict(int)
+
+    def __call__(self, event: HttpEvent) -> None:
+        """Add an event to the statistics."""
+        # The requests that failed before a response have no HTTP version
+        http_version = event.http_version or "unknown"
+        with self._lock:
+            self._requests[http_version] += 1
+            if not event.connection_reused:
+                self._connections[http_version] += 1
+
+    @property
+    def requests(self) -> int:
+        """The number of requests sent."""
+        with self._lock:
+            return sum(self._requests.values())
+
+    @property
+    def connections(self) -> int:
+        """The number of connections opened."""
+        with self._lock:
+            return sum(self._connections.values())
+
+    @property
+    def reuse_ratio(self) -> float:
+        """The fraction of the requests sent over an already open connection."""
+        requests = self.requests
+        return (requests - self.connections) / requests if requests else 0.0
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        """Get the number of requests and connections opened of each HTTP version."""
+        with self._lock:
+            return {
+                http_version: {
+                    "requests": requests,
+                    "connections": self._connections[http_version],
+                }
+                for http_version, requests in self._requests.items()
+            }
+
+    def format(self) -> str:
+        """Format the summary, one HTTP version per line."""
+        lines = []
+        for http_version, stats in sorted(self.summary().items()):
+            reused = stats["requests"] - stats["connections"]
+            lines.append(
+                f"{http_version}: {stats['requests']} request(s) over "
+                f"{stats['connections']} connection(s), {reused} reused"
+            )
+        return "\n".join(lines)
+
+
+class JsonLinesSink:
+    """A callback appending the events to a JSON lines file."""
+
+    def __init__(self, path: Union[str, Path]):
+        """Open the file, the events are appended to it.
+
+        Args:
+            path (Union[str, Path]): The path to the file.
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._file = self.path.open("a")
+
+    def __call__(self, event: HttpEvent) -> None:
+        """Write an event to the file."""
+        line = json.dumps(event._asdict())
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        """Close the file."""
+        with self._lock:
+            self._file.close()
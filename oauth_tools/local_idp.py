@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import base64
+import binascii
+import html
+import json
+import logging
+import re
+import secrets
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qs, unquote_plus, urlencode, urlparse
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from playwright.async_api import expect
+from playwright.async_api._generated import Page
+
+from oauth_tools.constants import EXTERNAL_USER_PASSWORD
+from oauth_tools.credentials import IdpClient, IdpUser, get_idp_clients, get_idp_users
+from oauth_tools.external_idp import ExternalIdpService
+
+logger = logging.getLogger(__name__)
+
+TOKEN_LIFESPAN = 3600
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html>
+  <head><title>Log in</title></head>
+  <body>
+    <form method="post" action="{action}">
+      <input type="hidden" name="req" value="{req}">
+      <input type="text" name="login" placeholder="email address">
+      <input type="password" name="password" placeholder="password">
+      <button type="submit">Login</button>
+    </form>
+    <p>{error}</p>
+  </body>
+</html>
+"""
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64url_uint(value: int) -> str:
+    return _b64url(value.to_bytes((value.bit_length() + 7) // 8, "big"))
+
+
+@lru_cache(maxsize=1)
+def _get_signing_key() -> rsa.RSAPrivateKey:
+    """Generate the key used to sign the ID tokens, once per process."""
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+class _OidcRequestHandler(BaseHTTPRequestHandler):
+    server: "_OidcServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+    def _send(self, status: int, body: str, content_type: str, **headers: str) -> None:
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_json(self, status: int, body: Dict) -> None:
+        self._send(status, json.dumps(body), "application/json", Cache_Control="no-store")
+
+    def _read_form(self) -> Dict[str, str]:
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        return {key: values[0] for key, values in form.items()}
+
+    def do_GET(self) -> None:  # noqa: N802
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        idp = self.server.idp
+        if url.path == "/.well-known/openid-configuration":
+            self._send_json(200, idp._discovery_document())
+        elif url.path == "/keys":
+            self._send_json(200, idp._jwks())
+        elif url.path == "/auth":
+            req, error = idp._start_auth_request(query)
+            if error:
+                self._send_json(400, {"error": error})
+                return
+            self._send(200, idp._login_page(req), "text/html")
+        elif url.path == "/userinfo":
+            claims = idp._get_userinfo(self.headers.get("Authorization", ""))
+            if not claims:
+                self._send_json(401, {"error": "invalid_token"})
+                return
+            self._send_json(200, claims)
+        else:
+            self._send_json(404, {"error": "not_found"})
+
+    def do_POST(self) -> None:  # noqa: N802
+        url = urlparse(self.path)
+        form = self._read_form()
+        idp = self.server.idp
+        if url.path == "/auth/login":
+            location = idp._complete_auth_request(form)
+            if not location:
+                page = idp._login_page(form.get("req", ""), error="Invalid credentials")
+                self._send(401, page, "text/html")
+                return
+            self._send(303, "", "text/html", Location=location)
+        elif url.path == "/token":
+            status, body = idp._exchange_code(form, self.headers.get("Authorization", ""))
+            self._send_json(status, body)
+        else:
+            self._send_json(404, {"error": "not_found"})
+
+
+class _OidcServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], idp: "LocalIdpService"):
+        super().__init__(address, _OidcRequestHandler)
+        self.idp = idp
+
+
+class LocalIdpService(ExternalIdpService):
+    """Class for managing lifecycle for a minimal OIDC provider running in the test process.
+
+    The provider only supports the authorization code flow. It starts in milliseconds and
+    does not need Kubernetes, use it for tests that do not need a production grade IdP.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        advertise_host: Optional[str] = None,
+        users: int = 1,
+        clients: int = 1,
+    ):
+        """Start the provider.
+
+        Args:
+            host (str): The address to listen on.
+            port (int): The port to listen on, a free port is used by default.
+            advertise_host (str): The host used in the issuer URL, defaults to `host`. Set it
+                when the provider must be reachable from elsewhere, e.g. from a pod.
+            users (int): The number of users to register, see `DexIdpService`.
+            clients (int): The number of clients to register, see `DexIdpService`.
+        """
+        self._host = host
+        self._port = port
+        self._advertise_host = advertise_host or host
+        self._users = get_idp_users(users, EXTERNAL_USER_PASSWORD)
+        self._clients = get_idp_clients(clients)
+        self._redirect_uri = ""
+        self._lock = threading.Lock()
+        self._auth_requests: Dict[str, Tuple[Dict[str, str], str]] = {}
+        self._codes: Dict[str, Tuple[Dict[str, str], IdpUser, float]] = {}
+        self._access_tokens: Dict[str, Tuple[IdpUser, float]] = {}
+        self._server: Optional[_OidcServer] = None
+        self.create_idp_service()
+
+    @property
+    def client_id(self) -> str:
+        """The client_id of a registered client."""
+        return self._clients[0].client_id
+
+    @property
+    def client_secret(self) -> str:
+        """The client_secret of a registered client."""
+        return self._clients[0].client_secret
+
+    @property
+    def user_email(self) -> str:
+        """The test user's email."""
+        return self._users[0].email
+
+    @property
+    def user_password(self) -> str:
+        """The test user's password."""
+        return self._users[0].password
+
+    @property
+    def issuer_url(self) -> str:
+        """The provider's issuer URL."""
+        return f"http://{self._advertise_host}:{self._port}/"
+
+    def iter_users(self) -> Iterator[IdpUser]:
+        """Iterate over the credentials of the registered users."""
+        return iter(self._users)
+
+    def iter_clients(self) -> Iterator[IdpClient]:
+        """Iterate over the credentials of the registered clients."""
+        return iter(self._clients)
+
+    def create_idp_service(self) -> None:
+        """Start serving the provider, in a background thread."""
+        if self._server:
+            return
+        self._server = _OidcServer((self._host, self._port), self)
+        self._port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serving the local identity provider on {self.issuer_url}")
+
+    def remove_idp_service(self) -> None:
+        """Stop serving the provider."""
+        if not self._server:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+    def update_redirect_uri(self, redirect_uri: str) -> None:
+        """Update the registered client's redirect_uri."""
+        if not redirect_uri:
+            logger.info("Empty parameter for redirect_uri")
+            return
+        self._redirect_uri = redirect_uri
+
+    async def complete_user_login(self, page: Page, user: Optional[IdpUser] = None) -> None:
+        """Get a page on the IDP login page and login the user.
+
+        Args:
+            page (Page): The page fixture.
+            user (IdpUser): The user to login as, defaults to the test user.
+        """
+        user = user or self._users[0]
+        logger.info("Signing in to the local identity provider")
+        await expect(page).to_have_url(re.compile(rf"{self.issuer_url}*"))
+        await page.get_by_placeholder("email address").fill(user.email)
+        await page.get_by_placeholder("password").fill(user.password)
+        await page.get_by_role("button", name="Login").click()
+
+    def _discovery_document(self) -> Dict:
+        return {
+            "issuer": self.issuer_url,
+            "authorization_endpoint": f"{self.issuer_url}auth",
+            "token_endpoint": f"{self.issuer_url}token",
+            "userinfo_endpoint": f"{self.issuer_url}userinfo",
+            "jwks_uri": f"{self.issuer_url}keys",
+            "response_types_supported": ["code"],
+            "grant_types_supported": ["authorization_code"],
+            "subject_types_supported": ["public"],
+            "id_token_signing_alg_values_supported": ["RS256"],
+            "scopes_supported": ["openid", "email", "profile"],
+            "token_endpoint_auth_methods_supported": ["client_secret_basic", "client_secret_post"],
+            "claims_supported": ["iss", "sub", "aud", "exp", "iat", "email", "email_verified"],
+        }
+
+    def _jwks(self) -> Dict:
+        public_numbers = _get_signing_key().public_key().public_numbers()
+        return {
+            "keys": [
+                {
+                    "kty": "RSA",
+                    "use": "sig",
+                    "alg": "RS256",
+                    "kid": "local-idp",
+                    "n": _b64url_uint(public_numbers.n),
+                    "e": _b64url_uint(public_numbers.e),
+                }
+            ]
+        }
+
+    def _sign(self, claims: Dict) -> str:
+        header = {"alg": "RS256", "typ": "JWT", "kid": "local-idp"}
+        signing_input = ".".join(
+            _b64url(json.dumps(part, separators=(",", ":")).encode()) for part in (header, claims)
+        )
+        signature = _get_signing_key().sign(
+            signing_input.encode(), padding.PKCS1v15(), hashes.SHA256()
+        )
+        return f"{signing_input}.{_b64url(signature)}"
+
+    def _get_client(self, client_id: str) -> Optional[IdpClient]:
+        return next((c for c in self._clients if c.client_id == client_id), None)
+
+    def _login_page(self, req: str, error: str = "") -> str:
+        return LOGIN_PAGE.format(
+            action=f"{self.issuer_url}auth/login", req=html.escape(req), error=html.escape(error)
+        )
+
+    def _start_auth_request(self, query: Dict[str, str]) -> Tuple[str, Optional[str]]:
+        if query.get("response_type") != "code":
+            return "", "unsupported_response_type"
+        if not self._get_client(query.get("client_id", "")):
+            return "", "unauthorized_client"
+        # The redirect_uri can be omitted when the client has a single one registered
+        redirect_uri = query.get("redirect_uri", self._redirect_uri)
+        if not redirect_uri or (self._redirect_uri and redirect_uri != self._redirect_uri):
+            return "", "invalid_request"
+
+        req = secrets.token_urlsafe()
+        with self._lock:
+            self._auth_requests[req] = (query, redirect_uri)
+        return req, None
+
+    def _complete_auth_request(self, form: Dict[str, str]) -> Optional[str]:
+        user = next(
+            (
+                u
+                for u in self._users
+                if u.email == form.get("login") and u.password == form.get("password")
+            ),
+            None,
+        )
+        with self._lock:
+            auth_request = self._auth_requests.get(form.get("req", ""))
+            if not user or not auth_request:
+                return None
+            del self._auth_requests[form["req"]]
+            query, redirect_uri = auth_request
+            code = secrets.token_urlsafe()
+            self._codes[code] = (query, user, time.time() + 60)
+
+        params = {"code": code}
+        if "state" in query:
+            params["state"] = query["state"]
+        return f"{redirect_uri}?{urlencode(params)}"
+
+    def _authenticate_client(self, form: Dict[str, str], authorization: str) -> Optional[str]:
+        client_id, client_secret = form.get("client_id", ""), form.get("client_secret", "")
+        if authorization.startswith("Basic "):
+            try:
+                credentials = base64.b64decode(
+                    authorization[len("Basic ") :], validate=True
+                ).decode()
+            except (binascii.Error, UnicodeDecodeError):
+                logger.info("Malformed client credentials")
+                return None
+            client_id, _, client_secret = credentials.partition(":")
+            # The credentials are form-urlencoded before being encoded, see RFC 6749 2.3.1
+            client_id, client_secret = unquote_plus(client_id), unquote_plus(client_secret)
+        client = self._get_client(client_id)
+        if not client or client.client_secret != client_secret:
+            return None
+        return client_id
+
+    def _exchange_code(self, form: Dict[str, str], authorization: str) -> Tuple[int, Dict]:
+        client_id = self._authenticate_client(form, authorization)
+        if not client_id:
+            return 401, {"error": "invalid_client"}
+        if form.get("grant_type") != "authorization_code":
+            return 400, {"error": "unsupported_grant_type"}
+
+        with self._lock:
+            query, user, expiry = self._codes.pop(form.get("code", ""), ({}, None, 0))
+        if (
+            not user
+            or expiry < time.time()
+            or query.get("client_id") != client_id
+            or query.get("redirect_uri") != form.get("redirect_uri")
+        ):
+            return 400, {"error": "invalid_grant"}
+
+        now = int(time.time())
+        claims = {
+            "iss": self.issuer_url,
+            "sub": user.user_id,
+            "aud": client_id,
+            "iat": now,
+            "exp": now + TOKEN_LIFESPAN,
+            "email": user.email,
+            "email_verified": True,
+            "name": user.username,
+        }
+        if "nonce" in query:
+            claims["nonce"] = query["nonce"]
+
+        access_token = secrets.token_urlsafe()
+        with self._lock:
+            self._access_tokens[access_token] = (user, now + TOKEN_LIFESPAN)
+        return 200, {
+            "access_token": access_token,
+            "token_type": "Bearer",
+            "expires_in": TOKEN_LIFESPAN,
+            "id_token": self._sign(claims),
+        }
+
+    def _get_userinfo(self, authorization: str) -> Optional[Dict]:
+        user, expiry = self._access_tokens.get(authorization[len("Bearer ") :], (None, 0))
+        if not user or expiry < time.time():
+            return None
+        return {"sub": user.user_id, "email": user.email, "email_verified": True}
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Attribute the network time of a browser flow to the backends it went through."""
+
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+from urllib.parse import urlparse
+
+from oauth_tools.constants import APPS
+
+
+def load_har(path: Union[str, Path]) -> Dict:
+    """Load a HAR file, e.g. recorded by playwright with `record_har_path`.
+
+    Args:
+        path (Union[str, Path]): The path to the HAR file.
+    """
+    return json.loads(Path(path).read_text())
+
+
+def get_backend(url: str, backends: Optional[Dict[str, str]] = None) -> str:
+    """Get the name of the backend that served a URL.
+
+    The identity platform applications are served by traefik under `/<model>-<app>/`,
+    they are recognized by their path. The other URLs are attributed to their host.
+
+    Args:
+        url (str): The URL of the request.
+        backends (Dict[str, str]): The names of other backends, by URL prefix, e.g.
+            `{ext_idp_service.issuer_url: "dex"}`.
+    """
+    for prefix, name in (backends or {}).items():
+        if url.startswith(prefix):
+            return name
+
+    parsed = urlparse(url)
+    segment = parsed.path.lstrip("/").split("/", 1)[0]
+    for app in APPS:
+        if segment.endswith(f"-{app}"):
+            return app
+    return parsed.netloc
+
+
+def _get_path(url: str, backend: str) -> str:
+    path = urlparse(url).path
+    segment, _, rest = path.lstrip("/").partition("/")
+    # Strip the traefik prefix, so that the paths read as the backend's own
+    return f"/{rest}" if segment.endswith(f"-{backend}") else path
+
+
+def get_latency_breakdown(har: Dict, backends: Optional[Dict[str, str]] = None) -> Dict:
+    """Break the time spent in the requests of a HAR down per backend and per path.
+
+    For each backend and path, the number of requests, the total time and the time spent
+    waiting for the server (time to first byte), in milliseconds.
+
+    Args:
+        har (Dict): The HAR, see `load_har`.
+        backends (Dict[str, str]): The names of other backends, see `get_backend`.
+    """
+
+    def new_stats() -> Dict[str, Any]:
+        return {"requests": 0, "time": 0.0, "wait": 0.0}
+
+    breakdown: Dict[str, Dict[str, Any]] = {}
+    paths: Dict[str, Dict[str, Dict[str, Any]]] = defaultdict(lambda: defaultdict(new_stats))
+    for entry in har["log"]["entries"]:
+        url = entry["request"]["url"]
+        backend = get_backend(url, backends)
+        path = f"{entry['request']['method']} {_get_path(url, backend)}"
+        # Unknown HAR timings are -1
+        time = max(entry.get("time", 0), 0)
+        wait = max(entry.get("timings", {}).get("wait", 0), 0)
+        for stats in (breakdown.setdefault(backend, new_stats()), paths[backend][path]):
+            stats["requests"] += 1
+            stats["time"] += time
+            stats["wait"] += wait
+
+    for backend, stats in breakdown.items():
+        stats["paths"] = {path: dict(path_stats) for path, path_stats in paths[backend].items()}
+    return {
+        "time": sum(stats["time"] for stats in breakdown.values()),
+        "backends": breakdown,
+    }
+
+
+def format_latency_breakdown(breakdown: Dict) -> str:
+    """Format a latency breakdown, the slowest backends and paths first.
+
+    Args:
+        breakdown (Dict): The breakdown, see `get_latency_breakdown`.
+    """
+    lines = [f"Total network time: {breakdown['time']:.0f}ms"]
+    backends = sorted(breakdown["backends"].items(), key=lambda item: -item[1]["time"])
+    for backend, stats in backends:
+        lines.append(
+            f"{backend}: {stats['requests']} request(s), {stats['time']:.0f}ms, "
+            f"waiting {stats['wait']:.0f}ms"
+        )
+        for path, path_stats in sorted(stats["paths"].items(), key=lambda item: -item[1]["time"]):
+            lines.append(
+                f"  {path}: {path_stats['requests']} request(s), {path_stats['time']:.0f}ms, "
+                f"waiting {path_stats['wait']:.0f}ms"
+            )
+    return "\n".join(lines)
@@ -2,17 +2,27 @@
 # Copyright 2024 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import hashlib
+import json
 import logging
 import re
+from collections import defaultdict
+from http.cookiejar import Cookie
 from os.path import join
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
 
+import httpx
+import yaml
 from playwright.async_api import expect
 from playwright.async_api._generated import BrowserContext, Page
 from pytest_operator.plugin import OpsTest
 
-from oauth_tools.constants import APPS
+from oauth_tools.constants import APPS, BUNDLE_FINGERPRINT_ANNOTATION
 from oauth_tools.external_idp import ExternalIdpService
+from oauth_tools.instrumentation import get_http_client
+from oauth_tools.timing import timed
+from oauth_tools.tracing import span, traced
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +42,7 @@ async def get_reverse_proxy_app_url(
     return f"https://{address}/{ops_test.model.name}-{app_name}/"
 
 
+@traced()
 async def deploy_identity_bundle(
     ops_test: OpsTest,
     bundle_url: str = "identity-platform",
@@ -44,59 +55,165 @@ async def deploy_identity_bundle(
         ops_test (OpsTest): The ops_test fixture.
         bundle_url (str): The identity platform bundle's name on charmhub or a path to the bundle.
         bundle_channel (str): The charmhub channel to use, not needed deploying the bundle from a local Path.
-        ext_idp_service (ExternalIdpService): The ExternalIdpService.
+            A local bundle is only deployed when it changed since it was last deployed on the
+            model, see `get_bundle_fingerprint`.
+        ext_idp_service (ExternalIdpService): The ExternalIdpService, it is provisioned while
+            the bundle is being deployed.
     """
     if ext_idp_service and not isinstance(ext_idp_service, ExternalIdpService):
         raise ValueError(
             f"Invalid ext_idp_service type: {type(ext_idp_service)}, MUST be ExternalIdpManager or None"
         )
 
-    deploy_cmd = ["juju", "deploy", bundle_url, "--trust"]
-    if bundle_channel:
-        deploy_cmd.extend(["--channel", bundle_channel])
-    await ops_test.run(*deploy_cmd)
+    if ext_idp_service:
+        # The external IdP does not depend on the bundle, deploy them concurrently
+        ext_idp_service.start_provisioning()
+
+    fingerprint = (
+        get_bundle_fingerprint(bundle_url, bundle_channel) if Path(bundle_url).is_file() else None
+    )
+    changed = await _get_changed_applications(ops_test, fingerprint)
+    if changed is not None and not changed:
+        logger.info("The deployed bundle is up to date, skipping the deployment")
+    else:
+        # Deploying a bundle on an existing model only applies the changes
+        deploy_cmd = ["juju", "deploy", bundle_url, "--trust"]
+        if bundle_channel:
+            deploy_cmd.extend(["--channel", bundle_channel])
+        with timed("deploy"):
+            await ops_test.run(*deploy_cmd)
+
+    apps = [app for app in APPS if changed is None or app in changed]
 
     # Wait for apps to go active, kratos_external_idp_integrator needs config to unblock
     if not ext_idp_service:
-        logger.info("Waiting for the identity platform to deploy")
-        await ops_test.model.wait_for_idle(
-            [getattr(APPS, k) for k in APPS._fields if k != "KRATOS_EXTERNAL_IDP_INTEGRATOR"],
-            raise_on_blocked=False,
-            status="active",
-            timeout=2000,
-        )
+        apps = [app for app in apps if app != APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR]
+        if apps:
+            logger.info("Waiting for the identity platform to deploy")
+            with timed("wait_for_idle"):
+                await ops_test.model.wait_for_idle(
+                    apps,
+                    raise_on_blocked=False,
+                    status="active",
+                    timeout=2000,
+                )
+        await _set_bundle_fingerprint(ops_test, fingerprint)
         logger.info("Successfully deployed the identity platform")
         return
 
+    logger.info("Waiting for the external identity provider")
+    with timed("external_idp"):
+        await ext_idp_service.async_wait_until_provisioned()
+
     logger.info("Configuring the identity platform")
-    await ops_test.model.applications[APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR].set_config({
+    integrator = ops_test.model.applications[APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR]
+    config = {
         "client_id": ext_idp_service.client_id,
         "client_secret": ext_idp_service.client_secret,
         "provider": "generic",
         "issuer_url": ext_idp_service.issuer_url,
         "scope": "profile email",
         "provider_id": "Dex",
-    })
-    logger.info("Waiting for the identity platform to deploy")
-    await ops_test.model.wait_for_idle(
-        list(APPS),
-        raise_on_blocked=False,
-        status="active",
-        timeout=2000,
-    )
+    }
+    current_config = await integrator.get_config()
+    if any(current_config.get(key, {}).get("value") != value for key, value in config.items()):
+        with span("set_config", application=APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR):
+            await integrator.set_config(config)
+        apps = list(APPS)
+
+    if apps:
+        logger.info("Waiting for the identity platform to deploy")
+        with timed("wait_for_idle"):
+            await ops_test.model.wait_for_idle(
+                apps,
+                raise_on_blocked=False,
+                status="active",
+                timeout=2000,
+            )
+    await _set_bundle_fingerprint(ops_test, fingerprint)
     logger.info("Successfully deployed the identity platform")
 
-    get_redirect_uri_action = (
-        await ops_test.model.applications[APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR]
-        .units[0]
-        .run_action("get-redirect-uri")
-    )
-
-    action_output = await get_redirect_uri_action.wait()
+    with timed("juju_action"):
+        get_redirect_uri_action = await integrator.units[0].run_action("get-redirect-uri")
+        action_output = await get_redirect_uri_action.wait()
     assert "redirect-uri" in action_output.results
 
     logger.info("Configuring the external provider")
-    ext_idp_service.update_redirect_uri(redirect_uri=action_output.results["redirect-uri"])
+    with span("update_redirect_uri"):
+        await ext_idp_service.async_update_redirect_uri(
+            redirect_uri=action_output.results["redirect-uri"]
+        )
+
+
+def get_bundle_fingerprint(bundle_path: Union[str, Path], channel: Optional[str] = None) -> Dict:
+    """Get the fingerprint of a bundle, to tell whether a model runs it.
+
+    Each application is fingerprinted on its own (charm, revision, resources, options,
+    scale...) so that the applications that changed can be told apart. The content of the
+    local charms and resources is fingerprinted, rather than their path.
+
+    Args:
+        bundle_path (Union[str, Path]): The path to the bundle, e.g. rendered by
+            `ops_test.render_bundle`.
+        channel (str): The channel the bundle is deployed with, if any.
+    """
+    bundle_path = Path(bundle_path)
+    bundle = yaml.safe_load(bundle_path.read_text())
+
+    def file_digest(value: Any) -> Any:
+        path = bundle_path.parent / str(value)
+        if isinstance(value, str) and path.is_file():
+            return hashlib.sha256(path.read_bytes()).hexdigest()
+        return value
+
+    applications = {}
+    for name, app in (bundle.get("applications") or bundle.get("services") or {}).items():
+        app = dict(app, charm=file_digest(app.get("charm")))
+        if "resources" in app:
+            app["resources"] = {k: file_digest(v) for k, v in app["resources"].items()}
+        applications[name] = _get_digest({"application": app, "channel": channel})
+
+    relations = sorted(sorted(relation) for relation in bundle.get("relations") or [])
+    return {"applications": applications, "relations": _get_digest(relations)}
+
+
+def _get_digest(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+async def _get_changed_applications(
+    ops_test: OpsTest, fingerprint: Optional[Dict]
+) -> Optional[List[str]]:
+    """Get the applications that changed since the bundle was last deployed on the model.
+
+    None means that everything is to be deployed.
+    """
+    if not fingerprint:
+        return None
+    annotations = await ops_test.model.get_annotations()
+    try:
+        deployed = json.loads(annotations[BUNDLE_FINGERPRINT_ANNOTATION])
+    except (KeyError, ValueError):
+        return None
+    if deployed.get("relations") != fingerprint["relations"]:
+        return None
+
+    deployed_apps = deployed.get("applications", {})
+    changed = [
+        app
+        for app, digest in fingerprint["applications"].items()
+        if deployed_apps.get(app) != digest or app not in ops_test.model.applications
+    ]
+    if changed:
+        logger.info(f"The bundle changed for {', '.join(changed)}")
+    return changed
+
+
+async def _set_bundle_fingerprint(ops_test: OpsTest, fingerprint: Optional[Dict]) -> None:
+    if fingerprint:
+        await ops_test.model.set_annotations({
+            BUNDLE_FINGERPRINT_ANNOTATION: json.dumps(fingerprint, sort_keys=True)
+        })
 
 
 async def clean_up_identity_bundle(
@@ -112,7 +229,7 @@ async def clean_up_identity_bundle(
     for app in APPS:
         await ops_test.model.remove_application(app, destroy_storage=True, no_wait=True)
     if ext_idp_service:
-        ext_idp_service.remove_idp_service()
+        await ext_idp_service.async_remove_idp_service()
 
 
 async def access_application_login_page(
@@ -157,6 +274,7 @@ async def click_on_sign_in_button_by_alt_text(page: Page, alt_text: str):
         await page.get_by_alt_text(alt_text).click()
 
 
+@traced()
 async def complete_auth_code_login(
     page: Page, ops_test: OpsTest, ext_idp_service: ExternalIdpService
 ) -> None:
@@ -178,15 +296,18 @@ async def complete_auth_code_login(
         ),
         "ui/login",
     )
-    logger.info("Choose external provider")
-    await expect(page).to_have_url(re.compile(rf"{expected_url}*"))
-    async with page.expect_navigation():
-        await page.get_by_role("button", name="Dex").click()
+    with timed("browser_login"):
+        logger.info("Choose external provider")
+        await expect(page).to_have_url(re.compile(rf"{expected_url}*"))
+        async with page.expect_navigation():
+            await page.get_by_role("button", name="Dex").click()
 
-    logger.info("Completing the login flow on the external provider")
-    await ext_idp_service.complete_user_login(page)
+        logger.info("Completing the login flow on the external provider")
+        with span("external_idp_login", idp=type(ext_idp_service).__name__):
+            await ext_idp_service.complete_user_login(page)
 
 
+@traced()
 async def complete_device_login(
     page: Page,
     ops_test: OpsTest,
@@ -211,8 +332,9 @@ async def complete_device_login(
     await expect(page).to_have_url(re.compile(rf"{expected_url}*"))
 
     logger.info("Accepting the user code")
-    async with page.expect_navigation():
-        await page.get_by_role("button", name="Next").click()
+    with span("accept_user_code"):
+        async with page.expect_navigation():
+            await page.get_by_role("button", name="Next").click()
 
     await complete_auth_code_login(page, ops_test, ext_idp_service=ext_idp_service)
 
@@ -245,10 +367,9 @@ async def get_cookie_from_browser_by_name(
         browser_context (BrowserContext): The browser_context fixture.
         name (str): The cookie name.
     """
-    cookies = await browser_context.cookies()
-    for cookie in cookies:
-        if cookie["name"] == name:
-            return cookie["value"]
+    for cookies in index_cookies_by_domain(await browser_context.cookies()).values():
+        if name in cookies:
+            return cookies[name]["value"]
     return None
 
 
@@ -265,9 +386,78 @@ async def get_cookies_from_browser_by_url(browser_context: BrowserContext, url:
     return cookies
 
 
+def index_cookies_by_domain(cookies: Iterable[Dict]) -> Dict[str, Dict[str, Dict]]:
+    """Index a list of browser cookies by domain and name.
+
+    Args:
+        cookies (Iterable[Dict]): The cookies, as returned by `BrowserContext.cookies`.
+    """
+    index: Dict[str, Dict[str, Dict]] = defaultdict(dict)
+    for cookie in cookies:
+        index[cookie["domain"].lstrip(".")][cookie["name"]] = cookie
+    return dict(index)
+
+
+def _to_jar_cookie(cookie: Dict) -> Cookie:
+    """Convert a browser cookie to a cookiejar cookie, keeping its attributes.
+
+    Args:
+        cookie (Dict): The cookie, as returned by `BrowserContext.cookies`.
+    """
+    domain = cookie["domain"]
+    # Playwright uses -1 for session cookies
+    expires = cookie.get("expires", -1)
+    return Cookie(
+        version=0,
+        name=cookie["name"],
+        value=cookie["value"],
+        port=None,
+        port_specified=False,
+        domain=domain,
+        domain_specified=bool(domain),
+        domain_initial_dot=domain.startswith("."),
+        path=cookie["path"],
+        path_specified=True,
+        secure=cookie.get("secure", False),
+        expires=int(expires) if expires >= 0 else None,
+        discard=expires < 0,
+        comment=None,
+        comment_url=None,
+        rest={"HttpOnly": None} if cookie.get("httpOnly") else {},
+    )
+
+
+async def get_http_client_from_browser(
+    browser_context: BrowserContext,
+    urls: Optional[List[str]] = None,
+    verify: Union[bool, str] = True,
+    **kwargs: Any,
+) -> httpx.Client:
+    """Create an HTTP client that shares the browser's cookies.
+
+    Use this to continue a flow with plain HTTP requests once the interactive part of it
+    (e.g. logging in) has been completed in the browser. The returned client pools its
+    connections, it is up to the caller to close it. The cookies keep their secure and
+    httpOnly attributes, so secure cookies are only sent over https.
+
+    Args:
+        browser_context (BrowserContext): The browser_context fixture.
+        urls (List[str]): If provided, only export the cookies that apply to these urls.
+        verify (Union[bool, str]): Whether to verify the server's certificate, or the path to
+            a CA bundle. Pass False for the self-signed certificates of a test deployment.
+        kwargs (Any): Extra arguments for the `httpx.Client`, see `get_http_client`.
+    """
+    browser_cookies = await (browser_context.cookies(urls) if urls else browser_context.cookies())
+    cookies = httpx.Cookies()
+    for cookie in browser_cookies:
+        cookies.jar.set_cookie(_to_jar_cookie(cookie))
+    return get_http_client(cookies=cookies, verify=verify, **kwargs)
+
+
 __all__ = [
     "get_reverse_proxy_app_url",
     "deploy_identity_bundle",
+    "get_bundle_fingerprint",
     "clean_up_identity_bundle",
     "access_application_login_page",
     "click_on_sign_in_button_by_text",
@@ -277,4 +467,6 @@ __all__ = [
     "verify_page_loads",
     "get_cookie_from_browser_by_name",
     "get_cookies_from_browser_by_url",
+    "index_cookies_by_domain",
+    "get_http_client_from_browser",
 ]
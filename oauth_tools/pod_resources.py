@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Sample the CPU, memory and container restarts of the pods of a namespace.
+
+The usage is read from the metrics API (`metrics.k8s.io`, served by metrics-server), the
+restarts from the pods' status. The samples are aggregated per component (hydra, kratos,
+postgresql-k8s...) to relate their resources to a load, e.g. a token throughput:
+
+    with PodResourceSampler(client, ops_test.model.name, interval=2.0) as sampler:
+        result = await measure_token_throughput(...)
+    logger.info(sampler.format())
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from lightkube import Client
+from lightkube.core.exceptions import ApiError
+from lightkube.generic_resource import create_namespaced_resource
+from lightkube.resources.core_v1 import Pod
+
+logger = logging.getLogger(__name__)
+
+PodMetrics = create_namespaced_resource("metrics.k8s.io", "v1beta1", "PodMetrics", "pods")
+
+# The label juju sets on the pods of an application
+APP_LABEL = "app.kubernetes.io/name"
+
+_QUANTITY = re.compile(r"^([0-9.]+)([a-zA-Z]*)$")
+_MULTIPLIERS = {
+    "": 1,
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+}
+
+
+class ResourceSample(NamedTuple):
+    """The resources of a component at a point in time.
+
+    `time` is in seconds since the sampler started, `cpu` in cores, `memory` in bytes and
+    `restarts` is the total number of container restarts. `cpu` and `memory` are None when
+    the metrics API is not available.
+    """
+
+    time: float
+    pods: int
+    cpu: Optional[float]
+    memory: Optional[int]
+    restarts: int
+
+
+def parse_quantity(quantity: str) -> float:
+    """Parse a Kubernetes quantity, e.g. "250m" or "128974848n" cores or "64Mi" bytes.
+
+    Args:
+        quantity (str): The quantity.
+    """
+    match = _QUANTITY.match(quantity)
+    if not match or match.group(2) not in _MULTIPLIERS:
+        raise ValueError(f"Invalid quantity: {quantity}")
+    return float(match.group(1)) * _MULTIPLIERS[match.group(2)]
+
+
+def _get_component(metadata: Any) -> str:
+    labels = metadata.labels or {}
+    # The pods of a statefulset are named <app>-<ordinal>
+    return labels.get(APP_LABEL) or metadata.name.rsplit("-", 1)[0]
+
+
+class PodResourceSampler:
+    """Sample the resources of the pods of a namespace, in a background thread."""
+
+    def __init__(
+        self,
+        client: Client,
+        namespace: str,
+        interval: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """Create a sampler, `start` it or use it as a context manager.
+
+        Args:
+            client (Client): The lightkube client, or any object with the same `list` method,
+                e.g. a fake metrics API.
+            namespace (str): The namespace of the pods, i.e. the name of the juju model.
+            interval (float): The number of seconds between two samples.
+            clock (Callable[[], float]): The clock of the samples' time.
+        """
+        self.client = client
+        self.namespace = namespace
+        self.interval = interval
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._metrics_available = True
+        self._series: Dict[str, List[ResourceSample]] = defaultdict(list)
+        # The last restart count of each pod, by uid, and the restarts of each component
+        # while sampled
+        self._pod_restarts: Dict[str, int] = {}
+        self._restarts: Dict[str, int] = defaultdict(int)
+        self._sampled = False
+
+    def sample(self) -> Dict[str, ResourceSample]:
+        """Take a sample of each component now, and add it to the series."""
+        now = self._clock() - self._start
+        pods: Dict[str, int] = defaultdict(int)
+        restarts: Dict[str, int] = defaultdict(int)
+        pod_restarts: Dict[str, Tuple[str, int]] = {}
+        for pod in self.client.list(Pod, namespace=self.namespace):
+            component = _get_component(pod.metadata)
+            pods[component] += 1
+            statuses = (pod.status.containerStatuses if pod.status else None) or []
+            count = sum(status.restartCount for status in statuses)
+            restarts[component] += count
+            pod_restarts[pod.metadata.uid or pod.metadata.name] = (component, count)
+
+        usage = self._get_usage()
+        samples = {
+            component: ResourceSample(
+                time=now,
+                pods=count,
+                cpu=usage[component][0] if usage is not None else None,
+                memory=int(usage[component][1]) if usage is not None else None,
+                restarts=restarts[component],
+            )
+            for component, count in pods.items()
+        }
+        with self._lock:
+            self._add_restarts(pod_restarts)
+            for component, sample in samples.items():
+                self._series[component].append(sample)
+        return samples
+
+    def _add_restarts(self, pod_restarts: Dict[str, Tuple[str, int]]) -> None:
+        # The restart count of a recreated pod starts from 0 again, so the restarts are
+        # counted per pod rather than from the total of the component
+        first_sample = not self._sampled
+        self._sampled = True
+        for uid, (component, count) in pod_restarts.items():
+            previous = self._pod_restarts.get(uid)
+            if previous is None:
+                # A pod created while sampled restarted while sampled
+                previous = count if first_sample else 0
+            self._restarts[component] += count - previous if count >= previous else count
+            self._pod_restarts[uid] = count
+
+    def _get_usage(self) -> Optional[Dict[str, List[float]]]:
+        if not self._metrics_available:
+            return None
+        usage: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+        try:
+            for metrics in self.client.list(PodMetrics, namespace=self.namespace):
+                component = _get_component(metrics.metadata)
+                for container in metrics["containers"]:
+                    usage[component][0] += parse_quantity(container["usage"]["cpu"])
+                    usage[component][1] += parse_quantity(container["usage"]["memory"])
+        except ApiError as e:
+            # Only the restarts are sampled when metrics-server is not deployed
+            logger.warning(f"The metrics API is not available, not sampling the usage: {e}")
+            self._metrics_available = False
+            return None
+        return usage
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+            except Exception:
+                logger.exception("Failed to sample the pod resources")
+            self._stopped.wait(self.interval)
+
+    def start(self) -> None:
+        """Start sampling in the background."""
+        if self._thread:
+            raise RuntimeError("The sampler is already started")
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="pod-resources", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling, after a last sample."""
+        if not self._thread:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self.sample()
+
+    def __enter__(self) -> "PodResourceSampler":
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def series(self) -> Dict[str, Dict[str, List]]:
+        """Get the time series of each component, one list per field of `ResourceSample`."""
+        with self._lock:
+            return {
+                component: {
+                    field: [getattr(sample, field) for sample in samples]
+                    for field in ResourceSample._fields
+                }
+                for component, samples in self._series.items()
+            }
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Get the mean and peak usage of each component and its restarts while sampled.
+
+        The restarts are summed per pod, those of the pods recreated while sampled included.
+        """
+        with self._lock:
+            restarts = dict(self._restarts)
+        summary = {}
+        for component, series in self.series().items():
+            cpu = [value for value in series["cpu"] if value is not None]
+            memory = [value for value in series["memory"] if value is not None]
+            summary[component] = {
+                "pods": max(series["pods"]),
+                "cpu_mean": sum(cpu) / len(cpu) if cpu else None,
+                "cpu_max": max(cpu, default=None),
+                "memory_max": max(memory, default=None),
+                "restarts": restarts.get(component, 0),
+            }
+        return summary
+
+    def format(self) -> str:
+        """Format the summary, one component per line."""
+        lines = []
+        for component, stats in sorted(self.summary().items()):
+            line = f"{component}: {stats['pods']} pod(s), {stats['restarts']} restart(s)"
+            if stats["cpu_mean"] is not None:
+                line += (
+                    f", cpu mean {stats['cpu_mean'] * 1000:.0f}m max "
+                    f"{stats['cpu_max'] * 1000:.0f}m, memory max "
+                    f"{stats['memory_max'] / 2**20:.0f}Mi"
+                )
+            lines.append(line)
+        return "\n".join(lines)
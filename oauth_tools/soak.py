@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keep a population of sessions refreshing their tokens for hours, and watch for drift.
+
+Each session refreshes its token every `refresh_interval` seconds, give or take a jitter,
+like a long-lived client would. The refreshes are grouped in time windows to track the
+latency over the run, flag an upward trend and find the bursts of errors:
+
+    result = await run_refresh_soak(
+        hydra_url, client_id, client_secret, refresh_tokens, duration=4 * 3600
+    )
+    logger.info(result.format())
+    assert not result.summary()["latency_trend"]["flagged"]
+"""
+
+import asyncio
+import logging
+import random
+from os.path import join
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+import httpx
+
+from oauth_tools.instrumentation import get_async_http_client
+
+logger = logging.getLogger(__name__)
+
+
+class SoakSample(NamedTuple):
+    """A refresh of a session, `time` is in seconds since the start of the soak.
+
+    `error_kind` is "connect" when the request could not be sent, and "read" when it was
+    sent but its response was lost.
+    """
+
+    time: float
+    session: int
+    latency: float
+    status: Optional[int]
+    error: Optional[str] = None
+    error_kind: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        """Whether the refresh did not issue a new token."""
+        return self.status != 200
+
+
+class SoakWindow(NamedTuple):
+    """The refreshes of a time window, the latencies are in seconds."""
+
+    start: float
+    requests: int
+    errors: int
+    p50: float
+    p95: float
+
+
+def _percentile(values: Sequence[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class SoakResult(NamedTuple):
+    """The outcome of a refresh token soak."""
+
+    sessions: int
+    duration: float
+    samples: Sequence[SoakSample]
+    broken_sessions: int
+    lost_sessions: int = 0
+
+    def windows(self, window: float = 300.0) -> List[SoakWindow]:
+        """Group the refreshes in consecutive time windows.
+
+        Args:
+            window (float): The length of the windows, in seconds.
+        """
+        buckets: Dict[int, List[SoakSample]] = {}
+        for sample in self.samples:
+            buckets.setdefault(int(sample.time // window), []).append(sample)
+        windows = []
+        for index, samples in sorted(buckets.items()):
+            latencies = [sample.latency for sample in samples if not sample.failed]
+            windows.append(
+                SoakWindow(
+                    start=index * window,
+                    requests=len(samples),
+                    errors=sum(sample.failed for sample in samples),
+                    p50=_percentile(latencies, 50),
+                    p95=_percentile(latencies, 95),
+                )
+            )
+        return windows
+
+    def get_latency_trend(self, window: float = 300.0) -> Optional[Dict[str, float]]:
+        """Fit a line through the median latency of the windows.
+
+        Returns the slope, in seconds per hour, and the drift: the relative increase of the
+        fitted latency from the start to the end of the soak. None if there are fewer than
+        3 windows.
+
+        Args:
+            window (float): The length of the windows, in seconds.
+        """
+        points = [
+            (start + window / 2, p50)
+            for start, requests, errors, p50, _ in self.windows(window)
+            if requests > errors
+        ]
+        if len(points) < 3:
+            return None
+
+        mean_time = sum(time for time, _ in points) / len(points)
+        mean_latency = sum(latency for _, latency in points) / len(points)
+        variance = sum((time - mean_time) ** 2 for time, _ in points)
+        slope = (
+            sum((time - mean_time) * (latency - mean_latency) for time, latency in points)
+            / variance
+        )
+        first, last = points[0][0], points[-1][0]
+        start_latency = mean_latency + slope * (first - mean_time)
+        end_latency = mean_latency + slope * (last - mean_time)
+        return {
+            "slope": slope * 3600,
+            "drift": (end_latency - start_latency) / start_latency if start_latency > 0 else 0.0,
+        }
+
+    def get_error_bursts(self, window: float = 300.0, min_errors: int = 3) -> List[SoakWindow]:
+        """Get the windows with at least `min_errors` failed refreshes.
+
+        Args:
+            window (float): The length of the windows, in seconds.
+            min_errors (int): The number of errors from which a window is a burst.
+        """
+        return [w for w in self.windows(window) if w.errors >= min_errors]
+
+    def summary(
+        self, window: float = 300.0, trend_threshold: float = 0.2, min_errors: int = 3
+    ) -> Dict[str, Any]:
+        """Summarize the soak and flag an upward latency trend.
+
+        Args:
+            window (float): The length of the windows, in seconds.
+            trend_threshold (float): The latency drift over which the trend is flagged, e.g.
+                0.2 when the median latency grew by more than 20% over the soak.
+            min_errors (int): The number of errors from which a window is a burst.
+        """
+        latencies = [sample.latency for sample in self.samples if not sample.failed]
+        trend = self.get_latency_trend(window)
+        return {
+            "sessions": self.sessions,
+            "broken_sessions": self.broken_sessions,
+            "lost_sessions": self.lost_sessions,
+            "duration": self.duration,
+            "requests": len(self.samples),
+            "errors": sum(sample.failed for sample in self.samples),
+            "connect_errors": sum(sample.error_kind == "connect" for sample in self.samples),
+            "read_errors": sum(sample.error_kind == "read" for sample in self.samples),
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "latency_trend": dict(
+                trend or {"slope": 0.0, "drift": 0.0},
+                flagged=bool(trend and trend["drift"] > trend_threshold),
+            ),
+            "error_bursts": [
+                burst._asdict() for burst in self.get_error_bursts(window, min_errors)
+            ],
+        }
+
+    def format(self, window: float = 300.0, trend_threshold: float = 0.2) -> str:
+        """Format the summary and the latency of each window.
+
+        Args:
+            window (float): The length of the windows, in seconds.
+            trend_threshold (float): The latency drift over which the trend is flagged.
+        """
+        summary = self.summary(window, trend_threshold)
+        trend = summary["latency_trend"]
+        lines = [
+            f"{summary['sessions']} session(s) for {summary['duration'] / 60:.0f}min: "
+            f"{summary['requests']} refresh(es), {summary['errors']} error(s) "
+            f"({summary['connect_errors']} connect, {summary['read_errors']} read), "
+            f"{summary['broken_sessions']} broken session(s), "
+            f"{summary['lost_sessions']} lost session(s), "
+            f"p50 {summary['p50'] * 1000:.0f}ms, p95 {summary['p95'] * 1000:.0f}ms",
+            f"Latency trend: {trend['slope'] * 1000:+.1f}ms/h, {trend['drift']:+.0%} over the soak"
+            + (" (UPWARD TREND)" if trend["flagged"] else ""),
+        ]
+        bursts = {burst["start"] for burst in summary["error_bursts"]}
+        for w in self.windows(window):
+            lines.append(
+                f"  {w.start / 60:6.0f}min: {w.requests} refresh(es), {w.errors} error(s), "
+                f"p50 {w.p50 * 1000:.0f}ms, p95 {w.p95 * 1000:.0f}ms"
+                + (" (ERROR BURST)" if w.start in bursts else "")
+            )
+        return "\n".join(lines)
+
+
+async def run_refresh_soak(
+    hydra_url: str,
+    client_id: str,
+    client_secret: str,
+    refresh_tokens: List[str],
+    duration: float,
+    refresh_interval: float = 60.0,
+    jitter: float = 0.2,
+    progress_interval: float = 600.0,
+    http2: bool = False,
+) -> SoakResult:
+    """Refresh the tokens of a population of sessions for `duration` seconds.
+
+    There is a session per refresh token, it carries on with the token it was last issued.
+    A session is broken when hydra rejects its token, e.g. because the rotation lost it,
+    the other sessions keep refreshing. The sessions start staggered over the first interval.
+
+    A refresh that could not connect did not consume the token, it is retried at the next
+    interval. A refresh whose response was lost may have rotated the token, retrying it
+    could be taken for a token reuse by hydra, so the session ends and is counted as lost
+    rather than broken.
+
+    Args:
+        hydra_url (str): The public URL of hydra.
+        client_id (str): The client_id of the client the tokens were issued to.
+        client_secret (str): The client_secret of the client.
+        refresh_tokens (List[str]): The refresh tokens, one per session.
+        duration (float): The number of seconds to soak for.
+        refresh_interval (float): The mean number of seconds between two refreshes of a
+            session.
+        jitter (float): The relative variation of the refresh interval.
+        progress_interval (float): The number of seconds between two progress logs.
+        http2 (bool): Whether to send the requests over HTTP/2, see `measure_token_throughput`.
+    """
+    url = join(hydra_url, "oauth2/token")
+    samples: List[SoakSample] = []
+    broken_sessions = lost_sessions = 0
+    start = monotonic()
+    deadline = start + duration
+
+    async def session(http_client: httpx.AsyncClient, index: int, refresh_token: str) -> None:
+        nonlocal broken_sessions, lost_sessions
+        await asyncio.sleep(random.uniform(0, min(refresh_interval, duration)))
+        while monotonic() < deadline:
+            sent = monotonic()
+            data = {"grant_type": "refresh_token", "refresh_token": refresh_token}
+            try:
+                resp = await http_client.post(url, data=data)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # The request was not sent, the token is refreshed again at the next interval
+                samples.append(
+                    SoakSample(sent - start, index, monotonic() - sent, None, repr(e), "connect")
+                )
+            except httpx.HTTPError as e:
+                # Hydra may have rotated the token, the session cannot tell which one is valid
+                samples.append(
+                    SoakSample(sent - start, index, monotonic() - sent, None, repr(e), "read")
+                )
+                logger.warning(f"Session {index} lost the response of a refresh: {e!r}")
+                lost_sessions += 1
+                return
+            else:
+                samples.append(
+                    SoakSample(sent - start, index, monotonic() - sent, resp.status_code)
+                )
+                if resp.status_code == 200:
+                    refresh_token = resp.json()["refresh_token"]
+                elif resp.status_code < 500:
+                    logger.warning(f"Session {index} broke: {resp.status_code} {resp.text}")
+                    broken_sessions += 1
+                    return
+            interval = refresh_interval * random.uniform(1 - jitter, 1 + jitter)
+            await asyncio.sleep(max(min(interval, deadline - monotonic()), 0))
+
+    async def report_progress() -> None:
+        while True:
+            await asyncio.sleep(progress_interval)
+            result = SoakResult(
+                len(refresh_tokens), monotonic() - start, samples, broken_sessions, lost_sessions
+            )
+            summary = result.summary(window=progress_interval)
+            logger.info(
+                f"Soak at {summary['duration'] / 60:.0f}min: {summary['requests']} refresh(es), "
+                f"{summary['errors']} error(s), p50 {summary['p50'] * 1000:.0f}ms, "
+                f"drift {summary['latency_trend']['drift']:+.0%}"
+            )
+
+    async with get_async_http_client(
+        auth=(client_id, client_secret), verify=False, http2=http2
+    ) as http_client:
+        progress = asyncio.ensure_future(report_progress())
+        try:
+            await asyncio.gather(
+                *(session(http_client, index, token) for index, token in enumerate(refresh_tokens))
+            )
+        finally:
+            progress.cancel()
+
+    return SoakResult(
+        sessions=len(refresh_tokens),
+        duration=monotonic() - start,
+        samples=sorted(samples, key=lambda sample: sample.time),
+        broken_sessions=broken_sessions,
+        lost_sessions=lost_sessions,
+    )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Pytest plugin reporting the time spent in each phase of the tests.
+
+The helpers time their phases (deploy, wait_for_idle, browser login...) with `timed`, tests
+can time their own phases too. The timings are aggregated per test and phase and written
+to a JSON report, which can be compared to a baseline report to flag regressions:
+
+    pytest_plugins = ["oauth_tools.fixtures", "oauth_tools.timing"]
+
+    pytest --phase-timings report.json --phase-timings-baseline baseline.json ...
+"""
+
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Generator, Iterable, List, NamedTuple, Optional
+
+import pytest
+
+from oauth_tools.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# The key of the phases timed outside of a test
+SESSION = "session"
+
+_current_test = SESSION
+_timings: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+_report_key = pytest.StashKey[Dict]()
+# The timings sent by the pytest-xdist workers to the controller
+_worker_timings_key = pytest.StashKey[List[Dict[str, Dict[str, float]]]]()
+WORKER_OUTPUT = "phase_timings"
+
+
+class PhaseRegression(NamedTuple):
+    """A phase of a test that got slower than in the baseline."""
+
+    test: str
+    phase: str
+    baseline: float
+    duration: float
+
+
+@contextmanager
+def timed(phase: str) -> Generator[None, None, None]:
+    """Time a phase of the current test, it is recorded as a span too.
+
+    The durations of the phases that run several times in a test are added up. It can be
+    used in coroutines, around the awaited calls.
+
+    Args:
+        phase (str): The name of the phase, e.g. "wait_for_idle".
+    """
+    test = _current_test
+    start = time.monotonic()
+    try:
+        with span(phase):
+            yield
+    finally:
+        _timings[test][phase] += time.monotonic() - start
+
+
+def get_timings() -> Dict[str, Dict[str, float]]:
+    """Get the seconds spent in each phase, per test."""
+    return {test: dict(phases) for test, phases in _timings.items()}
+
+
+def merge_timings(
+    all_timings: Iterable[Dict[str, Dict[str, float]]],
+) -> Dict[str, Dict[str, float]]:
+    """Merge the timings of several processes, e.g. of the pytest-xdist workers.
+
+    The durations of the phases timed in several processes, e.g. outside of a test, are
+    added up.
+
+    Args:
+        all_timings (Iterable[Dict]): The timings of each process, see `get_timings`.
+    """
+    merged: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for timings in all_timings:
+        for test, phases in timings.items():
+            for phase, duration in phases.items():
+                merged[test][phase] += duration
+    return {test: dict(phases) for test, phases in merged.items()}
+
+
+def compare_timings(
+    timings: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float = 0.2,
+    min_seconds: float = 1.0,
+) -> List[PhaseRegression]:
+    """Get the phases that got slower than in the baseline.
+
+    Args:
+        timings (Dict): The timings of the run, see `get_timings`.
+        baseline (Dict): The timings of the baseline run.
+        threshold (float): The relative slowdown over which a phase regressed.
+        min_seconds (float): The absolute slowdown under which a phase is considered noise.
+    """
+    regressions = []
+    for test, phases in timings.items():
+        for phase, duration in phases.items():
+            previous = baseline.get(test, {}).get(phase)
+            if previous is None:
+                continue
+            if duration > previous * (1 + threshold) and duration - previous > min_seconds:
+                regressions.append(PhaseRegression(test, phase, previous, duration))
+    return regressions
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    group = parser.getgroup("oauth-tools phase timings")
+    group.addoption(
+        "--phase-timings",
+        metavar="PATH",
+        help="Write the time spent in each phase of the tests to a JSON report",
+    )
+    group.addoption(
+        "--phase-timings-baseline",
+        metavar="PATH",
+        help="Compare the phase timings to those of a previous JSON report",
+    )
+    group.addoption(
+        "--phase-timings-threshold",
+        type=float,
+        default=0.2,
+        help="The relative slowdown over which a phase is flagged as a regression",
+    )
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item: pytest.Item) -> Generator[None, None, None]:
+    global _current_test
+    _current_test = item.nodeid
+    try:
+        yield
+    finally:
+        _current_test = SESSION
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node: Any, error: Any) -> None:
+    """Collect the timings of a pytest-xdist worker on the controller."""
+    timings = getattr(node, "workeroutput", {}).get(WORKER_OUTPUT)
+    if timings:
+        node.config.stash.setdefault(_worker_timings_key, []).append(timings)
+
+
+def pytest_sessionfinish(session: pytest.Session) -> None:
+    config = session.config
+    path: Optional[str] = config.getoption("phase_timings")
+    baseline_path: Optional[str] = config.getoption("phase_timings_baseline")
+    if not path and not baseline_path:
+        return
+
+    if hasattr(config, "workeroutput"):
+        # Each pytest-xdist worker runs its own tests, the controller merges their timings
+        config.workeroutput[WORKER_OUTPUT] = get_timings()
+        return
+
+    timings = merge_timings([get_timings(), *config.stash.get(_worker_timings_key, [])])
+    report: Dict = {"created": time.time(), "tests": timings}
+    if baseline_path:
+        baseline = json.loads(Path(baseline_path).read_text())
+        regressions = compare_timings(
+            timings, baseline["tests"], config.getoption("phase_timings_threshold")
+        )
+        report["regressions"] = [regression._asdict() for regression in regressions]
+    config.stash[_report_key] = report
+
+    if path:
+        Path(path).write_text(json.dumps(report, indent=2, sort_keys=True))
+        logger.info(f"Wrote the phase timings to {path}")
+
+
+def pytest_terminal_summary(terminalreporter: pytest.TerminalReporter) -> None:
+    report = terminalreporter.config.stash.get(_report_key, None)
+    if not report or "regressions" not in report:
+        return
+
+    terminalreporter.write_sep("=", "phase timing regressions")
+    if not report["regressions"]:
+        terminalreporter.write_line("No phase got slower than the baseline")
+    for regression in report["regressions"]:
+        terminalreporter.write_line(
+            f"{regression['test']} {regression['phase']}: "
+            f"{regression['baseline']:.1f}s -> {regression['duration']:.1f}s",
+            yellow=True,
+        )
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Nested timed spans of the oauth_tools flows.
+
+The helpers open spans around their steps (deploy, wait_for_idle, set_config, login...),
+the spans opened while another one is open are its children. Spans are only recorded when
+an exporter is registered with `add_span_exporter`. `ChromeTraceExporter` writes them to a
+file in the Chrome trace event format, open it in https://ui.perfetto.dev or
+chrome://tracing. As a pytest plugin, `--trace-spans PATH` exports the spans of the run,
+nested under a span per test:
+
+    pytest_plugins = ["oauth_tools.fixtures", "oauth_tools.tracing"]
+"""
+
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import pytest
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Span(NamedTuple):
+    """A timed step of a flow, `start` is a UNIX timestamp and `duration` in seconds."""
+
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    start: float
+    duration: float
+    thread_id: int
+    task_id: Optional[int]
+    attributes: Dict[str, Any]
+    error: Optional[str] = None
+
+
+SpanExporter = Callable[[Span], None]
+
+_exporters: List[SpanExporter] = []
+_span_ids = itertools.count(1)
+_current_span: ContextVar[Optional[int]] = ContextVar("oauth_tools_span", default=None)
+_exporter_key = pytest.StashKey["ChromeTraceExporter"]()
+
+
+def add_span_exporter(exporter: SpanExporter) -> None:
+    """Register an exporter, it is called with every span once it ends.
+
+    Args:
+        exporter (SpanExporter): The exporter, it must be thread safe.
+    """
+    _exporters.append(exporter)
+
+
+def remove_span_exporter(exporter: SpanExporter) -> None:
+    """Unregister an exporter.
+
+    Args:
+        exporter (SpanExporter): The exporter.
+    """
+    _exporters.remove(exporter)
+
+
+def _get_task_id() -> Optional[int]:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return None
+    return id(task) if task else None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Generator[None, None, None]:
+    """Record a span around a step of a flow.
+
+    It can be used in coroutines, around the awaited calls. The spans of the coroutines
+    gathered in a span are its children.
+
+    Args:
+        name (str): The name of the step, e.g. "wait_for_idle".
+        attributes (Any): Details of the step, they must be JSON serializable.
+    """
+    if not _exporters:
+        yield
+        return
+
+    span_id = next(_span_ids)
+    parent_id = _current_span.get()
+    token = _current_span.set(span_id)
+    start, start_time = time.monotonic(), time.time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        _export(
+            Span(
+                name=name,
+                span_id=span_id,
+                parent_id=parent_id,
+                start=start_time,
+                duration=time.monotonic() - start,
+                thread_id=threading.get_ident(),
+                task_id=_get_task_id(),
+                attributes=attributes,
+                error=error,
+            )
+        )
+
+
+def _export(span: Span) -> None:
+    for exporter in list(_exporters):
+        try:
+            exporter(span)
+        except Exception:
+            logger.exception(f"Span exporter {exporter} failed")
+
+
+def traced(name: Optional[str] = None) -> Callable[[F], F]:
+    """Decorate a function or a coroutine function to record a span around its calls.
+
+    Args:
+        name (str): The name of the span, the function's name by default.
+    """
+
+    def decorator(func: F) -> F:
+        span_name = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper  # type: ignore[return-value]
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+class ChromeTraceExporter:
+    """An exporter writing the spans to a Chrome trace event format file.
+
+    Each thread and asyncio task gets its own track, so that concurrent spans do not
+    overlap. The file is only written by `write`.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Create an exporter.
+
+        Args:
+            path (Union[str, Path]): The path of the trace file.
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._events: List[Dict[str, Any]] = []
+        self._tracks: Dict[Tuple[int, Optional[int]], int] = {}
+
+    def __call__(self, span: Span) -> None:
+        """Add a span to the trace."""
+        with self._lock:
+            track = self._tracks.setdefault((span.thread_id, span.task_id), len(self._tracks) + 1)
+            self._events.append({
+                "name": span.name,
+                "cat": "oauth_tools",
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": os.getpid(),
+                "tid": track,
+                "args": dict(
+                    span.attributes,
+                    span_id=span.span_id,
+                    parent_id=span.parent_id,
+                    **({"error": span.error} if span.error else {}),
+                ),
+            })
+
+    def write(self) -> None:
+        """Write the spans recorded so far to the trace file."""
+        with self._lock:
+            events = list(self._events)
+            tracks = dict(self._tracks)
+        for (thread_id, task_id), track in tracks.items():
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": track,
+                "args": {"name": f"thread {thread_id}" + (f" task {task_id}" if task_id else "")},
+            })
+
+        # The trace is replaced atomically, it can be opened while the tests are running
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+        tmp_path.replace(self.path)
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    group = parser.getgroup("oauth-tools tracing")
+    group.addoption(
+        "--trace-spans",
+        metavar="PATH",
+        help="Write the spans of the run to a Chrome trace event format file",
+    )
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    path = config.getoption("trace_spans", None)
+    if not path:
+        return
+    # Each pytest-xdist worker runs its own tests, they write their own trace
+    worker = getattr(config, "workerinput", {}).get("workerid")
+    exporter = ChromeTraceExporter(f"{path}.{worker}" if worker else path)
+    add_span_exporter(exporter)
+    config.stash[_exporter_key] = exporter
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item: pytest.Item) -> Generator[None, None, None]:
+    with span(item.nodeid):
+        yield
+
+
+def pytest_unconfigure(config: pytest.Config) -> None:
+    exporter = config.stash.get(_exporter_key, None)
+    if exporter:
+        remove_span_exporter(exporter)
+        exporter.write()
+        logger.info(f"Wrote the spans to {exporter.path}")
@@ -2,12 +2,28 @@
 # Copyright 2023 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import os
 from os.path import join
 from secrets import token_urlsafe
-from typing import Optional
+from typing import Dict, Optional
 from urllib.parse import urlencode
 
-import requests
+import httpx
+
+from oauth_tools.instrumentation import get_http_client
+from oauth_tools.timing import timed
+
+# Set HTTP2=1 to send the requests over HTTP/2, it requires the h2 package
+HTTP2 = os.environ.get("HTTP2", "0") == "1"
+
+# The requests go through the instrumented client of oauth_tools, it is closed by conftest.
+# Like requests, it follows the redirects and waits for the responses without a timeout.
+http_client = get_http_client(verify=False, http2=HTTP2, timeout=None, follow_redirects=True)
+
+
+def _drop_none(params: Dict[str, Optional[str]]) -> Dict[str, str]:
+    # Unlike requests, httpx sends the None values as empty strings, e.g. an empty scope
+    return {key: value for key, value in params.items() if value is not None}
 
 
 def get_authorization_url(
@@ -25,29 +41,30 @@ def get_authorization_url(
         "state": token_urlsafe(),
         "nonce": token_urlsafe(),
     }
-    return join(hydra_url, "oauth2/auth?" + urlencode(params))
+    return join(hydra_url, "oauth2/auth?" + urlencode(_drop_none(params)))
 
 
+@timed("token_exchange")
 def client_credentials_grant_request(
     hydra_url: str, client_id: str, client_secret: str, scope: str = "openid profile"
-) -> requests.Response:
+) -> httpx.Response:
     url = join(hydra_url, "oauth2/token")
     body = {
         "grant_type": "client_credentials",
         "scope": scope,
     }
 
-    return requests.post(
+    return http_client.post(
         url,
         data=body,
         auth=(client_id, client_secret),
-        verify=False,
     )
 
 
+@timed("token_exchange")
 def auth_code_grant_request(
     hydra_url: str, client_id: str, client_secret: str, auth_code: str, redirect_uri: str
-) -> requests.Response:
+) -> httpx.Response:
     url = join(hydra_url, "oauth2/token")
     body = {
         "code": auth_code,
@@ -55,67 +72,67 @@ def auth_code_grant_request(
         "redirect_uri": redirect_uri,
     }
 
-    return requests.post(
+    return http_client.post(
         url,
         data=body,
         auth=(client_id, client_secret),
-        verify=False,
     )
 
 
+@timed("token_exchange")
 def refresh_token_request(
     hydra_url: str, client_id: str, client_secret: str, refresh_token: str
-) -> requests.Response:
+) -> httpx.Response:
     url = join(hydra_url, "oauth2/token")
     body = {
         "refresh_token": refresh_token,
         "grant_type": "refresh_token",
     }
 
-    return requests.post(
+    return http_client.post(
         url,
         data=body,
         auth=(client_id, client_secret),
-        verify=False,
     )
 
 
-def userinfo_request(hydra_url: str, access_token: str) -> requests.Response:
+@timed("userinfo")
+def userinfo_request(hydra_url: str, access_token: str) -> httpx.Response:
     url = join(hydra_url, "userinfo")
 
-    return requests.get(
+    return http_client.get(
         url,
         headers={
             "Authorization": "Bearer " + access_token,
             "Content-Type": "application/json",
         },
-        verify=False,
     )
 
 
+@timed("token_exchange")
 def device_auth_request(
     hydra_url: str,
     client_id: str,
     client_secret: str,
     scope: Optional[str] = "openid email offline_access",
-) -> requests.Response:
+) -> httpx.Response:
     url = join(hydra_url, "oauth2/device/auth")
     body = {
         "scope": scope,
         "client_id": client_id,
     }
 
-    return requests.post(
+    return http_client.post(
         url,
-        data=body,
+        data=_drop_none(body),
         auth=(client_id, client_secret),
-        verify=False,
     )
 
 
+@timed("token_exchange")
 def device_token_request(
     hydra_url: str, client_id: str, client_secret: str, device_code: str
-) -> requests.Response:
+) -> httpx.Response:
     url = join(hydra_url, "oauth2/token")
     body = {
         "device_code": device_code,
@@ -123,9 +140,8 @@ def device_token_request(
         "client_id": client_id,
     }
 
-    return requests.post(
+    return http_client.post(
         url,
         data=body,
         auth=(client_id, client_secret),
-        verify=False,
     )
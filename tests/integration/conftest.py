@@ -2,4 +2,16 @@
 # Copyright 2023 Canonical Ltd.
 # See LICENSE file for licensing details.
 
-pytest_plugins = ["oauth_tools.fixtures"]
+from typing import Generator
+
+import pytest
+from integration import auth_utils
+
+pytest_plugins = ["oauth_tools.fixtures", "oauth_tools.timing", "oauth_tools.tracing"]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def close_http_client() -> Generator[None, None, None]:
+    """Close the HTTP client of `auth_utils` and its connections once the tests are done."""
+    yield
+    auth_utils.http_client.close()
@@ -7,6 +7,7 @@ import logging
 import os
 from os.path import join
 from pathlib import Path
+from typing import Any, Callable, Coroutine, List
 from urllib.parse import parse_qs, urlparse
 
 import pytest
@@ -20,18 +21,47 @@ from integration.auth_utils import (
     refresh_token_request,
     userinfo_request,
 )
-from playwright.async_api._generated import Page
+from playwright.async_api._generated import BrowserContext, Page
 from pytest_operator.plugin import OpsTest
 
+from oauth_tools.benchmark import (
+    ThroughputResult,
+    format_protocol_table,
+    format_scaling_table,
+    get_scaling_efficiency,
+    measure_token_throughput,
+)
+from oauth_tools.constants import APPS
 from oauth_tools.external_idp import ExternalIdpService
 from oauth_tools.oauth_helpers import (
     complete_auth_code_login,
     complete_device_login,
     deploy_identity_bundle,
 )
+from oauth_tools.pod_resources import PodResourceSampler
+from oauth_tools.soak import run_refresh_soak
+from oauth_tools.timing import timed
 
 logger = logging.getLogger(__name__)
 
+# The hydra scaling benchmark measures each run for BENCHMARK_DURATION seconds, 0 skips it
+BENCHMARK_DURATION = float(os.environ.get("BENCHMARK_DURATION", "0"))
+# The number of concurrent client_credentials requests, enough to saturate a hydra unit
+BENCHMARK_CONCURRENCY = int(os.environ.get("BENCHMARK_CONCURRENCY", "64"))
+# The number of sessions refreshing their tokens concurrently, each one logs in first
+BENCHMARK_REFRESH_SESSIONS = int(os.environ.get("BENCHMARK_REFRESH_SESSIONS", "32"))
+# The throughput hydra must gain per unit when scaled up, 1.0 is linear, 0 disables the check
+MIN_SCALING_EFFICIENCY = float(os.environ.get("MIN_SCALING_EFFICIENCY", "0.5"))
+
+# The refresh token soak runs for SOAK_DURATION seconds, 0 skips it
+SOAK_DURATION = float(os.environ.get("SOAK_DURATION", "0"))
+SOAK_SESSIONS = int(os.environ.get("SOAK_SESSIONS", "5"))
+SOAK_REFRESH_INTERVAL = float(os.environ.get("SOAK_REFRESH_INTERVAL", "60"))
+# The relative growth of the median refresh latency over which the soak fails
+SOAK_TREND_THRESHOLD = float(os.environ.get("SOAK_TREND_THRESHOLD", "0.2"))
+# The number of sessions whose refresh response may be lost, e.g. to a read timeout
+SOAK_MAX_LOST_SESSIONS = int(os.environ.get("SOAK_MAX_LOST_SESSIONS", "0"))
+
 
 def get_this_script_dir() -> Path:
     filename = inspect.getframeinfo(inspect.currentframe()).filename  # type: ignore[arg-type]
@@ -62,12 +92,42 @@ async def get_reverse_proxy_app_url(
     return f"https://{address}/{ops_test.model.name}-{app_name}/"
 
 
-@pytest.mark.skip_if_deployed
-@pytest.mark.abort_on_fail
-async def test_render_and_deploy_bundle(
-    ops_test: OpsTest, ext_idp_service: ExternalIdpService
-) -> None:
-    """Render the bundle from template and deploy using ops_test."""
+async def get_refresh_tokens(
+    ops_test: OpsTest,
+    context_factory: Callable[..., Coroutine[Any, Any, BrowserContext]],
+    ext_idp_service: ExternalIdpService,
+    hydra_url: str,
+    client: dict,
+    redirect_uri: str,
+    scopes: List[str],
+    sessions: int,
+) -> List[str]:
+    """Log in `sessions` times, with a browser context each, and get their refresh tokens."""
+    refresh_tokens = []
+    for _ in range(sessions):
+        page = await (await context_factory(ignore_https_errors=True)).new_page()
+        await page.goto(
+            get_authorization_url(hydra_url, client["client-id"], redirect_uri, " ".join(scopes))
+        )
+        await complete_auth_code_login(page, ops_test, ext_idp_service=ext_idp_service)
+        await page.wait_for_url(redirect_uri + "?*")
+        code = parse_qs(urlparse(page.url).query)["code"][0]
+        resp = auth_code_grant_request(
+            hydra_url, client["client-id"], client["client-secret"], code, redirect_uri
+        )
+        assert resp.status_code == 200
+        refresh_tokens.append(resp.json()["refresh_token"])
+    return refresh_tokens
+
+
+@pytest.fixture(scope="module", autouse=True)
+async def identity_bundle(ops_test: OpsTest, ext_idp_service: ExternalIdpService) -> None:
+    """Render the bundle from template and deploy it on the model of the module.
+
+    With pytest-xdist, each worker has a model of its own and deploys the bundle on it before
+    running its first test. On a reused model, only the applications that changed since the
+    last run are redeployed.
+    """
     await ops_test.model.set_config({"logging-config": "<root>=WARNING; unit=DEBUG"})
 
     logger.info(f"Rendering bundle {get_bundle_template()}")
@@ -87,6 +147,15 @@ async def test_render_and_deploy_bundle(
 
 
 @pytest.mark.abort_on_fail
+@pytest.mark.xdist_group("bundle")
+async def test_render_and_deploy_bundle(ops_test: OpsTest) -> None:
+    """Check that the bundle deployed by the `identity_bundle` fixture is active."""
+    for app in APPS:
+        assert ops_test.model.applications[app].status == "active"
+
+
+@pytest.mark.abort_on_fail
+@pytest.mark.xdist_group("bundle")
 async def test_hydra_is_up(
     ops_test: OpsTest, admin_traefik_app_name: str, hydra_app_name: str
 ) -> None:
@@ -100,6 +169,7 @@ async def test_hydra_is_up(
 
 
 @pytest.mark.abort_on_fail
+@pytest.mark.xdist_group("bundle")
 async def test_kratos_is_up(
     ops_test: OpsTest, admin_traefik_app_name: str, kratos_app_name: str
 ) -> None:
@@ -113,11 +183,13 @@ async def test_kratos_is_up(
 
 
 @pytest.mark.abort_on_fail
+@pytest.mark.xdist_group("bundle")
 async def test_kratos_external_idp_redirect_url(
     ops_test: OpsTest,
     ext_idp_service: ExternalIdpService,
     kratos_external_idp_integrator_app_name: str,
 ) -> None:
+    await ext_idp_service.async_wait_until_provisioned()
     await ops_test.model.applications[kratos_external_idp_integrator_app_name].set_config({
         "issuer_url": ext_idp_service.issuer_url,
         "provider_id": "Dex",
@@ -139,10 +211,11 @@ async def test_kratos_external_idp_redirect_url(
     action_output = await get_redirect_uri_action.wait()
     assert "redirect-uri" in action_output.results
 
-    ext_idp_service.update_redirect_uri(action_output.results["redirect-uri"])
+    await ext_idp_service.async_update_redirect_uri(action_output.results["redirect-uri"])
 
 
 @pytest.mark.skip_if_deployed
+@pytest.mark.xdist_group("bundle")
 async def test_multiple_kratos_external_idp_integrators(
     ops_test: OpsTest, kratos_app_name: str
 ) -> None:
@@ -192,54 +265,170 @@ async def test_multiple_kratos_external_idp_integrators(
     assert "redirect-uri" in action_output.results
 
 
+@pytest.mark.xdist_group("bundle")
 async def test_kratos_scale_up(ops_test: OpsTest, kratos_app_name: str) -> None:
     """Check that kratos works after it is scaled up."""
     app = ops_test.model.applications[kratos_app_name]
 
-    await app.scale(3)
+    with timed("scale_up"):
+        await app.scale(3)
 
-    await ops_test.model.wait_for_idle(
-        apps=[kratos_app_name],
-        raise_on_blocked=True,
-        status="active",
-        timeout=2000,
-        wait_for_exact_units=3,
-    )
+        await ops_test.model.wait_for_idle(
+            apps=[kratos_app_name],
+            raise_on_blocked=True,
+            status="active",
+            timeout=2000,
+            wait_for_exact_units=3,
+        )
 
 
+@pytest.mark.xdist_group("bundle")
 async def test_hydra_scale_up(ops_test: OpsTest, hydra_app_name: str) -> None:
     """Check that hydra works after it is scaled up."""
     app = ops_test.model.applications[hydra_app_name]
 
-    await app.scale(3)
+    with timed("scale_up"):
+        await app.scale(3)
+
+        await ops_test.model.wait_for_idle(
+            apps=[hydra_app_name],
+            raise_on_blocked=True,
+            status="active",
+            timeout=2000,
+            wait_for_exact_units=3,
+        )
+
 
+async def _scale_hydra(ops_test: OpsTest, hydra_app_name: str, units: int) -> None:
+    app = ops_test.model.applications[hydra_app_name]
+    if len(app.units) == units:
+        return
+    await app.scale(units)
     await ops_test.model.wait_for_idle(
         apps=[hydra_app_name],
         raise_on_blocked=True,
         status="active",
         timeout=2000,
-        wait_for_exact_units=3,
+        wait_for_exact_units=units,
+    )
+
+
+@pytest.mark.skipif(not BENCHMARK_DURATION, reason="Set BENCHMARK_DURATION to run the benchmark")
+@pytest.mark.xdist_group("bundle")
+async def test_hydra_scaling_benchmark(
+    ops_test: OpsTest,
+    context_factory: Callable[..., Coroutine[Any, Any, BrowserContext]],
+    ext_idp_service: ExternalIdpService,
+    hydra_app_name: str,
+    public_traefik_app_name: str,
+    pod_resource_sampler: PodResourceSampler,
+    record_property: Callable[[str, object], None],
+) -> None:
+    """Check that hydra serves more tokens when scaled from 1 to 3 units."""
+    with timed("scale_down"):
+        await _scale_hydra(ops_test, hydra_app_name, 1)
+
+    app = ops_test.model.applications[hydra_app_name]
+    scopes = ["openid", "profile", "email", "offline_access"]
+    redirect_uri = await get_reverse_proxy_app_url(ops_test, public_traefik_app_name, "dummy")
+    with timed("juju_action"):
+        action = await app.units[0].run_action(
+            "create-oauth-client",
+            **{
+                "redirect-uris": [redirect_uri],
+                "grant-types": ["authorization_code", "client_credentials", "refresh_token"],
+                "scope": scopes,
+            },
+        )
+        res = (await action.wait()).results
+    hydra_url = await get_reverse_proxy_app_url(ops_test, public_traefik_app_name, hydra_app_name)
+    # The refresh tokens are rotated by each run, the runs carry on with the last ones issued
+    refresh_tokens = await get_refresh_tokens(
+        ops_test,
+        context_factory,
+        ext_idp_service,
+        hydra_url,
+        res,
+        redirect_uri,
+        scopes,
+        BENCHMARK_REFRESH_SESSIONS,
+    )
+
+    async def measure(units: int, **kwargs: Any) -> ThroughputResult:
+        return await measure_token_throughput(
+            hydra_url,
+            res["client-id"],
+            res["client-secret"],
+            units=units,
+            concurrency=BENCHMARK_CONCURRENCY,
+            duration=BENCHMARK_DURATION,
+            **kwargs,
+        )
+
+    results = [await measure(1)]
+    refresh_results = [await measure(1, grant_type="refresh_token", refresh_tokens=refresh_tokens)]
+
+    with timed("scale_up"):
+        await _scale_hydra(ops_test, hydra_app_name, 3)
+
+    results.append(await measure(3))
+    refresh_results.append(
+        await measure(3, grant_type="refresh_token", refresh_tokens=refresh_tokens)
+    )
+    logger.info(f"Hydra scaling benchmark:\n{format_scaling_table([*results, *refresh_results])}")
+
+    # Traefik speaks HTTP/2, compare the sockets and latency of multiplexed requests
+    http2_result = await measure(3, http2=True)
+    logger.info(
+        f"HTTP/1.1 and HTTP/2 benchmark:\n{format_protocol_table([results[-1], http2_result])}"
+    )
+    # The number of connections depends on how traefik negotiated, it is reported only
+    if http2_result.connections > results[-1].connections:
+        logger.warning(
+            f"HTTP/2 opened {http2_result.connections} connection(s), "
+            f"HTTP/1.1 {results[-1].connections}"
+        )
+
+    # The throughput is reported next to the pod resources sampled meanwhile
+    record_property(
+        "token_throughput",
+        [
+            {
+                "units": result.units,
+                "grant_type": result.grant_type,
+                "http_version": result.http_version,
+                "throughput": result.throughput,
+                "p95": result.percentile(95),
+            }
+            for result in [*results, *refresh_results, http2_result]
+        ],
     )
+    logger.info(f"Pod resources:\n{pod_resource_sampler.format()}")
+    assert refresh_results[-1].requests > refresh_results[-1].errors
+    assert get_scaling_efficiency(results)[3] >= MIN_SCALING_EFFICIENCY
+    assert get_scaling_efficiency(refresh_results)[3] >= MIN_SCALING_EFFICIENCY
 
 
+@pytest.mark.xdist_group("bundle")
 async def test_create_hydra_client(
     ops_test: OpsTest, ext_idp_service: ExternalIdpService, hydra_app_name: str
 ) -> None:
     """Register a client on hydra."""
     app = ops_test.model.applications[hydra_app_name]
-    action = await app.units[0].run_action(
-        "create-oauth-client",
-        **{
-            "grant-types": ["authorization_code", "client_credentials"],
-        },
-    )
-
-    res = (await action.wait()).results
+    with timed("juju_action"):
+        action = await app.units[0].run_action(
+            "create-oauth-client",
+            **{
+                "grant-types": ["authorization_code", "client_credentials"],
+            },
+        )
+        res = (await action.wait()).results
 
     assert res["client-id"]
     assert res["client-secret"]
 
 
+@pytest.mark.xdist_group("authorization_code")
 async def test_authorization_code_flow(
     ops_test: OpsTest,
     page: Page,
@@ -254,15 +443,16 @@ async def test_authorization_code_flow(
     scopes = ["openid", "profile", "email", "offline_access"]
     redirect_uri = await get_reverse_proxy_app_url(ops_test, public_traefik_app_name, "dummy")
     app = ops_test.model.applications[hydra_app_name]
-    action = await app.units[0].run_action(
-        "create-oauth-client",
-        **{
-            "redirect-uris": [redirect_uri],
-            "grant-types": ["authorization_code", "refresh_token"],
-            "scope": scopes,
-        },
-    )
-    res = (await action.wait()).results
+    with timed("juju_action"):
+        action = await app.units[0].run_action(
+            "create-oauth-client",
+            **{
+                "redirect-uris": [redirect_uri],
+                "grant-types": ["authorization_code", "refresh_token"],
+                "scope": scopes,
+            },
+        )
+        res = (await action.wait()).results
     client_id = res["client-id"]
     client_secret = res["client-secret"]
 
@@ -324,19 +514,21 @@ async def test_authorization_code_flow(
     assert json_resp["email"] == user_email
 
 
+@pytest.mark.xdist_group("client_credentials")
 async def test_client_credentials_flow(
     ops_test: OpsTest,
     hydra_app_name: str,
     public_traefik_app_name: str,
 ) -> None:
     app = ops_test.model.applications[hydra_app_name]
-    action = await app.units[0].run_action(
-        "create-oauth-client",
-        **{
-            "grant-types": ["client_credentials"],
-        },
-    )
-    res = (await action.wait()).results
+    with timed("juju_action"):
+        action = await app.units[0].run_action(
+            "create-oauth-client",
+            **{
+                "grant-types": ["client_credentials"],
+            },
+        )
+        res = (await action.wait()).results
     client_id = res["client-id"]
     client_secret = res["client-secret"]
 
@@ -347,6 +539,7 @@ async def test_client_credentials_flow(
     assert "access_token" in resp.json()
 
 
+@pytest.mark.xdist_group("device_flow")
 async def test_device_flow(
     ops_test: OpsTest,
     page: Page,
@@ -357,14 +550,15 @@ async def test_device_flow(
 ) -> None:
     scopes = ["openid", "profile", "email", "offline_access"]
     app = ops_test.model.applications[hydra_app_name]
-    action = await app.units[0].run_action(
-        "create-oauth-client",
-        **{
-            "grant-types": ["urn:ietf:params:oauth:grant-type:device_code", "refresh_token"],
-            "scope": scopes,
-        },
-    )
-    res = (await action.wait()).results
+    with timed("juju_action"):
+        action = await app.units[0].run_action(
+            "create-oauth-client",
+            **{
+                "grant-types": ["urn:ietf:params:oauth:grant-type:device_code", "refresh_token"],
+                "scope": scopes,
+            },
+        )
+        res = (await action.wait()).results
     client_id = res["client-id"]
     client_secret = res["client-secret"]
 
@@ -430,3 +624,64 @@ async def test_device_flow(
 
     assert resp.status_code == 200
     assert json_resp["email"] == user_email
+
+
+@pytest.mark.skipif(not SOAK_DURATION, reason="Set SOAK_DURATION to run the soak")
+@pytest.mark.xdist_group("soak")
+async def test_refresh_token_soak(
+    ops_test: OpsTest,
+    context_factory: Callable[..., Coroutine[Any, Any, BrowserContext]],
+    ext_idp_service: ExternalIdpService,
+    hydra_app_name: str,
+    public_traefik_app_name: str,
+    pod_resource_sampler: PodResourceSampler,
+    record_property: Callable[[str, object], None],
+) -> None:
+    """Keep sessions refreshing their tokens for hours, check that the latency does not creep."""
+    scopes = ["openid", "profile", "email", "offline_access"]
+    redirect_uri = await get_reverse_proxy_app_url(ops_test, public_traefik_app_name, "dummy")
+    app = ops_test.model.applications[hydra_app_name]
+    with timed("juju_action"):
+        action = await app.units[0].run_action(
+            "create-oauth-client",
+            **{
+                "redirect-uris": [redirect_uri],
+                "grant-types": ["authorization_code", "refresh_token"],
+                "scope": scopes,
+            },
+        )
+        res = (await action.wait()).results
+    client_id = res["client-id"]
+    client_secret = res["client-secret"]
+    hydra_url = await get_reverse_proxy_app_url(ops_test, public_traefik_app_name, hydra_app_name)
+
+    # Each session logs in with a browser context of its own, to get its own refresh token
+    refresh_tokens = await get_refresh_tokens(
+        ops_test,
+        context_factory,
+        ext_idp_service,
+        hydra_url,
+        res,
+        redirect_uri,
+        scopes,
+        SOAK_SESSIONS,
+    )
+
+    with timed("soak"):
+        result = await run_refresh_soak(
+            hydra_url,
+            client_id,
+            client_secret,
+            refresh_tokens,
+            duration=SOAK_DURATION,
+            refresh_interval=SOAK_REFRESH_INTERVAL,
+        )
+
+    summary = result.summary(trend_threshold=SOAK_TREND_THRESHOLD)
+    record_property("refresh_token_soak", summary)
+    logger.info(f"Refresh token soak:\n{result.format(trend_threshold=SOAK_TREND_THRESHOLD)}")
+    logger.info(f"Pod resources:\n{pod_resource_sampler.format()}")
+    assert result.broken_sessions == 0
+    assert result.lost_sessions <= SOAK_MAX_LOST_SESSIONS
+    assert not summary["error_bursts"]
+    assert not summary["latency_trend"]["flagged"]
@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+pytest_plugins = ["oauth_tools.fixtures"]
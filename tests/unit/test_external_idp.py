@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+from time import monotonic
+from typing import Dict, Optional
+from unittest.mock import AsyncMock
+
+import bcrypt
+import pytest
+import yaml
+from lightkube import AsyncClient, Client, KubeConfig
+from lightkube.models.apps_v1 import DeploymentSpec, DeploymentStatus
+from lightkube.models.core_v1 import (
+    LoadBalancerIngress,
+    LoadBalancerStatus,
+    PodCondition,
+    PodStatus,
+    PodTemplateSpec,
+    ServiceStatus,
+)
+from lightkube.models.meta_v1 import LabelSelector, ObjectMeta
+from lightkube.resources.apps_v1 import Deployment
+from lightkube.resources.core_v1 import Namespace, Pod, Service
+from lightkube.types import CascadeType
+
+from oauth_tools.constants import EXTERNAL_USER_PASSWORD, EXTERNAL_USER_PASSWORD_HASH
+from oauth_tools.credentials import get_idp_clients, get_idp_users
+from oauth_tools.external_idp import (
+    CONFIG_CHECKSUM_ANNOTATION,
+    DexIdpService,
+    _is_subset,
+    _render_dex_manifest,
+)
+from oauth_tools.fake_kube import FakeAsyncClient
+
+
+def test_users_have_their_own_password() -> None:
+    users = get_idp_users(3, EXTERNAL_USER_PASSWORD)
+
+    assert users[0].password == EXTERNAL_USER_PASSWORD
+    assert len({user.password for user in users}) == 3
+    assert len({user.user_id for user in users}) == 3
+
+
+def test_dex_manifest_has_a_password_hash_per_user() -> None:
+    users = get_idp_users(3, EXTERNAL_USER_PASSWORD)
+
+    objs = _render_dex_manifest(get_idp_clients(1), users, None, None, "dex", 1, None)
+
+    config_map = next(obj for obj in objs if obj.kind == "ConfigMap")
+    passwords = yaml.safe_load(config_map.data["config.yaml"])["staticPasswords"]
+    assert [password["email"] for password in passwords] == [user.email for user in users]
+    assert passwords[0]["hash"] == EXTERNAL_USER_PASSWORD_HASH
+    for user, password in zip(users, passwords):
+        assert bcrypt.checkpw(user.password.encode(), password["hash"].encode())
+        other_users = [other for other in users if other != user]
+        assert not any(
+            bcrypt.checkpw(other.password.encode(), password["hash"].encode())
+            for other in other_users
+        )
+
+
+@pytest.fixture
+def kubeconfig() -> KubeConfig:
+    return KubeConfig.from_dict({
+        "clusters": [{"name": "test", "cluster": {"server": "https://127.0.0.1:6443"}}],
+        "contexts": [{"name": "test", "context": {"cluster": "test", "user": "test"}}],
+        "current-context": "test",
+        "users": [{"name": "test", "user": {"token": "token"}}],
+    })
+
+
+def test_sync_client_config_is_used_per_event_loop(kubeconfig: KubeConfig) -> None:
+    ext_idp_service = DexIdpService(client=Client(config=kubeconfig), provision=False)
+
+    async def get_client() -> AsyncClient:
+        return ext_idp_service._get_client()
+
+    first = ext_idp_service._run_sync(get_client())
+    second = ext_idp_service._run_sync(get_client())
+
+    assert isinstance(first, AsyncClient)
+    assert first is not second
+    # The clients are closed with the event loop they were created for
+    assert not ext_idp_service._kube_clients
+
+
+def test_async_client_is_bound_to_one_event_loop(kubeconfig: KubeConfig) -> None:
+    async_client = AsyncClient(config=kubeconfig)
+    ext_idp_service = DexIdpService(async_client=async_client, provision=False)
+
+    async def get_client() -> AsyncClient:
+        return ext_idp_service._get_client()
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(get_client()) is async_client
+        assert loop.run_until_complete(get_client()) is async_client
+    finally:
+        loop.close()
+    with pytest.raises(RuntimeError):
+        asyncio.run(get_client())
+    with pytest.raises(RuntimeError):
+        ext_idp_service.refresh_issuer_url()
+
+
+@pytest.fixture
+def async_ext_idp_service(
+    kubeconfig: KubeConfig, monkeypatch: pytest.MonkeyPatch
+) -> DexIdpService:
+    ext_idp_service = DexIdpService(async_client=AsyncClient(config=kubeconfig), provision=False)
+    monkeypatch.setattr(ext_idp_service, "_dex_namespace_exists", AsyncMock(return_value=False))
+    monkeypatch.setattr(ext_idp_service, "_apply_dex_resources", AsyncMock(return_value=True))
+    monkeypatch.setattr(ext_idp_service, "_wait_until_is_ready", AsyncMock())
+    monkeypatch.setattr(
+        ext_idp_service, "_get_live_redirect_uri", AsyncMock(return_value="https://redirect")
+    )
+    return ext_idp_service
+
+
+async def test_start_provisioning_with_an_async_client(
+    async_ext_idp_service: DexIdpService,
+) -> None:
+    async_ext_idp_service.start_provisioning()
+
+    with pytest.raises(RuntimeError):
+        async_ext_idp_service.issuer_url
+    await async_ext_idp_service.async_wait_until_provisioned()
+    async_ext_idp_service.start_provisioning()
+
+    async_ext_idp_service._apply_dex_resources.assert_awaited_once()
+
+
+async def test_start_provisioning_once_provisioned_is_a_noop(
+    async_ext_idp_service: DexIdpService,
+) -> None:
+    await async_ext_idp_service.async_ensure_idp_service()
+
+    async_ext_idp_service.start_provisioning()
+
+    assert async_ext_idp_service._provisioning is None
+    async_ext_idp_service._apply_dex_resources.assert_awaited_once()
+
+
+async def test_provisioning_without_deploying_waits_for_dex(
+    async_ext_idp_service: DexIdpService,
+) -> None:
+    async_ext_idp_service.start_provisioning(deploy=False)
+    await async_ext_idp_service.async_wait_until_provisioned()
+
+    async_ext_idp_service._apply_dex_resources.assert_not_awaited()
+    async_ext_idp_service._wait_until_is_ready.assert_awaited_once()
+    # The redirect URI registered by the deploying process is kept on update
+    assert async_ext_idp_service._redirect_uri == "https://redirect"
+
+
+def _metadata(name: str, namespace: str, **kwargs: object) -> ObjectMeta:
+    return ObjectMeta(name=name, namespace=namespace, **kwargs)
+
+
+def _pod(name: str, namespace: str, ready: bool, checksum: Optional[str] = None) -> Pod:
+    annotations: Dict[str, str] = {CONFIG_CHECKSUM_ANNOTATION: checksum} if checksum else {}
+    return Pod(
+        metadata=_metadata(name, namespace, labels={"app": "dex"}, annotations=annotations),
+        status=PodStatus(
+            conditions=[PodCondition(type="Ready", status="True" if ready else "False")]
+        ),
+    )
+
+
+def _deployment(namespace: str, available: int) -> Deployment:
+    return Deployment(
+        metadata=_metadata("dex", namespace, generation=1),
+        spec=DeploymentSpec(
+            replicas=1,
+            selector=LabelSelector(matchLabels={"app": "dex"}),
+            template=PodTemplateSpec(),
+        ),
+        status=DeploymentStatus(
+            observedGeneration=1, replicas=1, updatedReplicas=1, availableReplicas=available
+        ),
+    )
+
+
+def _service(namespace: str, ip: Optional[str] = None) -> Service:
+    ingress = [LoadBalancerIngress(ip=ip)] if ip else None
+    return Service(
+        metadata=_metadata("dex", namespace),
+        status=ServiceStatus(loadBalancer=LoadBalancerStatus(ingress=ingress)),
+    )
+
+
+async def _settle() -> None:
+    """Let the watches process the events emitted so far."""
+    await asyncio.sleep(0.05)
+
+
+@pytest.fixture
+def fake_client() -> FakeAsyncClient:
+    return FakeAsyncClient()
+
+
+@pytest.fixture
+def fake_ext_idp_service(fake_client: FakeAsyncClient) -> DexIdpService:
+    return DexIdpService(async_client=fake_client, provision=False)
+
+
+async def test_wait_for_pods_watches_from_the_listed_version(
+    fake_client: FakeAsyncClient, fake_ext_idp_service: DexIdpService
+) -> None:
+    namespace = fake_ext_idp_service.namespace
+    fake_client.modify(_pod("dex-0", namespace, ready=False, checksum="old"))
+
+    wait = asyncio.create_task(fake_ext_idp_service._wait_for_pods(monotonic() + 5, "new"))
+    await _settle()
+
+    assert fake_client.watches[-1]["resource_version"] == "1"
+    # The pods of the previous config are not counted
+    fake_client.modify(_pod("dex-0", namespace, ready=True, checksum="old"))
+    await _settle()
+    assert not wait.done()
+    fake_client.modify(_pod("dex-0", namespace, ready=True, checksum="new"))
+    await asyncio.wait_for(wait, timeout=1)
+
+
+async def test_wait_for_pods_forgets_the_deleted_pods(fake_client: FakeAsyncClient) -> None:
+    ext_idp_service = DexIdpService(async_client=fake_client, replicas=2, provision=False)
+    namespace = ext_idp_service.namespace
+    fake_client.modify(_pod("dex-0", namespace, ready=True))
+    fake_client.modify(_pod("dex-1", namespace, ready=False))
+
+    wait = asyncio.create_task(ext_idp_service._wait_for_pods(monotonic() + 5, None))
+    await _settle()
+    fake_client.remove(Pod, "dex-0", namespace)
+    fake_client.modify(_pod("dex-1", namespace, ready=True))
+    await _settle()
+
+    assert not wait.done()
+    fake_client.modify(_pod("dex-2", namespace, ready=True))
+    await asyncio.wait_for(wait, timeout=1)
+
+
+async def test_wait_for_deployment_times_out(
+    fake_client: FakeAsyncClient, fake_ext_idp_service: DexIdpService
+) -> None:
+    with pytest.raises(TimeoutError, match="Deployment"):
+        await fake_ext_idp_service._wait_for_deployment(monotonic() + 0.1)
+
+    # Not created yet, the deployment is watched from the start
+    assert fake_client.watches[-1]["resource_version"] is None
+
+
+async def test_wait_until_is_ready(
+    fake_client: FakeAsyncClient,
+    fake_ext_idp_service: DexIdpService,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(fake_ext_idp_service, "_wait_for_issuer", AsyncMock())
+    namespace = fake_ext_idp_service.namespace
+    fake_client.modify(_pod("dex-0", namespace, ready=True, checksum="checksum"))
+    fake_client.modify(_deployment(namespace, available=0))
+    fake_client.modify(_service(namespace))
+
+    wait = asyncio.create_task(
+        fake_ext_idp_service._wait_until_is_ready(checksum="checksum", timeout=5)
+    )
+    await _settle()
+    fake_client.modify(_deployment(namespace, available=1))
+    # A Service deleted while waiting is waited for until it is created again
+    fake_client.remove(Service, "dex", namespace)
+    await _settle()
+    assert not wait.done()
+    fake_client.modify(_service(namespace, ip="10.0.0.1"))
+    timings = await asyncio.wait_for(wait, timeout=1)
+
+    assert list(timings) == ["pods", "deployment", "service", "issuer"]
+    assert fake_ext_idp_service.readiness_timings == timings
+    assert fake_ext_idp_service.issuer_url == "http://10.0.0.1:5556/"
+
+
+def test_is_subset() -> None:
+    desired = {"metadata": {"name": "dex"}, "spec": {"ports": [{"port": 5556}]}}
+
+    # The defaults and status filled in by the API server are ignored
+    assert _is_subset(
+        desired,
+        {
+            "metadata": {"name": "dex", "resourceVersion": "1"},
+            "spec": {"ports": [{"port": 5556, "protocol": "TCP"}]},
+            "status": {},
+        },
+    )
+    assert not _is_subset(desired, {"metadata": {"name": "dex"}, "spec": {}})
+    assert not _is_subset(desired, {"metadata": {"name": "dex"}, "spec": {"ports": []}})
+    assert not _is_subset(
+        desired, {"metadata": {"name": "dex"}, "spec": {"ports": [{"port": 5557}]}}
+    )
+
+
+@pytest.fixture
+def applied_ext_idp_service(
+    fake_client: FakeAsyncClient,
+    fake_ext_idp_service: DexIdpService,
+    monkeypatch: pytest.MonkeyPatch,
+) -> DexIdpService:
+    monkeypatch.setattr(fake_ext_idp_service, "_wait_until_is_ready", AsyncMock())
+    return fake_ext_idp_service
+
+
+async def test_unchanged_dex_resources_are_not_applied(
+    fake_client: FakeAsyncClient, applied_ext_idp_service: DexIdpService
+) -> None:
+    assert await applied_ext_idp_service._apply_dex_resources()
+    assert {obj.kind for obj in fake_client.applied} >= {
+        "Namespace",
+        "ConfigMap",
+        "Deployment",
+        "Service",
+    }
+    # The Deployment goes last to roll out the new config
+    assert fake_client.applied[-1].kind == "Deployment"
+    fake_client.applied.clear()
+
+    assert not await applied_ext_idp_service._apply_dex_resources()
+
+    assert not fake_client.applied
+    applied_ext_idp_service._wait_until_is_ready.assert_awaited_once()
+
+
+async def test_changed_redirect_uri_is_applied(
+    fake_client: FakeAsyncClient, applied_ext_idp_service: DexIdpService
+) -> None:
+    await applied_ext_idp_service._apply_dex_resources()
+    checksum = fake_client.applied[-1].spec.template.metadata.annotations[
+        CONFIG_CHECKSUM_ANNOTATION
+    ]
+    fake_client.applied.clear()
+
+    applied_ext_idp_service._redirect_uri = "https://example.com/callback"
+    assert await applied_ext_idp_service._apply_dex_resources()
+
+    # The config changed, the pods are rolled out again with the new checksum
+    assert [obj.kind for obj in fake_client.applied] == ["ConfigMap", "Deployment"]
+    config = yaml.safe_load(fake_client.applied[0].data["config.yaml"])
+    assert config["staticClients"][0]["redirectURIs"] == ["https://example.com/callback"]
+    new_checksum = fake_client.applied[1].spec.template.metadata.annotations[
+        CONFIG_CHECKSUM_ANNOTATION
+    ]
+    assert new_checksum != checksum
+    applied_ext_idp_service._wait_until_is_ready.assert_awaited_with(checksum=new_checksum)
+
+
+async def test_changed_live_checksum_is_applied(
+    fake_client: FakeAsyncClient, applied_ext_idp_service: DexIdpService
+) -> None:
+    await applied_ext_idp_service._apply_dex_resources()
+    fake_client.applied.clear()
+    deployment = await fake_client.get(
+        Deployment, "dex", namespace=applied_ext_idp_service.namespace
+    )
+    deployment.spec.template.metadata.annotations[CONFIG_CHECKSUM_ANNOTATION] = "edited"
+    fake_client.modify(deployment)
+
+    assert await applied_ext_idp_service._apply_dex_resources()
+
+    assert [obj.kind for obj in fake_client.applied] == ["Deployment"]
+
+
+async def _set_service_ip(fake_client: FakeAsyncClient, namespace: str, ip: str) -> None:
+    service = await fake_client.get(Service, "dex", namespace=namespace)
+    service.status = _service(namespace, ip=ip).status
+    fake_client.modify(service)
+
+
+async def test_issuer_url_is_cached(
+    fake_client: FakeAsyncClient, applied_ext_idp_service: DexIdpService
+) -> None:
+    await applied_ext_idp_service._apply_dex_resources()
+    await _set_service_ip(fake_client, applied_ext_idp_service.namespace, "10.0.0.1")
+    assert await applied_ext_idp_service.async_refresh_issuer_url() == "http://10.0.0.1:5556/"
+    assert applied_ext_idp_service.saved_api_calls == 0
+
+    assert applied_ext_idp_service.issuer_url == "http://10.0.0.1:5556/"
+    fake_client.applied.clear()
+    await applied_ext_idp_service.async_update_redirect_uri("https://example.com/callback")
+
+    # The manifest is rendered with the cached issuer, the Service is left as is
+    assert applied_ext_idp_service.saved_api_calls == 2
+    assert "Service" not in [obj.kind for obj in fake_client.applied]
+    assert applied_ext_idp_service.issuer_url == "http://10.0.0.1:5556/"
+    assert applied_ext_idp_service.saved_api_calls == 3
+
+
+async def test_issuer_url_cache_is_invalidated_when_the_service_is_applied(
+    fake_client: FakeAsyncClient, applied_ext_idp_service: DexIdpService
+) -> None:
+    namespace = applied_ext_idp_service.namespace
+    await applied_ext_idp_service._apply_dex_resources()
+    await _set_service_ip(fake_client, namespace, "10.0.0.1")
+    await applied_ext_idp_service.async_refresh_issuer_url()
+    # e.g. deleted by hand, it gets a new LoadBalancer IP when it is applied again
+    fake_client.remove(Service, "dex", namespace)
+
+    await applied_ext_idp_service.async_update_redirect_uri("https://example.com/callback")
+
+    assert "Service" in [obj.kind for obj in fake_client.applied]
+    assert applied_ext_idp_service._issuer_url is None
+    await _set_service_ip(fake_client, namespace, "10.0.0.2")
+    assert await applied_ext_idp_service.async_refresh_issuer_url() == "http://10.0.0.2:5556/"
+
+
+async def test_dex_manifests_are_not_shared(fake_client: FakeAsyncClient) -> None:
+    first = DexIdpService(async_client=fake_client, provision=False)
+    second = DexIdpService(async_client=fake_client, provision=False)
+
+    objs = await first._get_dex_manifest()
+    deployment = next(obj for obj in objs if obj.kind == "Deployment")
+    deployment.spec.replicas = 5
+    deployment.metadata.labels["modified"] = "true"
+    second._redirect_uri = "https://example.com/callback"
+
+    for ext_idp_service in (first, second):
+        deployment = next(
+            obj for obj in await ext_idp_service._get_dex_manifest() if obj.kind == "Deployment"
+        )
+        assert deployment.spec.replicas == 1
+        assert "modified" not in deployment.metadata.labels
+    redirect_uris = []
+    for ext_idp_service in (first, second):
+        objs = await ext_idp_service._get_dex_manifest()
+        config_map = next(obj for obj in objs if obj.kind == "ConfigMap")
+        config = yaml.safe_load(config_map.data["config.yaml"])
+        redirect_uris.append(config["staticClients"][0]["redirectURIs"])
+    assert redirect_uris[0] != redirect_uris[1] == ["https://example.com/callback"]
+
+
+async def test_remove_idp_service_waits_for_the_namespace(
+    applied_ext_idp_service: DexIdpService,
+) -> None:
+    fake_client = applied_ext_idp_service._async_client
+    fake_client.namespace_deletion_delay = 0.2
+    namespace = applied_ext_idp_service.namespace
+    await applied_ext_idp_service._apply_dex_resources()
+
+    start = monotonic()
+    await applied_ext_idp_service.async_remove_idp_service()
+
+    assert monotonic() - start >= 0.2
+    assert ("Namespace", namespace, CascadeType.FOREGROUND) in fake_client.deleted
+    # Only the cluster scoped resources are deleted one by one, the others with the namespace
+    assert {deleted[0] for deleted in fake_client.deleted} == {
+        "Namespace",
+        "ClusterRole",
+        "ClusterRoleBinding",
+    }
+    assert not [key for key in fake_client.objects if namespace in key[1:]]
+    assert fake_client.watches[-1]["res"] is Namespace
+    assert fake_client.watches[-1]["resource_version"] is not None
+
+
+async def test_remove_idp_service_times_out(applied_ext_idp_service: DexIdpService) -> None:
+    applied_ext_idp_service._async_client.namespace_deletion_delay = 5
+    await applied_ext_idp_service._apply_dex_resources()
+
+    with pytest.raises(TimeoutError, match="namespace"):
+        await applied_ext_idp_service.async_remove_idp_service(timeout=0.1)
+
+
+async def test_remove_idp_service_after_a_failed_provisioning(
+    applied_ext_idp_service: DexIdpService, caplog: pytest.LogCaptureFixture
+) -> None:
+    fake_client = applied_ext_idp_service._async_client
+    await applied_ext_idp_service._apply_dex_resources()
+    applied_ext_idp_service._provisioning = asyncio.get_running_loop().create_future()
+    applied_ext_idp_service._provisioning.set_exception(RuntimeError("Failed to deploy dex"))
+
+    await applied_ext_idp_service.async_remove_idp_service()
+
+    assert "Failed to provision dex" in caplog.text
+    assert "Failed to deploy dex" in caplog.text
+    assert not fake_client.objects
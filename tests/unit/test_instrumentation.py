@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from typing import Iterator, List
+
+import httpx
+import pytest
+
+from oauth_tools.instrumentation import (
+    ConnectionStats,
+    HttpEvent,
+    InstrumentedTransport,
+    add_http_callback,
+    get_async_http_client,
+    get_http_client,
+    remove_http_callback,
+)
+from oauth_tools.local_idp import LocalIdpService
+
+
+def test_client_callbacks_only_see_their_client(local_idp_service: LocalIdpService) -> None:
+    url = join(local_idp_service.issuer_url, ".well-known/openid-configuration")
+    events: List[HttpEvent] = []
+    stats = ConnectionStats()
+    add_http_callback(events.append)
+    try:
+        with get_http_client(callbacks=[stats]) as http_client:
+            for _ in range(3):
+                assert http_client.get(url).status_code == 200
+        with get_http_client() as http_client:
+            assert http_client.get(url).status_code == 200
+    finally:
+        remove_http_callback(events.append)
+
+    # The registered callbacks see the requests of every client
+    assert len(events) == 4
+    assert stats.summary() == {"HTTP/1.0": {"requests": 3, "connections": 3}}
+
+
+async def test_async_client_callbacks(local_idp_service: LocalIdpService) -> None:
+    url = join(local_idp_service.issuer_url, ".well-known/openid-configuration")
+    stats = ConnectionStats()
+
+    async with get_async_http_client(callbacks=[stats]) as http_client:
+        for _ in range(2):
+            assert (await http_client.get(url)).status_code == 200
+
+    assert stats.requests == 2
+    # The server closes the HTTP/1.0 connections after each response
+    assert stats.connections == 2
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:  # noqa: N802
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def keep_alive_url() -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_keep_alive_connections_are_reused(keep_alive_url: str) -> None:
+    events: List[HttpEvent] = []
+    stats = ConnectionStats()
+
+    with get_http_client(callbacks=[events.append, stats]) as http_client:
+        for _ in range(3):
+            assert http_client.get(keep_alive_url).status_code == 200
+
+    assert [event.connection_reused for event in events] == [False, True, True]
+    assert stats.summary() == {"HTTP/1.1": {"requests": 3, "connections": 1}}
+    assert stats.reuse_ratio == pytest.approx(2 / 3)
+
+
+def test_failed_requests_are_not_reused() -> None:
+    events: List[HttpEvent] = []
+
+    def refuse(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("Connection refused", request=request)
+
+    transport = InstrumentedTransport(httpx.MockTransport(refuse), callbacks=[events.append])
+    with httpx.Client(transport=transport) as http_client:
+        # It fails before any connection is traced
+        with pytest.raises(httpx.ConnectError):
+            http_client.get("http://127.0.0.1/")
+
+    assert events[-1].error is not None
+    assert events[-1].status is None
+    assert not events[-1].connection_reused
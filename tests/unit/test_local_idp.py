@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import base64
+import json
+import re
+from os.path import join
+from typing import Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import httpx
+import pytest
+
+from oauth_tools.local_idp import LocalIdpService
+
+REDIRECT_URI = "http://127.0.0.1:8080/callback"
+
+
+@pytest.fixture
+def idp(local_idp_service: LocalIdpService) -> LocalIdpService:
+    local_idp_service.update_redirect_uri(REDIRECT_URI)
+    return local_idp_service
+
+
+def _login(idp: LocalIdpService, redirect_uri: Optional[str] = None) -> str:
+    """Log the test user in, and return the authorization code."""
+    params = {"response_type": "code", "client_id": idp.client_id, "state": "xyz"}
+    if redirect_uri:
+        params["redirect_uri"] = redirect_uri
+    resp = httpx.get(join(idp.issuer_url, "auth?" + urlencode(params)))
+    assert resp.status_code == 200
+    req = re.search(r'name="req" value="([^"]+)"', resp.text).group(1)
+
+    resp = httpx.post(
+        join(idp.issuer_url, "auth/login"),
+        data={"req": req, "login": idp.user_email, "password": idp.user_password},
+    )
+    assert resp.status_code == 303
+    location = urlparse(resp.headers["Location"])
+    assert f"{location.scheme}://{location.netloc}{location.path}" == REDIRECT_URI
+    query = parse_qs(location.query)
+    assert query["state"] == ["xyz"]
+    return query["code"][0]
+
+
+def _basic_auth(client_id: str, client_secret: str) -> str:
+    credentials = f"{client_id}:{client_secret}".encode()
+    return "Basic " + base64.b64encode(credentials).decode()
+
+
+def test_discovery_document(idp: LocalIdpService) -> None:
+    resp = httpx.get(join(idp.issuer_url, ".well-known/openid-configuration"))
+
+    assert resp.status_code == 200
+    assert resp.json()["issuer"] == idp.issuer_url
+    assert resp.json()["token_endpoint"] == join(idp.issuer_url, "token")
+
+
+def test_authorization_code_flow(idp: LocalIdpService) -> None:
+    code = _login(idp, redirect_uri=REDIRECT_URI)
+
+    resp = httpx.post(
+        join(idp.issuer_url, "token"),
+        data={"grant_type": "authorization_code", "code": code, "redirect_uri": REDIRECT_URI},
+        auth=(idp.client_id, idp.client_secret),
+    )
+    assert resp.status_code == 200
+    tokens = resp.json()
+    payload = tokens["id_token"].split(".")[1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    assert claims["iss"] == idp.issuer_url
+    assert claims["aud"] == idp.client_id
+    assert claims["email"] == idp.user_email
+
+    resp = httpx.get(
+        join(idp.issuer_url, "userinfo"),
+        headers={"Authorization": f"Bearer {tokens['access_token']}"},
+    )
+    assert resp.status_code == 200
+    assert resp.json()["email"] == idp.user_email
+
+
+def test_redirect_uri_defaults_to_the_registered_one(idp: LocalIdpService) -> None:
+    code = _login(idp)
+
+    # The token request omits the redirect_uri too
+    resp = httpx.post(
+        join(idp.issuer_url, "token"),
+        data={"grant_type": "authorization_code", "code": code},
+        auth=(idp.client_id, idp.client_secret),
+    )
+    assert resp.status_code == 200
+
+
+def test_unregistered_redirect_uri_is_rejected(idp: LocalIdpService) -> None:
+    params = {
+        "response_type": "code",
+        "client_id": idp.client_id,
+        "redirect_uri": "http://attacker.example.com/callback",
+    }
+    resp = httpx.get(join(idp.issuer_url, "auth?" + urlencode(params)))
+
+    assert resp.status_code == 400
+    assert resp.json()["error"] == "invalid_request"
+
+
+def test_basic_auth_credentials_are_url_decoded(idp: LocalIdpService) -> None:
+    code = _login(idp, redirect_uri=REDIRECT_URI)
+
+    resp = httpx.post(
+        join(idp.issuer_url, "token"),
+        data={"grant_type": "authorization_code", "code": code, "redirect_uri": REDIRECT_URI},
+        headers={
+            "Authorization": _basic_auth(
+                idp.client_id.replace("_", "%5F"), idp.client_secret.replace("_", "%5F")
+            )
+        },
+    )
+    assert resp.status_code == 200
+
+
+def test_invalid_client_secret_is_rejected(idp: LocalIdpService) -> None:
+    code = _login(idp, redirect_uri=REDIRECT_URI)
+
+    resp = httpx.post(
+        join(idp.issuer_url, "token"),
+        data={"grant_type": "authorization_code", "code": code, "redirect_uri": REDIRECT_URI},
+        headers={"Authorization": _basic_auth(idp.client_id, "wrong")},
+    )
+    assert resp.status_code == 401
+    assert resp.json()["error"] == "invalid_client"
+
+
+@pytest.mark.parametrize(
+    "authorization",
+    [
+        "Basic not-base64!",
+        "Basic " + base64.b64encode(b"client_id:\xff").decode(),
+        "Basic abc",
+    ],
+)
+def test_malformed_client_credentials_are_rejected(
+    idp: LocalIdpService, authorization: str
+) -> None:
+    code = _login(idp, redirect_uri=REDIRECT_URI)
+
+    resp = httpx.post(
+        join(idp.issuer_url, "token"),
+        data={"grant_type": "authorization_code", "code": code, "redirect_uri": REDIRECT_URI},
+        headers={"Authorization": authorization},
+    )
+    assert resp.status_code == 401
+    assert resp.json()["error"] == "invalid_client"
+
+
+def test_invalid_password_is_rejected(idp: LocalIdpService) -> None:
+    params = {"response_type": "code", "client_id": idp.client_id}
+    resp = httpx.get(join(idp.issuer_url, "auth?" + urlencode(params)))
+    req = re.search(r'name="req" value="([^"]+)"', resp.text).group(1)
+
+    resp = httpx.post(
+        join(idp.issuer_url, "auth/login"),
+        data={"req": req, "login": idp.user_email, "password": "wrong"},
+    )
+    assert resp.status_code == 401
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+from os.path import join
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import httpx
+import pytest
+import yaml
+
+from oauth_tools import oauth_helpers
+from oauth_tools.constants import APPS, BUNDLE_FINGERPRINT_ANNOTATION
+from oauth_tools.fake_ops_test import FakeOpsTest
+from oauth_tools.local_idp import LocalIdpService
+from oauth_tools.oauth_helpers import (
+    _get_changed_applications,
+    clean_up_identity_bundle,
+    deploy_identity_bundle,
+    get_bundle_fingerprint,
+    get_cookie_from_browser_by_name,
+    get_http_client_from_browser,
+    index_cookies_by_domain,
+)
+
+RELATIONS = [[f"{APPS.HYDRA}:pg-database", "postgresql-k8s:database"]]
+COOKIES = [
+    {
+        "name": "session",
+        "value": "secret",
+        "domain": "example.com",
+        "path": "/",
+        "expires": -1,
+        "httpOnly": True,
+        "secure": True,
+        "sameSite": "Lax",
+    },
+    {
+        "name": "theme",
+        "value": "dark",
+        "domain": ".other.example.com",
+        "path": "/ui",
+        "expires": 4102444800,
+        "httpOnly": False,
+        "secure": False,
+        "sameSite": "None",
+    },
+]
+
+
+class FakeBrowserContext:
+    """A browser context returning a fixed list of cookies."""
+
+    def __init__(self, cookies: List[Dict]) -> None:
+        self._cookies = cookies
+
+    async def cookies(self, urls: Optional[Any] = None) -> List[Dict]:
+        return list(self._cookies)
+
+
+@pytest.fixture
+def bundle_path(tmp_path: Path) -> Path:
+    (tmp_path / "hydra.charm").write_bytes(b"hydra")
+    applications = {app: {"charm": app, "scale": 1} for app in APPS}
+    applications[APPS.HYDRA]["charm"] = "./hydra.charm"
+    bundle_path = tmp_path / "bundle.yaml"
+    bundle_path.write_text(yaml.safe_dump({"applications": applications, "relations": RELATIONS}))
+    return bundle_path
+
+
+def _update_bundle(bundle_path: Path, app: str, **changes: object) -> None:
+    bundle = yaml.safe_load(bundle_path.read_text())
+    bundle["applications"][app].update(changes)
+    bundle_path.write_text(yaml.safe_dump(bundle))
+
+
+def _get_waited_apps(fake_ops_test: FakeOpsTest) -> List[Set[str]]:
+    return [set(call[1]) for call in fake_ops_test.calls if call[0] == "wait_for_idle"]
+
+
+async def test_deploy_identity_bundle_from_charmhub(
+    fake_ops_test: FakeOpsTest, local_idp_service: LocalIdpService
+) -> None:
+    await deploy_identity_bundle(
+        fake_ops_test, bundle_channel="0.1/edge", ext_idp_service=local_idp_service
+    )
+
+    assert (
+        "run",
+        "juju",
+        "deploy",
+        "identity-platform",
+        "--trust",
+        "--channel",
+        "0.1/edge",
+    ) in fake_ops_test.calls
+    assert _get_waited_apps(fake_ops_test) == [set(APPS)]
+    integrator = fake_ops_test.model.applications[APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR]
+    assert integrator.config["issuer_url"] == local_idp_service.issuer_url
+    assert integrator.config["client_id"] == local_idp_service.client_id
+    # The redirect URI returned by the integrator is registered on the provider
+    address = fake_ops_test.model.get_address(APPS.TRAEFIK_PUBLIC)
+    assert local_idp_service._redirect_uri == (
+        f"https://{address}/test-model-{APPS.KRATOS}/self-service/methods/oidc/callback/Dex"
+    )
+    # Nothing to fingerprint for a charmhub bundle
+    assert not fake_ops_test.model.annotations
+
+
+async def test_deploy_identity_bundle_without_ext_idp(fake_ops_test: FakeOpsTest) -> None:
+    await deploy_identity_bundle(fake_ops_test, bundle_channel="0.1/edge")
+
+    # The integrator stays blocked until it is configured with an external provider
+    assert _get_waited_apps(fake_ops_test) == [set(APPS) - {APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR}]
+
+
+async def test_unchanged_bundle_is_not_deployed_again(
+    fake_ops_test: FakeOpsTest, local_idp_service: LocalIdpService, bundle_path: Path
+) -> None:
+    await deploy_identity_bundle(
+        fake_ops_test, bundle_url=str(bundle_path), ext_idp_service=local_idp_service
+    )
+    assert ("run", "juju", "deploy", str(bundle_path), "--trust") in fake_ops_test.calls
+    assert json.loads(fake_ops_test.model.annotations[BUNDLE_FINGERPRINT_ANNOTATION]) == (
+        get_bundle_fingerprint(bundle_path)
+    )
+    fake_ops_test.reset()
+
+    await deploy_identity_bundle(
+        fake_ops_test, bundle_url=str(bundle_path), ext_idp_service=local_idp_service
+    )
+
+    assert not [call for call in fake_ops_test.calls if call[0] in ("run", "wait_for_idle")]
+    assert not [call for call in fake_ops_test.calls if call[0] == "set_config"]
+    # The redirect URI is registered again, e.g. on a new external provider
+    assert (
+        "run_action",
+        f"{APPS.KRATOS_EXTERNAL_IDP_INTEGRATOR}/0",
+        "get-redirect-uri",
+    ) in fake_ops_test.calls
+
+
+async def test_only_the_changed_applications_are_waited_for(
+    fake_ops_test: FakeOpsTest, local_idp_service: LocalIdpService, bundle_path: Path
+) -> None:
+    await deploy_identity_bundle(
+        fake_ops_test, bundle_url=str(bundle_path), ext_idp_service=local_idp_service
+    )
+    (bundle_path.parent / "hydra.charm").write_bytes(b"hydra v2")
+    fake_ops_test.reset()
+
+    await deploy_identity_bundle(
+        fake_ops_test, bundle_url=str(bundle_path), ext_idp_service=local_idp_service
+    )
+
+    assert ("run", "juju", "deploy", str(bundle_path), "--trust") in fake_ops_test.calls
+    assert _get_waited_apps(fake_ops_test) == [{APPS.HYDRA}]
+
+
+async def test_changed_applications(fake_ops_test: FakeOpsTest, bundle_path: Path) -> None:
+    fingerprint = get_bundle_fingerprint(bundle_path)
+    # Nothing is known about a model without a fingerprint, everything is deployed
+    assert await _get_changed_applications(fake_ops_test, fingerprint) is None
+    assert await _get_changed_applications(fake_ops_test, None) is None
+
+    await fake_ops_test.run("juju", "deploy", str(bundle_path))
+    fake_ops_test.model.annotations[BUNDLE_FINGERPRINT_ANNOTATION] = json.dumps(fingerprint)
+    assert await _get_changed_applications(fake_ops_test, fingerprint) == []
+
+    _update_bundle(bundle_path, APPS.KRATOS, options={"log_level": "debug"})
+    assert await _get_changed_applications(fake_ops_test, get_bundle_fingerprint(bundle_path)) == [
+        APPS.KRATOS
+    ]
+    # An application removed from the model is deployed again
+    await fake_ops_test.model.remove_application(APPS.HYDRA)
+    assert await _get_changed_applications(fake_ops_test, fingerprint) == [APPS.HYDRA]
+
+    bundle = yaml.safe_load(bundle_path.read_text())
+    bundle["relations"] = []
+    bundle_path.write_text(yaml.safe_dump(bundle))
+    assert (
+        await _get_changed_applications(fake_ops_test, get_bundle_fingerprint(bundle_path)) is None
+    )
+
+
+def test_bundle_fingerprint(bundle_path: Path) -> None:
+    fingerprint = get_bundle_fingerprint(bundle_path)
+    assert set(fingerprint["applications"]) == set(APPS)
+    assert get_bundle_fingerprint(bundle_path) == fingerprint
+
+    # The channel, and the content of the local charms, are part of the fingerprint
+    assert get_bundle_fingerprint(bundle_path, "edge") != fingerprint
+    (bundle_path.parent / "hydra.charm").write_bytes(b"hydra v2")
+    changed = get_bundle_fingerprint(bundle_path)
+    assert [
+        app
+        for app, digest in changed["applications"].items()
+        if fingerprint["applications"][app] != digest
+    ] == [APPS.HYDRA]
+    assert changed["relations"] == fingerprint["relations"]
+
+
+async def test_clean_up_identity_bundle(
+    fake_ops_test: FakeOpsTest, local_idp_service: LocalIdpService
+) -> None:
+    await deploy_identity_bundle(
+        fake_ops_test, bundle_channel="0.1/edge", ext_idp_service=local_idp_service
+    )
+    fake_ops_test.reset()
+
+    await clean_up_identity_bundle(fake_ops_test, ext_idp_service=local_idp_service)
+
+    assert [call[1] for call in fake_ops_test.calls if call[0] == "remove_application"] == list(
+        APPS
+    )
+    assert not fake_ops_test.model.applications
+    with pytest.raises(httpx.ConnectError):
+        httpx.get(join(local_idp_service.issuer_url, ".well-known/openid-configuration"))
+
+
+def test_index_cookies_by_domain() -> None:
+    index = index_cookies_by_domain(COOKIES)
+
+    assert set(index) == {"example.com", "other.example.com"}
+    assert index["example.com"]["session"] is COOKIES[0]
+    assert index["other.example.com"]["theme"] is COOKIES[1]
+
+
+async def test_get_cookie_from_browser_by_name() -> None:
+    browser_context = FakeBrowserContext(COOKIES)
+
+    assert await get_cookie_from_browser_by_name(browser_context, "theme") == "dark"
+    assert await get_cookie_from_browser_by_name(browser_context, "missing") is None
+
+
+async def test_get_http_client_from_browser_keeps_cookie_attributes() -> None:
+    client = await get_http_client_from_browser(FakeBrowserContext(COOKIES))
+
+    with client:
+        cookies = {cookie.name: cookie for cookie in client.cookies.jar}
+        assert cookies["session"].secure
+        assert cookies["session"].has_nonstandard_attr("HttpOnly")
+        assert cookies["session"].discard
+        assert not cookies["theme"].secure
+        assert not cookies["theme"].has_nonstandard_attr("HttpOnly")
+        assert cookies["theme"].expires == 4102444800
+        assert cookies["theme"].domain_initial_dot
+        assert cookies["theme"].path == "/ui"
+
+        # The secure cookie is only sent over https
+        request = client.build_request("GET", "http://example.com/")
+        assert "session=" not in request.headers.get("cookie", "")
+        request = client.build_request("GET", "https://example.com/")
+        assert "session=secret" in request.headers["cookie"]
+
+
+async def test_get_http_client_from_browser_verifies_certificates(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    calls = []
+
+    def fake_get_http_client(**kwargs: Any) -> httpx.Client:
+        calls.append(kwargs)
+        return httpx.Client()
+
+    monkeypatch.setattr(oauth_helpers, "get_http_client", fake_get_http_client)
+
+    await get_http_client_from_browser(FakeBrowserContext(COOKIES))
+    await get_http_client_from_browser(FakeBrowserContext(COOKIES), verify=False)
+
+    assert [kwargs["verify"] for kwargs in calls] == [True, False]
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from typing import List
+
+import pytest
+
+from oauth_tools.fake_metrics import FakeMetricsClient
+from oauth_tools.pod_resources import PodResourceSampler, parse_quantity
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def metrics_client() -> FakeMetricsClient:
+    client = FakeMetricsClient()
+    client.add_pod("hydra-0", app="hydra", cpu="250m", memory="64Mi")
+    client.add_pod("hydra-1", app="hydra", cpu="750m", memory="64Mi")
+    # Without the juju label, the component is told from the pod name
+    client.add_pod("postgresql-k8s-0", cpu="1", memory="1Gi")
+    return client
+
+
+@pytest.mark.parametrize(
+    "quantity, expected",
+    [
+        ("0", 0.0),
+        ("2", 2.0),
+        ("250m", 0.25),
+        ("128974848n", 0.128974848),
+        ("1500u", 0.0015),
+        ("1k", 1000.0),
+        ("64Mi", 64 * 2**20),
+        ("2Gi", 2 * 2**30),
+        ("1.5G", 1.5e9),
+    ],
+)
+def test_parse_quantity(quantity: str, expected: float) -> None:
+    assert parse_quantity(quantity) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("quantity", ["", "m", "abc", "5X", "1Mii", "-1"])
+def test_parse_invalid_quantity(quantity: str) -> None:
+    with pytest.raises(ValueError):
+        parse_quantity(quantity)
+
+
+def test_sample_per_component(metrics_client: FakeMetricsClient) -> None:
+    clock = FakeClock()
+    sampler = PodResourceSampler(metrics_client, "test-model", clock=clock)
+
+    clock.now += 5
+    samples = sampler.sample()
+
+    assert set(samples) == {"hydra", "postgresql-k8s"}
+    hydra = samples["hydra"]
+    assert hydra.time == 5
+    assert hydra.pods == 2
+    assert hydra.cpu == pytest.approx(1.0)
+    assert hydra.memory == 128 * 2**20
+    assert samples["postgresql-k8s"].memory == 2**30
+
+
+def test_series_and_summary(metrics_client: FakeMetricsClient) -> None:
+    clock = FakeClock()
+    sampler = PodResourceSampler(metrics_client, "test-model", clock=clock)
+
+    sampler.sample()
+    metrics_client.set_usage("hydra-0", cpu="1250m", memory="256Mi")
+    clock.now += 5
+    sampler.sample()
+
+    series = sampler.series()["hydra"]
+    assert series["time"] == [0, 5]
+    assert series["cpu"] == pytest.approx([1.0, 2.0])
+    summary = sampler.summary()["hydra"]
+    assert summary["pods"] == 2
+    assert summary["cpu_mean"] == pytest.approx(1.5)
+    assert summary["cpu_max"] == pytest.approx(2.0)
+    assert summary["memory_max"] == 320 * 2**20
+    assert summary["restarts"] == 0
+    assert "hydra: 2 pod(s), 0 restart(s), cpu mean 1500m max 2000m" in sampler.format()
+
+
+def test_restarts_are_counted_per_pod(metrics_client: FakeMetricsClient) -> None:
+    # The restarts before the sampling started are not counted
+    metrics_client.restart("hydra-0")
+    sampler = PodResourceSampler(metrics_client, "test-model", clock=FakeClock())
+    sampler.sample()
+
+    metrics_client.restart("hydra-0")
+    metrics_client.restart("hydra-1")
+    sampler.sample()
+    # A recreated pod counts its restarts from 0 again
+    metrics_client.recreate("hydra-0")
+    sampler.sample()
+    metrics_client.restart("hydra-0")
+    metrics_client.add_pod("hydra-2", app="hydra")
+    metrics_client.restart("hydra-2")
+    sampler.sample()
+
+    restarts: List[int] = sampler.series()["hydra"]["restarts"]
+    assert restarts == [1, 3, 1, 3]
+    assert sampler.summary()["hydra"]["restarts"] == 4
+    assert sampler.summary()["postgresql-k8s"]["restarts"] == 0
+
+
+def test_only_restarts_without_metrics_api(metrics_client: FakeMetricsClient) -> None:
+    metrics_client.metrics_available = False
+    sampler = PodResourceSampler(metrics_client, "test-model", clock=FakeClock())
+
+    sampler.sample()
+    metrics_client.restart("postgresql-k8s-0")
+    metrics_client.metrics_available = True
+    samples = sampler.sample()
+
+    # The metrics API is not queried again once it failed
+    assert samples["hydra"].cpu is None
+    assert samples["hydra"].memory is None
+    assert samples["postgresql-k8s"].restarts == 1
+    summary = sampler.summary()
+    assert summary["hydra"]["cpu_mean"] is None
+    assert summary["hydra"]["memory_max"] is None
+    assert summary["postgresql-k8s"]["restarts"] == 1
+    assert sampler.format().splitlines() == [
+        "hydra: 2 pod(s), 0 restart(s)",
+        "postgresql-k8s: 1 pod(s), 1 restart(s)",
+    ]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from typing import Any, Dict, List, Optional
+
+import httpx
+import pytest
+
+from oauth_tools import soak
+from oauth_tools.soak import SoakResult, SoakSample, run_refresh_soak
+
+
+def _get_result(
+    latencies: Dict[int, List[float]], errors: Optional[Dict[int, int]] = None
+) -> SoakResult:
+    """Get a soak result with the latencies and errors of each 300s window."""
+    errors = errors or {}
+    samples = []
+    for window in sorted({*latencies, *errors}):
+        start = window * 300.0
+        for i, latency in enumerate(latencies.get(window, [])):
+            samples.append(SoakSample(start + i, i, latency, 200))
+        for i in range(errors.get(window, 0)):
+            samples.append(SoakSample(start + 200 + i, i, 1.0, 500))
+    return SoakResult(sessions=5, duration=3600.0, samples=samples, broken_sessions=0)
+
+
+def test_windows() -> None:
+    result = _get_result({0: [0.1, 0.2, 0.3, 0.4], 2: [0.5]}, errors={2: 2})
+
+    windows = result.windows()
+
+    assert [(w.start, w.requests, w.errors) for w in windows] == [(0, 4, 0), (600, 3, 2)]
+    assert windows[0].p50 == 0.3
+    assert windows[0].p95 == 0.4
+    # The latency of the failed refreshes is left out
+    assert windows[1].p50 == windows[1].p95 == 0.5
+    # The errors come 200s into their window
+    assert [w.start for w in result.windows(window=60)] == [0, 600, 780]
+
+
+def test_latency_trend() -> None:
+    result = _get_result({0: [0.1], 1: [0.2], 2: [0.3]})
+
+    trend = result.get_latency_trend()
+
+    # 0.1s more every 300s
+    assert trend["slope"] == pytest.approx(1.2)
+    assert trend["drift"] == pytest.approx(2.0)
+
+
+def test_flat_latency_trend() -> None:
+    result = _get_result({0: [0.2, 0.1, 0.3], 1: [0.2], 2: [0.2], 3: [0.2]})
+
+    assert result.get_latency_trend() == {"slope": pytest.approx(0), "drift": pytest.approx(0)}
+    assert not result.summary()["latency_trend"]["flagged"]
+
+
+def test_latency_trend_needs_3_windows() -> None:
+    # The windows with only errors have no latency
+    result = _get_result({0: [0.1], 1: [0.2]}, errors={2: 3})
+
+    assert result.get_latency_trend() is None
+    assert result.summary()["latency_trend"] == {"slope": 0.0, "drift": 0.0, "flagged": False}
+
+
+def test_trend_threshold() -> None:
+    result = _get_result({0: [0.10], 1: [0.11], 2: [0.12]})
+
+    # The fitted latency grew by 20%
+    assert not result.summary(trend_threshold=0.25)["latency_trend"]["flagged"]
+    assert result.summary(trend_threshold=0.15)["latency_trend"]["flagged"]
+    assert "(UPWARD TREND)" in result.format(trend_threshold=0.15)
+
+
+def test_error_bursts() -> None:
+    result = _get_result({0: [0.1], 1: [0.1], 2: [0.1]}, errors={0: 2, 1: 3, 2: 5})
+
+    assert [w.start for w in result.get_error_bursts()] == [300, 600]
+    assert [w.start for w in result.get_error_bursts(min_errors=5)] == [600]
+    summary = result.summary()
+    assert summary["errors"] == 10
+    assert [burst["errors"] for burst in summary["error_bursts"]] == [3, 5]
+    assert result.format().count("(ERROR BURST)") == 2
+
+
+class FakeTokenEndpoint:
+    """Rotate the refresh tokens, fail the requests of the tokens given a failure."""
+
+    def __init__(self, failures: Dict[str, List[Exception]]):
+        self.failures = failures
+        self.issued = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        token = dict(httpx.QueryParams(request.content.decode()))["refresh_token"]
+        if self.failures.get(token):
+            raise self.failures[token].pop(0)
+        self.issued += 1
+        return httpx.Response(200, json={"refresh_token": f"{token}-{self.issued}"})
+
+
+async def test_soak_retries_the_connect_errors_only(monkeypatch: pytest.MonkeyPatch) -> None:
+    endpoint = FakeTokenEndpoint({
+        "connect": [httpx.ConnectError("refused"), httpx.ConnectTimeout("timeout")],
+        "read": [httpx.ReadTimeout("timeout")],
+    })
+
+    def get_async_http_client(**kwargs: Any) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(endpoint), auth=kwargs["auth"])
+
+    monkeypatch.setattr(soak, "get_async_http_client", get_async_http_client)
+
+    result = await run_refresh_soak(
+        "http://hydra",
+        "client",
+        "secret",
+        ["connect", "read"],
+        duration=0.5,
+        refresh_interval=0.01,
+        jitter=0,
+    )
+
+    summary = result.summary()
+    assert summary["connect_errors"] == 2
+    assert summary["read_errors"] == 1
+    assert result.broken_sessions == 0
+    assert result.lost_sessions == 1
+    # The session that could not connect carried on with its token
+    connect_samples = [sample for sample in result.samples if sample.session == 0]
+    assert [sample.error_kind for sample in connect_samples[:3]] == ["connect", "connect", None]
+    assert connect_samples[-1].status == 200
+    assert [sample.error_kind for sample in result.samples if sample.session == 1] == ["read"]
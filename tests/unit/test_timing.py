@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+import pytest
+
+from oauth_tools import timing
+from oauth_tools.timing import (
+    WORKER_OUTPUT,
+    merge_timings,
+    pytest_sessionfinish,
+    pytest_testnodedown,
+)
+
+
+class FakeConfig:
+    """The options of the timing plugin, and the stash of a pytest config."""
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        baseline_path: Optional[Path] = None,
+        **attributes: Any,
+    ):
+        self.stash = pytest.Stash()
+        self._options = {
+            "phase_timings": str(path) if path else None,
+            "phase_timings_baseline": str(baseline_path) if baseline_path else None,
+            "phase_timings_threshold": 0.2,
+        }
+        self.__dict__.update(attributes)
+
+    def getoption(self, name: str) -> Any:
+        return self._options[name]
+
+
+@pytest.fixture(autouse=True)
+def timings(monkeypatch: pytest.MonkeyPatch) -> Dict[str, Dict[str, float]]:
+    timings: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    monkeypatch.setattr(timing, "_timings", timings)
+    return timings
+
+
+def test_merge_timings() -> None:
+    merged = merge_timings([
+        {"session": {"deploy": 10.0}, "test_a": {"login": 1.0}},
+        {"session": {"deploy": 5.0, "wait_for_idle": 2.0}, "test_b": {"login": 3.0}},
+    ])
+
+    assert merged == {
+        "session": {"deploy": 15.0, "wait_for_idle": 2.0},
+        "test_a": {"login": 1.0},
+        "test_b": {"login": 3.0},
+    }
+
+
+def test_worker_sends_its_timings_to_the_controller(
+    timings: Dict[str, Dict[str, float]], tmp_path: Path
+) -> None:
+    timings["test_a"]["login"] = 1.0
+    config = FakeConfig(tmp_path / "report.json", workerinput={"workerid": "gw0"}, workeroutput={})
+
+    pytest_sessionfinish(SimpleNamespace(config=config))
+
+    assert config.workeroutput[WORKER_OUTPUT] == {"test_a": {"login": 1.0}}
+    assert not list(tmp_path.iterdir())
+
+
+def test_controller_reports_the_timings_of_all_the_workers(tmp_path: Path) -> None:
+    path, baseline_path = tmp_path / "report.json", tmp_path / "baseline.json"
+    baseline_path.write_text(
+        json.dumps({"tests": {"test_a": {"login": 1.0}, "test_b": {"login": 3.0}}})
+    )
+    config = FakeConfig(path, baseline_path)
+    for timings in ({"test_a": {"login": 5.0}}, {"test_b": {"login": 3.0}}):
+        pytest_testnodedown(
+            SimpleNamespace(config=config, workeroutput={WORKER_OUTPUT: timings}), None
+        )
+
+    pytest_sessionfinish(SimpleNamespace(config=config))
+
+    report = json.loads(path.read_text())
+    assert report["tests"] == {"test_a": {"login": 5.0}, "test_b": {"login": 3.0}}
+    assert report["regressions"] == [
+        {"test": "test_a", "phase": "login", "baseline": 1.0, "duration": 5.0}
+    ]
+    # A single report, the workers do not write their own
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["baseline.json", "report.json"]